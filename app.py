@@ -1,459 +1,730 @@
-import json, os, io, traceback, smtplib
-from flask import Flask, request, send_file, jsonify
-from pypdf import PdfReader, PdfWriter
+import itertools, json, os, io, time, traceback
+import pypdf
+from flask import Flask, Response, g, request, send_file, jsonify, stream_with_context
+from editions import Layout, TemplateRegistry, UnknownEdition
+from form_fill import FieldBatch
+from field_plan import Choice, Const, Flag, Get, Join, Lookup, Text, Unless, When, compile_plan
+from payload_schema import Amount, Code, Date, Email, Enum, Integer, PayloadError, Str, Unit, YesNo, compile_schema
+import mailer
+from batch import BatchRunner, parse_items, stream_zip
+from result_cache import ResultCache, code_fingerprint, payload_key
+from jobs import JobQueue, JobStore, QueueFull
+from spool import PdfSpool
+from static_assets import StaticAssets
+import metrics
+from metrics import Timings
+
+# static/ is served by StaticAssets (see index below), not Flask's static route
+app = Flask(__name__, static_folder=None)
+
+@app.before_request
+def start_timing():
+    g.t0 = time.perf_counter()
+    g.timings = Timings()
 
-app = Flask(__name__, static_folder="static", static_url_path="")
+@app.after_request
+def add_timing(r):
+    # Server-Timing shows the per-phase breakdown in browser devtools
+    if "t0" in g:
+        total = time.perf_counter() - g.t0
+        endpoint = request.endpoint if request.endpoint in metrics.ENDPOINTS else "other"
+        metrics.REQUEST_SECONDS.observe(endpoint, total)
+        r.headers["Server-Timing"] = g.timings.server_timing(total)
+    return r
 
 @app.after_request
 def add_cors(r):
+    # The frontend is same-origin; only the API is called cross-origin
+    if request.endpoint in ("index", "static_asset"): return r
     r.headers["Access-Control-Allow-Origin"] = "*"
-    r.headers["Access-Control-Allow-Headers"] = "Content-Type"
+    r.headers["Access-Control-Allow-Headers"] = "Content-Type, If-None-Match"
+    r.headers["Access-Control-Expose-Headers"] = "ETag, X-Cache, Location, Retry-After"
+    r.headers["Timing-Allow-Origin"] = "*"
     r.headers["Access-Control-Allow-Methods"] = "GET,POST,OPTIONS"
     return r
 
 @app.route("/fill", methods=["OPTIONS"])
+@app.route("/fill/batch", methods=["OPTIONS"])
+@app.route("/jobs", methods=["OPTIONS"])
+@app.route("/preview", methods=["OPTIONS"])
 def fill_options(): return "", 204
 
 PDF_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "i-129.pdf")
-SMTP_HOST = os.environ.get("SMTP_HOST","")
-SMTP_PORT = int(os.environ.get("SMTP_PORT","587"))
-SMTP_USER = os.environ.get("SMTP_USER","")
-SMTP_PASS = os.environ.get("SMTP_PASS","")
-NOTIFY_EMAIL = os.environ.get("NOTIFY_EMAIL","")
-
-
-def fill_i129(data, input_pdf):
-    f = data
-    reader = PdfReader(input_pdf)
-    if reader.is_encrypted:
-        reader.decrypt("")
-
-    writer = PdfWriter()
-    writer.append(reader)
-
-    # Remove XFA so PDF viewers render AcroForm fields
-    if "/AcroForm" in writer._root_object:
-        acroform = writer._root_object["/AcroForm"].get_object()
-        if "/XFA" in acroform:
-            del acroform["/XFA"]
-
-    # Build field → page map
-    key_to_page = {}
-    for pi, page in enumerate(writer.pages):
-        if "/Annots" not in page: continue
-        for annot in page["/Annots"]:
-            obj = annot.get_object()
-            if obj.get("/Subtype") == "/Widget" and "/T" in obj:
-                key_to_page[str(obj["/T"])] = pi
-
-    def s(key, value):
-        if not value or key not in key_to_page: return
-        try:
-            writer.update_page_form_field_values(
-                [writer.pages[key_to_page[key]]], {key: str(value)}, auto_regenerate=False)
-        except Exception as e:
-            app.logger.warning(f"Could not set {key}: {e}")
+# SMTP_HOST/PORT/USER/PASS, NOTIFY_EMAIL and MAIL_* tuning; see mailer.from_env
+MAILER = mailer.from_env(base_dir=os.path.dirname(PDF_PATH))
+
+
+CLS_SHORT = {
+    "H-1B Specialty Occupation":"H-1B","H-1B1 Chile/Singapore":"H-1B1",
+    "H-2A Agricultural Worker":"H-2A","H-2B Non-agricultural Worker":"H-2B","H-3 Trainee":"H-3",
+    "L-1A Manager/Executive":"L-1A","L-1B Specialized Knowledge":"L-1B",
+    "O-1A Extraordinary Ability (Sciences/Business/Athletics)":"O-1A",
+    "O-1B Extraordinary Ability (Arts/TV/Film)":"O-1B",
+    "E-1 Treaty Trader":"E-1","E-2 Treaty Investor":"E-2",
+    "TN Canada":"TN","TN Mexico":"TN","R-1 Religious Worker":"R-1","Q-1 Cultural Exchange":"Q-1",
+}
+BASIS_MAP = {"new":"new[0]","continuation":"continuation[0]","change_prev":"previouschange[0]",
+             "concurrent":"concurrent[0]","change_employer":"change[0]","amended":"amended[0]"}
+ACTION_IDX = {"notify":0,"change_extend":1,"extend":2,"amend":3}
+# H classification checkbox on supplement
+CLS_MAP = {
+    "H-1B Specialty Occupation": 0,
+    "H-1B1 Chile/Singapore": 1,
+    "H-2A Agricultural Worker": 4,
+    "H-2B Non-agricultural Worker": 7,
+    "H-3 Trainee": 5,
+}
+# i-129.pdf is the 01/20/25 edition; others sit next to it as i-129-YYYY-MM-DD.pdf (see editions.py)
+DEFAULT_EDITION = "2025-01-20"
+# Pages (0-based, 01/20/25 edition) kept by the compact output mode
+CORE_PAGES = range(0, 8)          # Parts 1-9
+ATTACHMENT_PAGES = range(36, 38)  # Attachment-1, only needed for more than one beneficiary
+SUPPLEMENT_PAGES = {
+    "E-1": range(8, 10), "E-2": range(8, 10),
+    "TN": range(10, 12),
+    "H-1B": (*range(12, 15), *range(20, 23)),
+    "H-1B1": (*range(10, 15), *range(20, 23)),
+    "H-2A": range(12, 19), "H-2B": range(12, 19),
+    "H-3": (*range(12, 15), 19),
+    "L-1A": range(23, 27), "L-1B": range(23, 27),
+    "O-1A": range(27, 30), "O-1B": range(27, 30),
+    "Q-1": (30,),
+    "R-1": range(31, 36),
+}
+# Highest education level
+EDU_MAP = {
+    "none": "a_no_diploma[0]",
+    "hs": "b_HSDiploma[0]",
+    "some_college": "c_some_college[0]",
+    "associates": "e_AssociateDegree[0]",
+    "bachelors": "f_BachelorDegree[0]",
+    "some_grad": "d_collegeplus[0]",
+    "masters": "g_MasterDegree[0]",
+    "professional": "h_ProfessionalDegree[0]",
+    "doctorate": "i_DoctorateDegree[0]",
+}
+
+
+# "full" rewrites the whole document; "incremental" appends only the changes to the original bytes;
+# "compact" keeps only the pages for the petition's classification, deduplicated and recompressed;
+# "flat" draws the answers into the pages and drops the form, for archiving and printing
+OUTPUT_MODES = ("full", "incremental", "compact", "flat")
+OUTPUT_MODE = os.environ.get("OUTPUT_MODE", "full")
+
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+# Everything that shapes the output bytes: template preparation and baking, edition choice, the fill code, pypdf
+CODE_FINGERPRINT = code_fingerprint(*(os.path.join(_HERE, m) for m in (
+    "app.py", "field_plan.py", "payload_schema.py", "form_fill.py", "template_cache.py", "editions.py",
+    "field_manifest.py", "incremental.py", "compact.py", "flatten.py")), versions=(f"pypdf {pypdf.__version__}",))
+RESULTS = ResultCache(max_bytes=int(float(os.environ.get("RESULT_CACHE_MB", "64")) * (1 << 20)),
+                      disk_dir=os.environ.get("RESULT_CACHE_DIR") or None,
+                      disk_max_bytes=int(float(os.environ.get("RESULT_CACHE_DISK_MB", "512")) * (1 << 20)))
+# /fill output bigger than this goes to an unlinked temp file instead of memory
+SPOOL_BYTES = int(float(os.environ.get("PDF_SPOOL_MB", "1")) * (1 << 20))
+
+def edition_for(data, input_pdf=None):
+    """The form edition a payload is filled into: ``input_pdf`` if given, else chosen by the registry."""
+    return TEMPLATES.pick(data) if input_pdf is None else TEMPLATES.by_path(input_pdf)
+
+
+def result_key(data, input_pdf=None, mode=None):
+    edition = edition_for(data, input_pdf)
+    return payload_key(data, mode or OUTPUT_MODE, edition.name + edition.sha256 + CODE_FINGERPRINT)
+
+
+def fill_i129(data, input_pdf=None, mode=None, timings=None, out=None):
+    """Fill the template and write the PDF to ``out`` (a new BytesIO by default), which is returned.
+
+    ``input_pdf`` forces one edition's file; by default the payload picks its edition.
+    """
+    mode = mode or OUTPUT_MODE
+    if mode not in OUTPUT_MODES: raise ValueError(f"Unknown output mode {mode!r}")
+    timings = timings or Timings()
+    # Copy-on-write clone of the parsed, decrypted, XFA-free template
+    with timings.phase("clone"):
+        edition = edition_for(data, input_pdf)
+        cache = TEMPLATES.template(edition)
+        base = cache.incremental() if mode == "incremental" else cache
+        # Flat output only rewrites the catalog and the pages, so its clone copies just those
+        writer, manifest = base.checkout(cache.flatten().mutable) if mode == "flat" else base.checkout()
+
+    # Collect every value first; they are written in one pass at the end
+    with timings.phase("map_fields"):
+        fields = resolve_fields(data, manifest, edition.layout)
+    with timings.phase("fill_fields"):
+        if mode == "flat":
+            cache.flatten().apply(writer, fields)
+        else:
+            fields.apply(writer)
+
+    with timings.phase("write"):
+        buf = io.BytesIO() if out is None else out
+        if mode == "incremental":
+            base.write(writer, fields.touched, buf)
+        elif mode == "compact":
+            cache.compact().write(writer, compact_pages(data, edition.layout), buf)
+        elif mode == "flat":
+            cache.compact().write(writer, None, buf)
+        else:
+            writer.write(buf)
+    if out is None: buf.seek(0)
+    return buf
+
+
+def compact_pages(data, layout):
+    """Pages the compact mode keeps for this payload, or None (all of them) for an unknown classification."""
+    short = CLS_SHORT.get(data.get("classification", ""))
+    if short not in layout.supplement_pages: return None
+    pages = [*layout.core_pages, *layout.supplement_pages[short]]
+    try:
+        if int(data.get("totalWorkers") or 1) > 1: pages += layout.attachment_pages
+    except ValueError:
+        pass
+    return sorted(set(pages))
+
+
+def resolve_fields(data, manifest, layout, constants=False):
+    """The ``FieldBatch`` that ``fill_i129`` writes for ``data``; shared with ``/preview``.
+
+    Constant answers are already in the cached template, so they are only
+    included on request (``/preview`` shows the whole form).
+    """
+    fields = FieldBatch(manifest)
+    layout.plan.apply(data, fields, constants)
+    return fields
 
+
+PET_NAME = ("companyName", Join("petFirstName", "petLastName"))
+BEN_NAME = (Join("benFirstName", "benLastName"),)
+H_CLS_BOXES = [(f"SubHLine4_class[{i}]", "/" + state) for i, state in enumerate("ABCDEGHF")]
+
+def unit_boxes(prefix, *kinds):
+    """The Apt/Ste/Flr boxes of one address, given the kind each of ``prefix[0..2]`` stands for."""
+    return {kind: (f"{prefix}[{i}]", f"/ {kind.upper()} ") for i, kind in enumerate(kinds)}
+
+FIELD_SPEC = [
     # ══ PAGE 1 — PART 1: PETITIONER ══════════════════════════════
-    if f.get("petitionerType") == "company":
-        s("Line3_CompanyorOrgName[0]", f.get("companyName"))
-    else:
-        s("Line1_FamilyName[0]",  f.get("petLastName"))
-        s("Line1_GivenName[0]",   f.get("petFirstName"))
-        s("Line1_MiddleName[0]",  f.get("petMiddleName"))
-
-    s("Line7a_InCareofName[0]",             f.get("petInCareOf"))
-    s("Line7b_StreetNumberName[0]",         f.get("petStreet"))
-    s("Line3_AptSteFlrNumber[0]",           f.get("petApt"))
-    s("Line_CityTown[0]",                   f.get("petCity"))
-    s("P1_Line3_State[0]",                  f.get("petState"))
-    s("P1_Line3_ZipCode[0]",                f.get("petZip"))
-    s("P1_Line3_Country[0]",                f.get("petCountry") or "United States")
-    s("P1_Line3_Province[0]",               f.get("petProvince"))
-    s("P1_Line3_PostalCode[0]",             f.get("petPostalCode"))
-    s("Line2_DaytimePhoneNumber1_Part8[0]", f.get("petPhone"))
-    s("Line3_MobilePhoneNumber1_Part8[0]",  f.get("petMobile"))
-    s("Line9_EmailAddress[0]",              f.get("petEmail"))
-    s("TextField1[0]",                      f.get("fein"))
-    s("Line3_TaxNumber[0]",                 f.get("petIRS") or f.get("fein"))
-    s("Line4_SSN[0]",                       f.get("petSSN"))
-
-    nonprofit = f.get("isNonprofit") == "yes"
-    s("P1Line6_Yes[0]", "/Y"   if nonprofit else "/Off")
-    s("P1Line6_No[0]",  "/Off" if nonprofit else "/Y")
+    When("petitionerType", "company",
+         Text("Line3_CompanyorOrgName[0]", "companyName")),
+    Unless("petitionerType", "company",
+           Text("Line1_FamilyName[0]",  "petLastName"),
+           Text("Line1_GivenName[0]",   "petFirstName"),
+           Text("Line1_MiddleName[0]",  "petMiddleName")),
+
+    Text("Line7a_InCareofName[0]",             "petInCareOf"),
+    Text("Line7b_StreetNumberName[0]",         "petStreet"),
+    Text("Line3_AptSteFlrNumber[0]",           "petApt"),
+    Choice("petAptType", unit_boxes("Line3_Unit", "ste", "apt", "flr")),
+    Text("Line_CityTown[0]",                   "petCity"),
+    Text("P1_Line3_State[0]",                  "petState"),
+    Text("P1_Line3_ZipCode[0]",                "petZip"),
+    Text("P1_Line3_Country[0]",                "petCountry", default="United States"),
+    Text("P1_Line3_Province[0]",               "petProvince"),
+    Text("P1_Line3_PostalCode[0]",             "petPostalCode"),
+    Text("Line2_DaytimePhoneNumber1_Part8[0]", "petPhone"),
+    Text("Line3_MobilePhoneNumber1_Part8[0]",  "petMobile"),
+    Text("Line9_EmailAddress[0]",              "petEmail"),
+    Text("TextField1[0]",                      "fein"),
+    Text("Line3_TaxNumber[0]",                 "petIRS", "fein"),
+    Text("Line4_SSN[0]",                       "petSSN"),
+
+    Flag("isNonprofit", "P1Line6_Yes[0]", "P1Line6_No[0]"),
 
     # ══ PAGE 2 — PART 2 + PART 3 NAME ════════════════════════════
-    cls_short = {
-        "H-1B Specialty Occupation":"H-1B","H-1B1 Chile/Singapore":"H-1B1",
-        "H-2A Agricultural Worker":"H-2A","H-2B Non-agricultural Worker":"H-2B","H-3 Trainee":"H-3",
-        "L-1A Manager/Executive":"L-1A","L-1B Specialized Knowledge":"L-1B",
-        "O-1A Extraordinary Ability (Sciences/Business/Athletics)":"O-1A",
-        "O-1B Extraordinary Ability (Arts/TV/Film)":"O-1B",
-        "E-1 Treaty Trader":"E-1","E-2 Treaty Investor":"E-2",
-        "TN Canada":"TN","TN Mexico":"TN","R-1 Religious Worker":"R-1","Q-1 Cultural Exchange":"Q-1",
-    }
-    cls = f.get("classification","")
-    s("Part2_ClassificationSymbol[0]", cls_short.get(cls, cls))
-    s("TtlNumbersofWorker[0]",         f.get("totalWorkers") or "1")
-    s("Line1_ReceiptNumber[0]",        f.get("priorReceiptNumber") or "None")
-
-    basis_map = {"new":"new[0]","continuation":"continuation[0]","change_prev":"previouschange[0]",
-                 "concurrent":"concurrent[0]","change_employer":"change[0]","amended":"amended[0]"}
-    basis = f.get("basisForClassification","new")
-    for k,field in basis_map.items():
-        s(field, "/1" if k==basis else "/Off")
-
-    action_idx = {"notify":0,"change_extend":1,"extend":2,"amend":3}.get(f.get("requestedAction","notify"),0)
-    for i in range(6):
-        s(f"P2Checkbox4[{i}]", "/A" if i==action_idx else "/Off")
+    Text("Part2_ClassificationSymbol[0]", Lookup("classification", CLS_SHORT)),
+    Text("TtlNumbersofWorker[0]",         "totalWorkers", default="1"),
+    Text("Line1_ReceiptNumber[0]",        "priorReceiptNumber", default="None"),
+
+    Choice("basisForClassification", BASIS_MAP, default="new"),
+    Choice("requestedAction", {a: (f"P2Checkbox4[{i}]", "/" + "ABCDEF"[i]) for a, i in ACTION_IDX.items()},
+           otherwise="notify", unused=[f"P2Checkbox4[{i}]" for i in range(len(ACTION_IDX), 6)]),
 
     # Named beneficiary checkbox
-    s("P3Line1_Checkbox[1]", "/Y")
-    s("P3Line1_Checkbox[0]", "/Off")
+    Const("P3Line1_Checkbox[1]", "/Y"),
+    Const("P3Line1_Checkbox[0]", "/Off"),
 
     # Beneficiary name on page 2
-    s("Part3_Line2_FamilyName[0]", f.get("benLastName"))
-    s("Part3_Line2_GivenName[0]",  f.get("benFirstName"))
-    s("Part3_Line2_MiddleName[0]", f.get("benMiddleName"))
+    Text("Part3_Line2_FamilyName[0]", "benLastName"),
+    Text("Part3_Line2_GivenName[0]",  "benFirstName"),
+    Text("Part3_Line2_MiddleName[0]", "benMiddleName"),
 
     # ══ PAGE 3 — PART 3: OTHER NAMES + PERSONAL + US ADDRESS + PART 4 ══
     # Other names (up to 3)
-    s("Line3_FamilyName1[0]",  f.get("benOtherLast1"))
-    s("Line3_GivenName1[0]",   f.get("benOtherFirst1"))
-    s("Line3_MiddleName1[0]",  f.get("benOtherMiddle1"))
-    s("Line3_FamilyName2[0]",  f.get("benOtherLast2"))
-    s("Line3_GivenName2[0]",   f.get("benOtherFirst2"))
-    s("Line3_MiddleName2[0]",  f.get("benOtherMiddle2"))
-    s("Line3_FamilyName3[0]",  f.get("benOtherLast3"))
-    s("Line3_GivenName3[0]",   f.get("benOtherFirst3"))
-    s("Line3_MiddleName3[0]",  f.get("benOtherMiddle3"))
+    *(Text(f"Line3_{part}Name{n}[0]", f"benOther{key}{n}")
+      for n in range(1, 4) for part, key in (("Family", "Last"), ("Given", "First"), ("Middle", "Middle"))),
 
     # Personal info
-    male = f.get("benSex") == "male"
-    s("Line1_Gender_P3[0]", "/M"   if male else "/Off")
-    s("Line1_Gender_P3[1]", "/Off" if male else "/F")
-    s("Line6_DateOfBirth[0]",               f.get("benDob"))
-    s("Line5_SSN[0]",                       f.get("benSSN"))
-    s("Line1_AlienNumber[0]",               f.get("benANumber"))
-    s("Part3Line4_CountryOfBirth[0]",       f.get("benCountryBirth"))
-    s("Part4Line3_DProvince[0]",            f.get("benProvinceBirth"))
-    s("Part3Line4_CountryOfCitizenship[0]", f.get("benCountryCitizenship"))
+    Flag("benSex", "Line1_Gender_P3[0]", "Line1_Gender_P3[1]", yes="/M", no="/F", when="male"),
+    Text("Line6_DateOfBirth[0]",               "benDob"),
+    Text("Line5_SSN[0]",                       "benSSN"),
+    Text("Line1_AlienNumber[0]",               "benANumber"),
+    Text("Part3Line4_CountryOfBirth[0]",       "benCountryBirth"),
+    Text("Part4Line3_DProvince[0]",            "benProvinceBirth"),
+    Text("Part3Line4_CountryOfCitizenship[0]", "benCountryCitizenship"),
 
     # US address
-    s("Line8a_StreetNumberName[0]",  f.get("benStreet"))
-    s("Line6_AptSteFlrNumber[0]",    f.get("benApt"))
-    s("Line8d_CityTown[0]",          f.get("benCity"))
-    s("Line8e_State[0]",             f.get("benState"))
-    s("Line8f_ZipCode[0]",           f.get("benZip"))
+    Text("Line8a_StreetNumberName[0]",  "benStreet"),
+    Text("Line6_AptSteFlrNumber[0]",    "benApt"),
+    Choice("benAptType", unit_boxes("Line6_Unit", "apt", "flr", "ste")),
+    Text("Line8d_CityTown[0]",          "benCity"),
+    Text("Line8e_State[0]",             "benState"),
+    Text("Line8f_ZipCode[0]",           "benZip"),
 
     # Passport + entry info
-    s("Part3Line5_PassportorTravDoc[0]", f.get("benPassportNumber"))
-    s("Line_CountryOfIssuance[0]",       f.get("benPassportCountry"))
-    s("Line11e_ExpDate[1]",              f.get("benPassportIssued"))
-    s("Line11e_ExpDate[0]",              f.get("benPassportExpires"))
-    s("Line11h_DateStatusExpires[0]",    f.get("benStatusExpires"))
-    s("Part3Line5_ArrivalDeparture[0]",  f.get("benI94"))
-    s("Part3Line5_DateofArrival[0]",     f.get("benLastArrival"))
-    s("Line5_EAD[0]",                    f.get("benEAD"))
-    s("Line5_SEVIS[0]",                  f.get("benSEVIS"))
+    Text("Part3Line5_PassportorTravDoc[0]", "benPassportNumber"),
+    Text("Line_CountryOfIssuance[0]",       "benPassportCountry"),
+    Text("Line11e_ExpDate[1]",              "benPassportIssued"),
+    Text("Line11e_ExpDate[0]",              "benPassportExpires"),
+    Text("Line11h_DateStatusExpires[0]",    "benStatusExpires"),
+    Text("Part3Line5_ArrivalDeparture[0]",  "benI94"),
+    Text("Part3Line5_DateofArrival[0]",     "benLastArrival"),
+    Text("Line5_EAD[0]",                    "benEAD"),
+    Text("Line5_SEVIS[0]",                  "benSEVIS"),
 
     # Processing office
-    s("OfficeAddressCity[0]",        f.get("consultateCity"))
-    s("Part4_1c_State_or_Country[0]",f.get("consultateCountry"))
-    ot = f.get("officeType","consulate")
-    s("TypeofOffice[0]", "/CON" if ot=="consulate" else "/Off")
-    s("TypeofOffice[1]", "/PRE" if ot=="preflight" else "/Off")
-    s("TypeofOffice[2]", "/POR" if ot=="port"      else "/Off")
+    Text("OfficeAddressCity[0]",         "consultateCity"),
+    Text("Part4_1c_State_or_Country[0]", "consultateCountry"),
+    Choice("officeType", {"consulate": ("TypeofOffice[0]", "/CON"), "preflight": ("TypeofOffice[1]", "/PFI"),
+                          "port": ("TypeofOffice[2]", "/POE")}, default="consulate"),
 
     # Beneficiary foreign address
-    s("Line2b_StreetNumberName[0]", f.get("benForeignStreet"))
-    s("Line2c_CityTown[0]",         f.get("benForeignCity"))
-    s("Line2g2_Province[0]",        f.get("benForeignProvince"))
-    s("Line3f_PostalCode[0]",        f.get("benForeignPostal"))
-    s("Line_Country[0]",             f.get("benForeignCountry"))
+    Text("Line2b_StreetNumberName[0]", "benForeignStreet"),
+    Text("Line2c_CityTown[0]",         "benForeignCity"),
+    Text("Line2g2_Province[0]",        "benForeignProvince"),
+    Text("Line3f_PostalCode[0]",       "benForeignPostal"),
+    Text("Line_Country[0]",            "benForeignCountry"),
 
     # Page 4 standard answers
-    s("P4Line2_Checkbox[1]", "/Y")   # valid passport: yes
-    s("P4Line2_Checkbox[0]", "/Off")
-    s("P4Line3_No[0]",  "/Y"); s("P4Line3_Yes[0]",  "/Off")
-    s("P4Line4_No[0]",  "/Y"); s("P4Line4_Yes[0]",  "/Off")
-    s("P4Line5_No[0]",  "/Y"); s("P4Line5_Yes[0]",  "/Off")
-    s("P4Line6_No[0]",  "/Y"); s("P4Line6_Yes[0]",  "/Off")
-    s("P4Line7[0]",     "/N"); s("P4Line7[1]",       "/Off")
-    s("P4Line8[1]",     "/Y"); s("P4Line8[0]",       "/Off")
-    s("P4Line8a_No[0]", "/Y"); s("P4Line8a_Yes[0]",  "/Off")
-    s("P4Line8b_No[0]", "/Y"); s("P4Line8b_Yes[0]",  "/Off")
-    s("P4Line9_No[0]",  "/Y"); s("P4Line9_Yes[0]",   "/Off")
-    s("P4Line10_No[0]", "/Y"); s("P4Line10_Yes[0]",  "/Off")
-    s("P4Line11a_No[0]","/Y"); s("P4Line11a_Yes[0]", "/Off")
+    Const("P4Line2_Checkbox[1]", "/Y"),   # valid passport: yes
+    Const("P4Line2_Checkbox[0]", "/Off"),
+    *(c for line in ("3", "4", "5", "6", "8a", "8b", "9", "10", "11a")
+      for c in (Const(f"P4Line{line}_No[0]", "/Y"), Const(f"P4Line{line}_Yes[0]", "/Off"))),
+    Const("P4Line7[0]", "/N"), Const("P4Line7[1]", "/Off"),
+    Const("P4Line8[1]", "/N"), Const("P4Line8[0]", "/Off"),
 
     # ══ PAGE 5 — PART 5: EMPLOYMENT ══════════════════════════════
-    s("Part5_Q1_JobTitle[0]",  f.get("jobTitle"))
-    s("Part5_Q2_LCAorETA[0]", f.get("lcaNumber"))
-
-    s("P5Line3a_StreetNumberName[0]", f.get("workStreet") or f.get("petStreet"))
-    s("P5Line3a_AptSteFlrNumber[0]",  f.get("workApt")    or f.get("petApt"))
-    s("P5Line3a_CityTown[0]",         f.get("workCity")   or f.get("petCity"))
-    s("P5Line3a_State[0]",            f.get("workState")  or f.get("petState"))
-    s("P5Line3a_ZipCode[0]",          f.get("workZip")    or f.get("petZip"))
-
-    third = f.get("isThirdParty") == "yes"
-    s("P5Line3[1]", "/1"   if third else "/Off")
-    s("P5Line3[0]", "/Off" if third else "/0")
-    if third:
-        s("P5Line3a_ThirdpartyOrganization[0]", f.get("thirdPartyName"))
-
-    itin = f.get("hasItinerary") == "yes"
-    s("P5Line4_Yes[0]", "/Y"   if itin else "/Off")
-    s("P5Line4_No[0]",  "/Off" if itin else "/Y")
-
-    offsite = f.get("isOffsite") == "yes"
-    s("P5Line5_Yes[0]", "/Y"   if offsite else "/Off")
-    s("P5Line5_No[0]",  "/Off" if offsite else "/Y")
-
-    cnmi = f.get("isCNMI") == "yes"
-    s("P5Line6_Yes[0]", "/Y"   if cnmi else "/Off")
-    s("P5Line6_No[0]",  "/Off" if cnmi else "/Y")
-
-    fulltime = f.get("isFullTime") == "yes"
-    s("P5Line7_Yes[0]", "/Y"   if fulltime else "/Off")
-    s("P5Line7_No[0]",  "/Off" if fulltime else "/Y")
-    if not fulltime:
-        s("P5Line9_Hours[0]", f.get("hoursPerWeek"))
-
-    s("Line8_Wages[0]",        f.get("wages"))
-    s("Line8_Per[0]",          f.get("wagesPer") or "year")
-    s("Line10_Explanation[0]", f.get("otherComp"))
-    s("Part5_Q10_DateFrom[0]", f.get("startDate"))
-    s("Part5_Q10_DateTo[0]",   f.get("endDate"))
+    Text("Part5_Q1_JobTitle[0]", "jobTitle"),
+    Text("Part5_Q2_LCAorETA[0]", "lcaNumber"),
+
+    Text("P5Line3a_StreetNumberName[0]", "workStreet", "petStreet"),
+    Text("P5Line3a_AptSteFlrNumber[0]",  "workApt",    "petApt"),
+    When("workApt", "", Choice("petAptType", unit_boxes("P5Line3a_Unit", "apt", "flr", "ste"))),
+    Unless("workApt", "", Choice("workAptType", unit_boxes("P5Line3a_Unit", "apt", "flr", "ste"))),
+    Text("P5Line3a_CityTown[0]",         "workCity",   "petCity"),
+    Text("P5Line3a_State[0]",            "workState",  "petState"),
+    Text("P5Line3a_ZipCode[0]",          "workZip",    "petZip"),
+
+    Flag("isThirdParty", "P5Line3[1]", "P5Line3[0]", yes="/1", no="/0"),
+    When("isThirdParty", "yes",
+         Text("P5Line3a_ThirdpartyOrganization[0]", "thirdPartyName")),
+    Flag("hasItinerary", "P5Line4_Yes[0]", "P5Line4_No[0]"),
+    Flag("isOffsite",    "P5Line5_Yes[0]", "P5Line5_No[0]"),
+    Flag("isCNMI",       "P5Line6_Yes[0]", "P5Line6_No[0]"),
+    Flag("isFullTime",   "P5Line7_Yes[0]", "P5Line7_No[0]"),
+    Unless("isFullTime", "yes",
+           Text("P5Line9_Hours[0]", "hoursPerWeek")),
+
+    Text("Line8_Wages[0]",        "wages"),
+    Text("Line8_Per[0]",          "wagesPer", default="year"),
+    Text("Line10_Explanation[0]", "otherComp"),
+    Text("Part5_Q10_DateFrom[0]", "startDate"),
+    Text("Part5_Q10_DateTo[0]",   "endDate"),
 
     # ══ PAGE 6 — PART 5: EMPLOYER + PART 6 + PART 7 NAME ════════
-    s("Part5Line12_TypeofBusiness[0]", f.get("businessType"))
-    s("P5Line13_YearEstablished[0]",   f.get("yearEstablished"))
-    s("P5Line14_NumberofEmployees[0]", f.get("numEmployees"))
-    s("Line15_GrossAnnualIncome[0]",   f.get("grossIncome"))
-    s("Line16_NetAnnualIncome[0]",     f.get("netIncome"))
-
-    few = f.get("has25orFewer") == "yes"
-    s("P5Line15_CB[0]", "/Y"   if few else "/Off")
-    s("P5Line15_CB[1]", "/Off" if few else "/Y")
+    Text("Part5Line12_TypeofBusiness[0]", "businessType"),
+    Text("P5Line13_YearEstablished[0]",   "yearEstablished"),
+    Text("P5Line14_NumberofEmployees[0]", "numEmployees"),
+    Text("Line15_GrossAnnualIncome[0]",   "grossIncome"),
+    Text("Line16_NetAnnualIncome[0]",     "netIncome"),
 
-    export_lic = f.get("exportControl") == "license_req"
-    s("NoDeemed[0]", "/Off" if export_lic else "/1")
-    s("Deemed[0]",   "/1"   if export_lic else "/Off")
+    Flag("has25orFewer", "P5Line15_CB[0]", "P5Line15_CB[1]", no="/N"),
+    Flag("exportControl", "Deemed[0]", "NoDeemed[0]", yes="/1", no="/1", when="license_req"),
 
     # Signatory name repeated on page 6
-    s("Line1a_PetitionerLastName[0]",  f.get("sigLastName") or f.get("petLastName") or f.get("companyName"))
-    s("Line1a_PetitionerLastName[1]",  f.get("sigTitle"))
-    s("Line1b_PetitionerFirstName[0]", f.get("sigFirstName") or f.get("petFirstName"))
+    Text("Line1a_PetitionerLastName[0]",  "sigLastName", "petLastName", "companyName"),
+    Text("Line1a_PetitionerLastName[1]",  "sigTitle"),
+    Text("Line1b_PetitionerFirstName[0]", "sigFirstName", "petFirstName"),
 
     # ══ PAGE 7 — PART 7: SIGNATURE BLOCK ════════════════════════
-    s("Pt7Line3_DaytimePhoneNumber1[0]", f.get("sigPhone") or f.get("petPhone"))
-    s("Pt7Line3_EmailAddress[0]",        f.get("sigEmail") or f.get("petEmail"))
+    Text("Pt7Line3_DaytimePhoneNumber1[0]", "sigPhone", "petPhone"),
+    Text("Pt7Line3_EmailAddress[0]",        "sigEmail", "petEmail"),
 
     # ══ PAGES 13-14 — H CLASSIFICATION SUPPLEMENT ═══════════════
-    pet_name = f.get("companyName") or f"{f.get('petFirstName','')} {f.get('petLastName','')}".strip()
-    ben_name  = f"{f.get('benFirstName','')} {f.get('benLastName','')}".strip()
-    s("Line1_PetitionerName[0]", pet_name)
-    s("Line2_BeneficiaryName[0]", ben_name)
-    s("Line2_TtlNumberofBeneficiaries[0]", f.get("totalWorkers","1"))
+    Text("Line1_PetitionerName[0]", *PET_NAME),
+    Text("Line2_BeneficiaryName[0]", *BEN_NAME),
+    Text("Line2_TtlNumberofBeneficiaries[0]", Get("totalWorkers", "1")),
 
     # H classification checkbox on supplement
-    cls_map = {
-        "H-1B Specialty Occupation": 0,
-        "H-1B1 Chile/Singapore": 1,
-        "H-2A Agricultural Worker": 4,
-        "H-2B Non-agricultural Worker": 7,
-        "H-3 Trainee": 5,
-    }
-    cls_idx = cls_map.get(f.get("classification",""), -1)
-    for i in range(8):
-        s(f"SubHLine4_class[{i}]", "/Y" if i == cls_idx else "/Off")
+    Choice("classification", {cls: H_CLS_BOXES[i] for cls, i in CLS_MAP.items()},
+           unused=[box for i, (box, _) in enumerate(H_CLS_BOXES) if i not in CLS_MAP.values()]),
 
     # Prior H/L stays (up to 6)
-    for n in range(1, 7):
-        s(f"Name_Line{n}[0]",     f.get(f"hPriorStay{n}Class"))
-        s(f"DateFrom_Line{n}[0]", f.get(f"hPriorStay{n}From"))
-        s(f"DateTo_Line{n}[0]",   f.get(f"hPriorStay{n}To"))
+    *(t for n in range(1, 7) for t in (Text(f"Name_Line{n}[0]",     f"hPriorStay{n}Class"),
+                                       Text(f"DateFrom_Line{n}[0]", f"hPriorStay{n}From"),
+                                       Text(f"DateTo_Line{n}[0]",   f"hPriorStay{n}To"))),
 
     # Duties and work experience (page 14)
-    s("Line1_Duties[0]",                f.get("hDuties"))
-    s("Line2_SummaryofWorkExperience[0]",f.get("hWorkExperience"))
+    Text("Line1_Duties[0]",                   "hDuties"),
+    Text("Line2_SummaryofWorkExperience[0]",  "hWorkExperience"),
 
     # H supplement yes/no questions
-    guam = f.get("hSubjectToGuam") == "yes"
-    s("SupHLine5_Yes[1]", "/Y"   if guam else "/Off")
-    s("SupHLine5_No[1]",  "/Off" if guam else "/Y")
-
-    coe = f.get("hChangeOfEmployer") == "yes"
-    s("SupHLine5_Yes[0]", "/Y"   if coe else "/Off")
-    s("SupHLine5_No[0]",  "/Off" if coe else "/Y")
-
-    ctrl = f.get("hBenControllingInterest") == "yes"
-    s("Line8a_Check[0]", "/Y"   if ctrl else "/Off")
-    s("Line8a_Check[1]", "/Off" if ctrl else "/Y")
-    if ctrl:
-        s("Line8b_Explain[0]", f.get("hBenControllingExplain"))
+    Flag("hSubjectToGuam",    "SupHLine5_Yes[1]", "SupHLine5_No[1]"),
+    Flag("hChangeOfEmployer", "SupHLine5_Yes[0]", "SupHLine5_No[0]"),
+    Flag("hBenControllingInterest", "Line8a_Check[1]", "Line8a_Check[0]", no="/N"),
+    When("hBenControllingInterest", "yes",
+         Text("Line8b_Explain[0]", "hBenControllingExplain")),
 
     # Petitioner printed name on supplement signature block
-    s("Sect1_PetitionerPrintedName[0]", pet_name)
+    Text("Sect1_PetitionerPrintedName[0]", *PET_NAME),
 
     # ══ PAGES 21-23 — H-1B DATA COLLECTION SUPPLEMENT ═══════════
-    s("Line1_FamilyName[3]", pet_name)
-    s("Line1_FamilyName[2]", ben_name)
-
-    # 1a H-1B dependent employer
-    dep = f.get("h1bDependentEmployer") == "yes"
-    s("H1BSecALine1a_Yes[0]", "/Y"   if dep else "/Off")
-    s("H1BSecALine1a_No[0]",  "/Off" if dep else "/Y")
-
-    # 1b willful violator
-    wv = f.get("h1bWillfulViolator") == "yes"
-    s("H1BSecALine1b_Yes[0]", "/Y"   if wv else "/Off")
-    s("H1BSecALine1b_No[0]",  "/Off" if wv else "/Y")
+    Text("Line1_FamilyName[3]", *PET_NAME),
+    Text("Line1_FamilyName[2]", *BEN_NAME),
 
-    # 1c exempt from DOL attestation
-    exempt = f.get("h1bExemptDOL") == "yes"
-    s("H1BSecALine1c_Yes[0]", "/Y"   if exempt else "/Off")
-    s("H1BSecALine1c_No[0]",  "/Off" if exempt else "/Y")
-
-    # 1d 50 or more employees
-    fifty = f.get("h1b50orMore") == "yes"
-    s("H1BSecALine1d_Yes[0]", "/Y"   if fifty else "/Off")
-    s("H1BSecALine1d_No[0]",  "/Off" if fifty else "/Y")
+    Flag("h1bDependentEmployer", "H1BSecALine1a_Yes[0]", "H1BSecALine1a_No[0]", no="/N"),  # 1a H-1B dependent employer
+    Flag("h1bWillfulViolator",   "H1BSecALine1b_Yes[0]", "H1BSecALine1b_No[0]", no="/N"),  # 1b willful violator
+    Flag("h1bExemptDOL",         "H1BSecALine1c_Yes[0]", "H1BSecALine1c_No[0]", no="/N"),  # 1c exempt from DOL attestation
+    Flag("h1b50orMore",          "H1BSecALine1d_Yes[0]", "H1BSecALine1d_No[0]", no="/N"),  # 1d 50 or more employees
 
     # 1d.1 more than 50% H-1B/L workers
-    if fifty:
-        pct = f.get("h1bMoreThan50pct") == "yes"
-        s("H1BSecALine1d1_Yes[0]", "/Y"   if pct else "/Off")
-        s("H1BSecALine1d1_No[0]",  "/Off" if pct else "/Y")
-
-    # 1c.2 exempt from fee (for dependent employers)
-    # 1c.1 not used for cap
-    if dep:
-        c2 = f.get("h1bExemptDOL") == "yes"
-        s("H1BSecALine1c1_Yes[0]", "/Y"   if c2 else "/Off")
-        s("H1BSecALine1c1_No[0]",  "/Off" if c2 else "/Y")
-        s("H1BSecALine1c2_Yes[0]", "/Y"   if c2 else "/Off")
-        s("H1BSecALine1c2_No[0]",  "/Off" if c2 else "/Y")
+    When("h1b50orMore", "yes",
+         Flag("h1bMoreThan50pct", "H1BSecALine1d1_Yes[0]", "H1BSecALine1d1_No[0]")),
+
+    # 1c.1 and 1c.2 (for dependent employers) follow the DOL exemption
+    When("h1bDependentEmployer", "yes",
+         Flag("h1bExemptDOL", "H1BSecALine1c1_Yes[0]", "H1BSecALine1c1_No[0]"),
+         Flag("h1bExemptDOL", "H1BSecALine1c2_Yes[0]", "H1BSecALine1c2_No[0]")),
 
     # Highest education level
-    edu_map = {
-        "none": "a_no_diploma[0]",
-        "hs": "b_HSDiploma[0]",
-        "some_college": "c_some_college[0]",
-        "associates": "e_AssociateDegree[0]",
-        "bachelors": "f_BachelorDegree[0]",
-        "some_grad": "d_collegeplus[0]",
-        "masters": "g_MasterDegree[0]",
-        "professional": "h_ProfessionalDegree[0]",
-        "doctorate": "i_DoctorateDegree[0]",
-    }
-    edu_val = f.get("h1bEducation","")
-    for k, field_name in edu_map.items():
-        s(field_name, "/Y" if k == edu_val else "/Off")
+    Choice("h1bEducation", EDU_MAP),
 
     # Field of study, DOT, NAICS, rate of pay
-    s("PartA_q3_Field_of_Study[0]", f.get("h1bFieldOfStudy"))
-    s("Line5_DOTCode[0]",           f.get("h1bDOTCode"))
-    s("Line6_NAICSCode[0]",         f.get("h1bNAICSCode"))
-    s("Line4_RateofPayPerYear[0]",  f.get("h1bRateOfPay") or f.get("wages"))
+    Text("PartA_q3_Field_of_Study[0]", "h1bFieldOfStudy"),
+    Text("Line5_DOTCode[0]",           "h1bDOTCode"),
+    Text("Line6_NAICSCode[0]",         "h1bNAICSCode"),
+    Text("Line4_RateofPayPerYear[0]",  "h1bRateOfPay", "wages"),
 
     # Section 2 Fee exemption
-    fee = f.get("h1bFeeExempt") == "yes"
-    s("H1BSec2Line1_Yes[0]", "/Y"   if fee else "/Off")
-    s("H1BSec2Line1_No[0]",  "/Off" if fee else "/Y")
-
-    np2 = f.get("h1bNonprofit") == "yes"
-    s("H1BSec2Line2_Yes[0]", "/Y"   if np2 else "/Off")
-    s("H1BSec2Line2_No[0]",  "/Off" if np2 else "/Y")
+    Flag("h1bFeeExempt", "H1BSec2Line1_Yes[0]", "H1BSec2Line1_No[0]"),
+    Flag("h1bNonprofit", "H1BSec2Line2_Yes[0]", "H1BSec2Line2_No[0]"),
 
     # Default remaining fee exemption lines to No
-    for i in range(3, 10):
-        s(f"H1BSec2Line{i}_No[0]",  "/Y")
-        s(f"H1BSec2Line{i}_Yes[0]", "/Off")
+    *(c for i in range(3, 10)
+      for c in (Const(f"H1BSec2Line{i}_No[0]", "/Y"), Const(f"H1BSec2Line{i}_Yes[0]", "/Off"))),
 
     # Section 3 Cap determination
-    cap_e = f.get("h1bCapExempt") == "yes"
-    s("Cap[0]", "/Y"   if cap_e else "/Off")   # cap-exempt box 1
-    s("Cap[1]", "/Off" if cap_e else "/Off")
-    s("Cap[2]", "/Off")
-    s("Cap[3]", "/Off" if not f.get("h1bCongressionallyMandated") == "yes" else "/Y")
-
-    buf = io.BytesIO()
-    writer.write(buf)
-    buf.seek(0)
-    return buf
+    Flag("h1bCapExempt", "Cap[0]", yes="/A"),   # cap-exempt box 1
+    Const("Cap[1]", "/Off"),
+    Const("Cap[2]", "/Off"),
+    Flag("h1bCongressionallyMandated", "Cap[3]", yes="/D"),
+]
+PLAN = compile_plan(FIELD_SPEC)
+
+# ══ PAYLOAD SCHEMA ═══════════════════════════════════════════════
+# Checked and normalized before any PDF work (see payload_schema.py); lengths are the form's MaxLen where it has
+# one, and startup fails if a field could still cut a value off
+NAME, FREE_TEXT = Str(60), Str(1000, multiline=True)
+US_STATE = Code(r"[A-Z]{2}", "a two-letter state code", 2, strip=" .")
+ZIP = Code(r"\d{5}", "a 5-digit ZIP code", 5)
+PHONE = Code(r"\d{10,15}", "a phone number of 10 to 15 digits", 15, strip=" -().+")
+# Part 7 has room for a 10-digit daytime phone only, filled from sigPhone or else petPhone
+DAYTIME_PHONE = Code(r"\d{10}", "a 10-digit phone number", 10, strip=" -().+")
+NINE_DIGITS = Code(r"\d{9}", "9 digits", 9)
+DATE = Date()
+
+PAYLOAD_SCHEMA = {
+    "formEdition": Date(iso=True), "filingDate": Date(iso=True),
+    "petitionerType": Enum("company", "individual"),
+    ("companyName", "thirdPartyName"): Str(100),
+    ("petLastName", "petFirstName", "petMiddleName", "benLastName", "benFirstName", "benMiddleName",
+     "sigLastName", "sigFirstName", "sigTitle",
+     *(f"benOther{part}{n}" for n in range(1, 4) for part in ("Last", "First", "Middle"))): NAME,
+    ("petStreet", "benStreet", "workStreet", "petInCareOf"): Str(34), "benForeignStreet": Str(25),
+    **{key: Unit(key + "Type") for key in ("petApt", "benApt", "workApt", "benForeignApt")},
+    ("petAptType", "benAptType", "workAptType", "benForeignAptType"): Enum("apt", "ste", "flr"),
+    ("petCity", "benCity", "workCity", "benForeignCity"): Str(40),
+    ("petState", "benState", "workState"): US_STATE,
+    ("petZip", "benZip", "workZip"): ZIP,
+    ("petProvince", "benProvinceBirth", "benForeignProvince"): Str(20),
+    ("petPostalCode", "benForeignPostal"): Str(9),
+    ("petCountry", "benCountryBirth", "benCountryCitizenship", "benPassportCountry", "benForeignCountry",
+     "consultateCity", "consultateCountry"): Str(40),
+    "petMobile": PHONE, ("petPhone", "sigPhone"): DAYTIME_PHONE,
+    ("petEmail", "sigEmail"): Email(),
+    ("fein", "petIRS", "petSSN", "benSSN"): NINE_DIGITS,
+    "benANumber": Code(r"\d{9}", "9 digits (pad an 8-digit A-Number with a leading 0)", 9, strip=" -Aa"),
+    "classification": Enum(*CLS_SHORT), "basisForClassification": Enum(*BASIS_MAP),
+    "requestedAction": Enum(*ACTION_IDX), "totalWorkers": Integer(1, 9999999),
+    "priorReceiptNumber": Code(r"[A-Z]{3}\d{10}", "a receipt number (3 letters, 10 digits) or None", 13,
+                               literals=("None",)),
+    "benSex": Enum("male", "female"),
+    ("benDob", "benPassportIssued", "benPassportExpires", "benLastArrival", "startDate", "endDate",
+     *(f"hPriorStay{n}{end}" for n in range(1, 7) for end in ("From", "To"))): DATE,
+    "benStatusExpires": Date("D/S"),
+    "benPassportNumber": Str(30), "benCurrentStatus": Str(20),
+    "benI94": Code(r"\d{11}|\d{9}[A-Z]\d", "an 11-character I-94 number", 11),
+    "benSEVIS": Code(r"N\d{10}", "N followed by 10 digits", 11),
+    "benEAD": Code(r"[A-Z]{3}\d{10}", "3 letters and 10 digits", 13),
+    "officeType": Enum("consulate", "preflight", "port"),
+    ("jobTitle", "h1bFieldOfStudy", *(f"hPriorStay{n}Class" for n in range(1, 7))): Str(80),
+    "lcaNumber": Str(25), "businessType": Str(80),
+    ("isNonprofit", "isThirdParty", "hasItinerary", "isOffsite", "isCNMI", "isFullTime", "has25orFewer",
+     "hSubjectToGuam", "hChangeOfEmployer", "hBenControllingInterest", "h1bDependentEmployer",
+     "h1bWillfulViolator", "h1bExemptDOL", "h1b50orMore", "h1bMoreThan50pct", "h1bFeeExempt", "h1bNonprofit",
+     "h1bCapExempt", "h1bCongressionallyMandated"): YesNo(),
+    "hoursPerWeek": Integer(1, 168),
+    ("wages", "grossIncome", "netIncome", "h1bRateOfPay"): Amount(15),
+    "wagesPer": Enum("hour", "week", "month", "year"),
+    ("otherComp", "hDuties", "hWorkExperience", "hBenControllingExplain"): FREE_TEXT,
+    "yearEstablished": Integer(1600, 2200), "numEmployees": Integer(0, 9999999999),
+    "exportControl": Enum("license_req", "no_license"),
+    "h1bEducation": Enum(*EDU_MAP),
+    "h1bDOTCode": Code(r"\d{3}", "a 3-digit DOT code", 3), "h1bNAICSCode": Code(r"\d{2,6}", "a 2- to 6-digit NAICS code", 6),
+}
+SCHEMA = compile_schema(PAYLOAD_SCHEMA)
+if PLAN.keys - SCHEMA.normalizers.keys():
+    raise ValueError(f"Mapped keys missing from PAYLOAD_SCHEMA: {sorted(PLAN.keys - SCHEMA.normalizers.keys())}")
+
+
+def invalid_payload(e):
+    """The 422 response for a ``PayloadError``."""
+    return jsonify(error="Invalid payload", errors=e.errors), 422
+
+# One layout per edition whose fields or pages differ; later editions reuse the newest older one
+LAYOUTS = {DEFAULT_EDITION: Layout(PLAN, CORE_PAGES, SUPPLEMENT_PAGES, ATTACHMENT_PAGES)}
+# Editions are loaded on first use; TEMPLATE_CACHE_MB bounds the parsed templates kept per worker
+TEMPLATES = TemplateRegistry(os.environ.get("TEMPLATE_DIR") or _HERE, LAYOUTS, DEFAULT_EDITION,
+                             max_bytes=int(float(os.environ.get("TEMPLATE_CACHE_MB", "512")) * (1 << 20)))
+
+# Parse today's edition once at startup instead of on the first request
+if TEMPLATES.editions:
+    _edition = TEMPLATES.pick({})
+    TEMPLATES.template(_edition)
+    # A value the schema accepts must never be cut off by a field's MaxLen
+    _overflows = SCHEMA.overflows(_edition.layout.plan.text_sources(), TEMPLATES.manifest(_edition)["fields"])
+    if _overflows:
+        raise ValueError(f"PAYLOAD_SCHEMA allows values too long for edition {_edition.name}: {'; '.join(_overflows)}")
+
+
+def map_fields(data, fields, layout=LAYOUTS[DEFAULT_EDITION]):
+    """Translate a questionnaire payload into ``fields.set(name, value)`` calls, constants included."""
+    layout.plan.apply(data, fields, constants=True)
 
 
 def send_email(data, pdf_bytes):
-    if not all([SMTP_HOST, SMTP_USER, SMTP_PASS, NOTIFY_EMAIL]): return
-    try:
-        import email.mime.multipart, email.mime.text, email.mime.application
-        msg = email.mime.multipart.MIMEMultipart()
-        msg["From"] = SMTP_USER; msg["To"] = NOTIFY_EMAIL
-        ben = f"{data.get('benFirstName','')} {data.get('benLastName','')}".strip()
-        msg["Subject"] = f"I-129 Submission – {ben} | {data.get('classification','')}"
-        pet = data.get("companyName","") or f"{data.get('petFirstName','')} {data.get('petLastName','')}".strip()
-        msg.attach(email.mime.text.MIMEText(f"New I-129\nPetitioner: {pet}\nBeneficiary: {ben}\nClassification: {data.get('classification','')}\nJob: {data.get('jobTitle','')}\nDates: {data.get('startDate','')} to {data.get('endDate','')}\n"))
-        att = email.mime.application.MIMEApplication(pdf_bytes, _subtype="pdf")
-        att.add_header("Content-Disposition","attachment",filename=f"I-129_{ben.replace(' ','_')}.pdf")
-        msg.attach(att)
-        with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as srv:
-            srv.starttls(); srv.login(SMTP_USER, SMTP_PASS); srv.send_message(msg)
-    except Exception as e:
-        app.logger.warning(f"Email failed: {e}")
+    # Queued; delivered by the mailer's worker threads over a reused connection
+    return MAILER.submit(data, pdf_bytes)
+
 
+ASSETS = StaticAssets(os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"))
 
 @app.route("/")
-def index(): return app.send_static_file("index.html")
+def index(): return ASSETS.response("index.html", request)
+
+def static_asset(name): return ASSETS.response(name, request)
+
+# One rule per asset URL rather than a catch-all, so other paths keep their 404s and 405s
+for _url in ASSETS.urls():
+    app.add_url_rule("/" + _url, "static_asset", static_asset, defaults={"name": _url})
 
 @app.route("/health")
 def health():
     return jsonify(status="ok",pdf_exists=os.path.exists(PDF_PATH),
-                   pdf_size_mb=round(os.path.getsize(PDF_PATH)/1024/1024,1) if os.path.exists(PDF_PATH) else 0)
+                   pdf_size_mb=round(os.path.getsize(PDF_PATH)/1024/1024,1) if os.path.exists(PDF_PATH) else 0,
+                   templates=TEMPLATES.stats(), mail=MAILER.stats(), result_cache=RESULTS.stats(),
+                   jobs=JOBS.stats(), static=ASSETS.stats())
+
+SAMPLE = {"petitionerType":"company","companyName":"Acme Technology Corp","fein":"12-3456789",
+    "petStreet":"100 Corporate Drive","petApt":"Suite 400","petCity":"Dallas","petState":"TX",
+    "petZip":"75201","petCountry":"United States","petPhone":"2145551234","petEmail":"hr@acme.com",
+    "isNonprofit":"no","classification":"H-1B Specialty Occupation","basisForClassification":"new",
+    "totalWorkers":"1","priorReceiptNumber":"None","requestedAction":"notify",
+    "benLastName":"Sharma","benFirstName":"Rahul","benMiddleName":"K",
+    "benDob":"1990-05-15","benSex":"male","benCountryBirth":"India","benProvinceBirth":"Maharashtra",
+    "benCountryCitizenship":"India","benSSN":"","benANumber":"",
+    "benStreet":"500 University Ave","benApt":"Apt 2B","benCity":"Dallas","benState":"TX","benZip":"75202",
+    "benPassportNumber":"J1234567","benPassportCountry":"India",
+    "benPassportIssued":"2020-01-10","benPassportExpires":"2030-01-09",
+    "benI94":"12345678901","benLastArrival":"2022-08-20",
+    "benCurrentStatus":"F-1","benStatusExpires":"2025-05-15","benSEVIS":"N0012345678","benEAD":"",
+    "officeType":"consulate","consultateCity":"Mumbai","consultateCountry":"India",
+    "jobTitle":"Software Engineer","lcaNumber":"I-200-24001-123456",
+    "workStreet":"","workCity":"","workState":"","workZip":"",
+    "isThirdParty":"no","hasItinerary":"no","isOffsite":"no","isCNMI":"no",
+    "isFullTime":"yes","wages":"120000","wagesPer":"year","startDate":"2025-10-01","endDate":"2028-09-30",
+    "businessType":"Information Technology","yearEstablished":"2005","numEmployees":"500",
+    "grossIncome":"50000000","netIncome":"8000000","has25orFewer":"no","exportControl":"no_license",
+    "sigLastName":"Johnson","sigFirstName":"Sarah","sigTitle":"HR Director",
+    "sigPhone":"2145551234","sigEmail":"hr@acme.com"}
+
+def probe_payloads():
+    """Payloads that drive map_fields down every branch (see `field_manifest.py check`)."""
+    yes = {k: "yes" for k in PLAN.keys}
+    yield from (SAMPLE, {}, yes, {**yes, "petitionerType": "company"})
+    enums = {"classification": CLS_SHORT, "basisForClassification": BASIS_MAP, "requestedAction": ACTION_IDX,
+             "h1bEducation": EDU_MAP, "officeType": ("consulate","preflight","port"),
+             "benSex": ("male","female"), "exportControl": ("license_req","no_license")}
+    for k, values in enums.items():
+        for v in values:
+            yield {**yes, k: v}
+
+@app.route("/metrics")
+def prometheus_metrics():
+    """Prometheus text exposition, summed over every worker process."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 @app.route("/test")
 def test():
-    sample = {"petitionerType":"company","companyName":"Acme Technology Corp","fein":"12-3456789",
-      "petStreet":"100 Corporate Drive","petApt":"Suite 400","petCity":"Dallas","petState":"TX",
-      "petZip":"75201","petCountry":"United States","petPhone":"2145551234","petEmail":"hr@acme.com",
-      "isNonprofit":"no","classification":"H-1B Specialty Occupation","basisForClassification":"new",
-      "totalWorkers":"1","priorReceiptNumber":"None","requestedAction":"notify",
-      "benLastName":"Sharma","benFirstName":"Rahul","benMiddleName":"K",
-      "benDob":"1990-05-15","benSex":"male","benCountryBirth":"India","benProvinceBirth":"Maharashtra",
-      "benCountryCitizenship":"India","benSSN":"","benANumber":"",
-      "benStreet":"500 University Ave","benApt":"Apt 2B","benCity":"Dallas","benState":"TX","benZip":"75202",
-      "benPassportNumber":"J1234567","benPassportCountry":"India",
-      "benPassportIssued":"2020-01-10","benPassportExpires":"2030-01-09",
-      "benI94":"12345678901","benLastArrival":"2022-08-20",
-      "benCurrentStatus":"F-1","benStatusExpires":"2025-05-15","benSEVIS":"N0012345678","benEAD":"",
-      "officeType":"consulate","consultateCity":"Mumbai","consultateCountry":"India",
-      "jobTitle":"Software Engineer","lcaNumber":"I-200-24001-123456",
-      "workStreet":"","workCity":"","workState":"","workZip":"",
-      "isThirdParty":"no","hasItinerary":"no","isOffsite":"no","isCNMI":"no",
-      "isFullTime":"yes","wages":"120000","wagesPer":"year","startDate":"2025-10-01","endDate":"2028-09-30",
-      "businessType":"Information Technology","yearEstablished":"2005","numEmployees":"500",
-      "grossIncome":"50000000","netIncome":"8000000","has25orFewer":"no","exportControl":"no_license",
-      "sigLastName":"Johnson","sigFirstName":"Sarah","sigTitle":"HR Director",
-      "sigPhone":"2145551234","sigEmail":"hr@acme.com"}
-    buf = fill_i129(sample, PDF_PATH)
+    mode = request.args.get("mode")
+    if mode and mode not in OUTPUT_MODES: return jsonify(error=f"mode must be one of {', '.join(OUTPUT_MODES)}"), 400
+    data = {**SAMPLE, "formEdition": request.args["edition"]} if request.args.get("edition") else SAMPLE
+    try:
+        with g.timings.phase("validate"):
+            data = SCHEMA.validate(data)
+        buf = fill_i129(data, None, mode, g.timings)
+    except PayloadError as e:
+        return invalid_payload(e)
+    except UnknownEdition as e:
+        return jsonify(error=str(e)), 400
     return send_file(buf,mimetype="application/pdf",as_attachment=True,download_name="test_i129.pdf")
 
+def download_name(data):
+    ben = f"{data.get('benFirstName','')}_{data.get('benLastName','')}".strip("_") or "form"
+    return f"I-129_{ben}.pdf"
+
+def _fill_bytes(data, mode=None):
+    return fill_i129(data, None, mode).getvalue()
+
+BATCH = BatchRunner(_fill_bytes, processes=int(os.environ.get("BATCH_PROCESSES", min(2, os.cpu_count() or 1))))
+
 @app.route("/fill", methods=["POST"])
 def fill():
     try:
         data = request.get_json(force=True, silent=True)
         if not data: return jsonify(error="No JSON data received"), 400
-        buf = fill_i129(data, PDF_PATH)
-        pdf_bytes = buf.getvalue()
-        send_email(data, pdf_bytes)
-        ben = f"{data.get('benFirstName','')}_{data.get('benLastName','')}".strip("_") or "form"
-        return send_file(io.BytesIO(pdf_bytes),mimetype="application/pdf",as_attachment=True,download_name=f"I-129_{ben}.pdf")
+        mode = request.args.get("mode")
+        if mode and mode not in OUTPUT_MODES: return jsonify(error=f"mode must be one of {', '.join(OUTPUT_MODES)}"), 400
+        with g.timings.phase("validate"):
+            data = SCHEMA.validate(data)
+        with g.timings.phase("cache"):
+            key = result_key(data, None, mode)
+            not_modified = key in request.if_none_match
+            pdf = RESULTS.get(key)
+        hit = pdf is not None
+        metrics.RESULT_CACHE.inc("hit" if hit else "miss")
+        # A 304 needs no body, but the notification e-mail still needs the PDF
+        if not hit and (not not_modified or MAILER.configured):
+            # One buffer serves the cache, the e-mail and the response
+            pdf = fill_i129(data, None, mode, g.timings, out=PdfSpool(SPOOL_BYTES))
+            with g.timings.phase("cache"):
+                RESULTS.put(key, pdf)
+        if pdf is not None:
+            with g.timings.phase("email"):
+                send_email(data, pdf)
+        if not_modified:
+            r = app.response_class(status=304)
+        else:
+            body = io.BytesIO(pdf) if hit else pdf.open()
+            r = send_file(body,mimetype="application/pdf",as_attachment=True,download_name=download_name(data))
+            r.content_length = len(pdf)
+        r.set_etag(key)
+        r.headers["X-Cache"] = "hit" if hit else "miss"
+        return r
+    except PayloadError as e:
+        return invalid_payload(e)
+    except UnknownEdition as e:
+        return jsonify(error=str(e)), 400
     except Exception as e:
         app.logger.error(traceback.format_exc())
         return jsonify(error=str(e)), 500
 
+@app.route("/preview", methods=["POST"])
+def preview():
+    """The values ``/fill`` would write, per 1-based page, without touching the PDF."""
+    data = request.get_json(force=True, silent=True)
+    if not data or not isinstance(data, dict): return jsonify(error="No JSON data received"), 400
+    try:
+        with g.timings.phase("validate"):
+            data = SCHEMA.validate(data)
+        edition = TEMPLATES.pick(data)
+    except PayloadError as e:
+        return invalid_payload(e)
+    except UnknownEdition as e:
+        return jsonify(error=str(e)), 400
+    with g.timings.phase("map_fields"):
+        fields = resolve_fields(data, TEMPLATES.manifest(edition), edition.layout, constants=True)
+    pages = fields.by_page()
+    return jsonify(edition=edition.name, classification=CLS_SHORT.get(data.get("classification", "")),
+                   count=len(fields), pages=[{"page": p + 1, "fields": pages[p]} for p in sorted(pages)],
+                   compact_pages=[p + 1 for p in compact_pages(data, edition.layout) or ()] or None)
+
+def _job_done(job_id, data):
+    with open(JOBS.store.pdf_path(job_id), "rb") as fh:
+        send_email(data, fh.read())
+
+# JOBS_DIR is shared by all workers; JOB_PROCESSES is per worker, JOB_QUEUE_SIZE is server-wide
+JOBS = JobQueue(_fill_bytes, JobStore(os.environ.get("JOBS_DIR") or os.path.join(_HERE, "jobs"),
+                                      ttl=float(os.environ.get("JOB_TTL", "3600"))),
+                processes=int(os.environ.get("JOB_PROCESSES", "2")),
+                capacity=int(os.environ.get("JOB_QUEUE_SIZE", "20")), on_done=_job_done)
+
+@app.route("/jobs", methods=["POST"])
+def create_job():
+    """Queue a fill; poll the returned URL for the PDF."""
+    data = request.get_json(force=True, silent=True)
+    if not data or not isinstance(data, dict): return jsonify(error="No JSON data received"), 400
+    mode = request.args.get("mode")
+    if mode and mode not in OUTPUT_MODES: return jsonify(error=f"mode must be one of {', '.join(OUTPUT_MODES)}"), 400
+    try:
+        with g.timings.phase("validate"):
+            data = SCHEMA.validate(data)
+        TEMPLATES.pick(data)
+        job_id = JOBS.submit(data, mode or OUTPUT_MODE, download_name(data))
+    except PayloadError as e:
+        return invalid_payload(e)
+    except UnknownEdition as e:
+        return jsonify(error=str(e)), 400
+    except QueueFull as e:
+        return jsonify(error=f"Too many pending jobs ({e}); retry later"), 429, {"Retry-After": "10"}
+    url = f"/jobs/{job_id}"
+    return jsonify(id=job_id, status="queued", url=url), 202, {"Location": url}
+
+@app.route("/jobs/<job_id>")
+def get_job(job_id):
+    """The PDF once the job is done; otherwise (or with ?format=json) its status."""
+    JOBS.maybe_sweep()
+    job = JOBS.store.get(job_id)
+    if job is None: return jsonify(error="Unknown or expired job"), 404
+    if job["status"] == "done" and request.args.get("format") != "json":
+        return send_file(JOBS.store.pdf_path(job_id), mimetype="application/pdf", as_attachment=True,
+                         download_name=job["filename"])
+    del job["owner"]
+    if job["status"] in ("queued", "running"):
+        return jsonify(job), 202, {"Retry-After": "2"}
+    return jsonify(job), 500 if job["status"] == "failed" else 200
+
+@app.route("/fill/batch", methods=["POST"])
+def fill_batch():
+    """Fill a JSON array or NDJSON stream of payloads; streams back a ZIP with a manifest.json."""
+    try:
+        items = parse_items(request.stream, request.content_type)
+        first = next(items, None)
+        if first is None: return jsonify(error="No payloads received"), 400
+    except ValueError as e:
+        return jsonify(error=str(e)), 400
+    def all_items():
+        # Each payload is checked as it is read; a bad one becomes that item's error in the manifest
+        for item in itertools.chain((first,), items):
+            try:
+                yield item if isinstance(item, Exception) else SCHEMA.validate(item)
+            except Exception as e:  # PayloadError, or a bug: either way only this item fails, never the ZIP
+                if not isinstance(e, PayloadError): app.logger.error(traceback.format_exc())
+                yield e
+    body = stream_zip(BATCH.run(all_items()), download_name, on_success=send_email)
+    return Response(stream_with_context(body), mimetype="application/zip",
+                    headers={"Content-Disposition": "attachment; filename=I-129_batch.zip"})
+
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
     app.run(host="0.0.0.0", port=port, debug=False)
@@ -0,0 +1,188 @@
+"""Parallel batch filling for ``/fill/batch``.
+
+Payloads are fanned out to a fork-based process pool, so every child starts
+with the parent's already-parsed template (see ``template_cache``).  At most
+``window`` payloads are in flight at once and finished PDFs are written into a
+streamed ZIP as soon as they complete, which keeps memory flat however large
+the batch is.
+"""
+import concurrent.futures as cf
+import codecs, json, logging, multiprocessing, os, re, threading, zipfile
+
+log = logging.getLogger(__name__)
+
+
+class BatchRunner:
+    def __init__(self, fn, processes=2, window=None):
+        self.fn = fn
+        self.processes = processes
+        self.window = window or processes * 2
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = cf.ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("fork"))
+                self._pid = os.getpid()
+            return self._pool
+
+    def _reset(self):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def run(self, items):
+        """Yield ``(index, payload, result, error)`` in completion order."""
+        pool = self._executor()
+        pending = {}
+        items = enumerate(items)
+        exhausted = False
+        while pending or not exhausted:
+            while not exhausted and len(pending) < self.window:
+                try:
+                    i, data = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                if isinstance(data, Exception):
+                    yield i, None, None, data
+                    continue
+                pending[pool.submit(self.fn, data)] = (i, data)
+            if not pending: continue
+            done, _ = cf.wait(pending, return_when=cf.FIRST_COMPLETED)
+            for fut in done:
+                i, data = pending.pop(fut)
+                try:
+                    yield i, data, fut.result(), None
+                except cf.process.BrokenProcessPool:
+                    self._reset()
+                    raise
+                except Exception as e:
+                    yield i, data, None, e
+
+
+def parse_items(stream, content_type):
+    """Payloads from a JSON array or NDJSON body; bad NDJSON lines become exceptions.
+
+    Both forms are read incrementally, so only the payloads in flight are held
+    in memory, never the whole body.
+    """
+    if "ndjson" in (content_type or "") or "jsonlines" in (content_type or ""):
+        for line in stream:
+            line = line.strip()
+            if not line: continue
+            try:
+                item = json.loads(line)
+                yield item if isinstance(item, dict) else ValueError("item is not a JSON object")
+            except ValueError as e:
+                yield e
+        return
+    for item in _json_array(stream):
+        yield item if isinstance(item, (dict, Exception)) else ValueError("item is not a JSON object")
+
+
+_WS = re.compile(r"[ \t\n\r]*")
+MAX_ITEM = 8 << 20  # a single payload is a few KB; anything near this is not a questionnaire
+
+
+def _json_array(stream, chunk=1 << 16):
+    # Element by element: raw_decode over a buffer that holds one chunk plus the item being read.  A syntax
+    # error before the first element raises (the request is rejected); after it, it ends the batch as an item.
+    decoder, utf8 = json.JSONDecoder(), codecs.getincrementaldecoder("utf-8")()
+    buf, pos, eof, n = "", 0, False, 0
+
+    def fill():
+        nonlocal buf, pos, eof
+        data = stream.read(chunk)
+        eof = not data
+        buf, pos = buf[pos:] + utf8.decode(data, final=eof), 0
+
+    def peek():
+        # The next non-blank character, or "" at the end of the body
+        nonlocal pos
+        while True:
+            pos = _WS.match(buf, pos).end()
+            if pos < len(buf) or eof: return buf[pos:pos + 1]
+            fill()
+
+    def fail(msg):
+        if not n: raise ValueError(msg)
+        return ValueError(f"{msg}; the items after it were not read")
+
+    if peek() != "[":
+        raise ValueError("Expected a JSON array of payloads (or NDJSON)")
+    pos += 1
+    if peek() == "]": return
+    while True:
+        try:
+            item, end = decoder.raw_decode(buf, pos)
+            # A number cut off by the end of the buffer ("1." of "1.5") may continue in the next chunk
+            complete = eof or (end < len(buf) and buf[end] in ",] \t\n\r")
+        except ValueError as e:
+            if eof:
+                yield fail(f"Invalid JSON in batch item #{n}: {getattr(e, 'msg', e)}"); return
+            complete = False
+        if not complete:
+            if len(buf) - pos > MAX_ITEM:
+                yield fail(f"Batch item #{n} is over {MAX_ITEM >> 20} MB or not valid JSON"); return
+            fill(); continue
+        pos = end
+        yield item
+        n += 1
+        c = peek()
+        if c == "]": return
+        if c != ",":
+            yield fail(f"Invalid JSON in batch: expected ',' or ']' after item #{n - 1}"); return
+        pos += 1
+        peek()
+
+
+class _Sink:
+    # Unseekable file-like that zipfile writes into; we drain it between entries
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, b):
+        self.chunks.append(bytes(b))
+        return len(b)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        out = b"".join(self.chunks)
+        self.chunks = []
+        return out
+
+
+def stream_zip(results, filename_for, on_success=None):
+    """Generate ZIP bytes from ``BatchRunner.run`` results, ending with manifest.json."""
+    sink = _Sink()
+    names = set()
+    manifest = []
+    with zipfile.ZipFile(sink, "w", compression=zipfile.ZIP_DEFLATED, compresslevel=1) as zf:
+        for i, data, pdf, err in results:
+            if err is not None:
+                log.warning(f"Batch item {i} failed: {err}")
+                entry = {"index": i, "status": "error", "error": str(err)}
+                if getattr(err, "errors", None): entry["errors"] = err.errors
+                manifest.append(entry)
+                continue
+            name = base = filename_for(data)
+            n = 1
+            while name in names:
+                n += 1
+                name = f"{base[:-4]}_{n}.pdf"
+            names.add(name)
+            zf.writestr(name, pdf)
+            manifest.append({"index": i, "status": "ok", "file": name, "bytes": len(pdf)})
+            if on_success: on_success(data, pdf)
+            yield sink.drain()
+        manifest.sort(key=lambda m: m["index"])
+        ok = sum(m["status"] == "ok" for m in manifest)
+        zf.writestr("manifest.json", json.dumps({"total": len(manifest), "ok": ok,
+                                                 "failed": len(manifest) - ok, "items": manifest}, indent=1))
+    yield sink.drain()
@@ -0,0 +1,357 @@
+"""Benchmarks for fill_i129 and a load driver for the HTTP endpoints.
+
+    python bench.py fill  [--iterations N] [--mode full|incremental|compact|flat]
+    python bench.py modes [--iterations N]    # every output mode side by side, with render times
+    python bench.py request                   # peak memory of one POST /fill per mode
+    python bench.py http  [--url URL | --workers N] [--concurrency N] [--requests N]
+    python bench.py all   ...
+
+``fill`` runs in-process over the ``/test`` sample and generated variants
+(every classification, with and without the H supplement and H-1B data
+collection answers).  It reports per-phase latency percentiles, output size,
+peak RSS and allocation figures.  ``modes`` also times rendering every page of
+the sample's output with PyMuPDF, when it is installed.  ``http`` starts gunicorn with a local SMTP
+stub (or targets ``--url``) and fires concurrent ``POST /fill`` requests.
+
+Every run can be saved with ``--out results.json``.  ``--baseline old.json``
+compares against an earlier run and exits 1 when any metric is more than
+``--threshold`` (default 20%) worse.
+"""
+import argparse, concurrent.futures as cf, gc, json, os, platform, resource, signal, socket
+import subprocess, sys, time, tracemalloc, urllib.error, urllib.request
+from smtp_stub import SMTPStub
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Questionnaire keys that only feed the H classification / H-1B data collection supplements
+H_SUPPLEMENT = {"hDuties": "Design and build distributed payment services.",
+                "hWorkExperience": "6 years of backend development in Python and Go.",
+                "hPriorStay1Class": "F-1", "hPriorStay1From": "2018-08-20", "hPriorStay1To": "2022-05-15",
+                "hPriorStay2Class": "OPT", "hPriorStay2From": "2022-05-16", "hPriorStay2To": "2025-05-15",
+                "hSubjectToGuam": "no", "hChangeOfEmployer": "yes",
+                "hBenControllingInterest": "yes", "hBenControllingExplain": "Holds 2% of common stock."}
+H1B_DATA = {"h1bDependentEmployer": "no", "h1bWillfulViolator": "no", "h1bExemptDOL": "yes",
+            "h1b50orMore": "yes", "h1bMoreThan50pct": "no", "h1bEducation": "masters",
+            "h1bFieldOfStudy": "Computer Science", "h1bDOTCode": "030", "h1bNAICSCode": "541511",
+            "h1bRateOfPay": "120000", "h1bFeeExempt": "no", "h1bNonprofit": "no",
+            "h1bCapExempt": "no", "h1bCongressionallyMandated": "no"}
+
+
+def variants():
+    """``name -> payload``: the /test sample, then every classification bare and with both supplements."""
+    import app
+    base = {k: v for k, v in app.SAMPLE.items() if not k.startswith("h")}
+    out = {"sample": app.SAMPLE,
+           "sample+hsup": {**base, **H_SUPPLEMENT},
+           "sample+h1b": {**base, **H1B_DATA}}
+    for cls, short in app.CLS_SHORT.items():
+        out[f"{short}/{cls}"] = {**base, "classification": cls}
+        out[f"{short}/{cls}+hsup+h1b"] = {**base, "classification": cls, **H_SUPPLEMENT, **H1B_DATA}
+    return out
+
+
+def percentiles(xs):
+    xs = sorted(xs)
+    if not xs: return {}
+    pick = lambda p: round(xs[min(len(xs) - 1, int(p * len(xs)))], 2)
+    return {"p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": round(xs[-1], 2),
+            "mean": round(sum(xs) / len(xs), 2), "n": len(xs)}
+
+
+def peak_rss_mb():
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(rss / (1 << 20 if sys.platform == "darwin" else 1 << 10), 1)
+
+
+# ══ IN-PROCESS ═══════════════════════════════════════════════════
+def fill_phases(data, mode):
+    """One validated ``fill_i129`` call, as ``/fill`` makes it; returns (phase timings in ms, output bytes)."""
+    import app
+    from metrics import Timings
+    timings = Timings()
+    t = time.perf_counter()
+    with timings.phase("validate"):
+        data = app.SCHEMA.validate(data)
+    pdf = app.fill_i129(data, app.PDF_PATH, mode, timings).getvalue()
+    return {**timings.ms, "total": (time.perf_counter() - t) * 1000}, pdf
+
+
+def bench_fill(iterations, mode, only=None):
+    import app
+    cache = app.TEMPLATES.template(app.TEMPLATES.by_path(app.PDF_PATH))
+    cache.template()  # usually already loaded when app was imported
+    load_ms = cache.stats()["load_ms"] + (cache.incremental().load_ms if mode == "incremental" else 0)
+
+    results = {}
+    for name, data in variants().items():
+        if only and only not in name: continue
+        fill_phases(data, mode)  # warm-up
+        phases, size = {}, 0
+        for _ in range(iterations):
+            ms, pdf = fill_phases(data, mode)
+            size = len(pdf)
+            for k, v in ms.items():
+                phases.setdefault(k, []).append(v)
+        # Allocations of one more fill, measured separately since tracemalloc slows everything down
+        gc.collect()
+        gen0 = gc.get_stats()[0]["collections"]
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        tracemalloc.reset_peak()
+        ms, pdf = fill_phases(data, mode)
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        retained = sum(d.count_diff for d in after.compare_to(before, "filename") if d.count_diff > 0)
+        del pdf
+        results[name] = {"phases_ms": {k: percentiles(v) for k, v in phases.items()}, "bytes": size,
+                         "alloc_peak_kb": round(peak / 1024), "alloc_blocks_retained": retained,
+                         "gc_gen0_collections": gc.get_stats()[0]["collections"] - gen0}
+        print(f"  {name:60} {results[name]['phases_ms']['total']['p50']:8.1f} ms  {size / 1024:8.0f} KiB", flush=True)
+    return {"mode": mode, "iterations": iterations, "template_load_ms": round(load_ms, 1),
+            "peak_rss_mb": peak_rss_mb(), "variants": results}
+
+
+def render_ms(pdf, iterations):
+    """Median time for PyMuPDF to open ``pdf`` and rasterize every page (forms included) at 72 dpi, or None."""
+    try:
+        import pymupdf
+    except ImportError:
+        return None
+    times = []
+    for _ in range(iterations):
+        t = time.perf_counter()
+        with pymupdf.open(stream=pdf, filetype="pdf") as doc:
+            for page in doc:
+                page.get_pixmap(dpi=72, annots=True)
+        times.append((time.perf_counter() - t) * 1000)
+    return percentiles(times)["p50"]
+
+
+def bench_modes(iterations, only=None):
+    """``bench_fill`` for every output mode, plus medians across variants and render times for comparison."""
+    import app
+    runs, summary = {}, {}
+    for mode in app.OUTPUT_MODES:
+        print(f" {mode}:")
+        runs[mode] = run = bench_fill(iterations, mode, only)
+        med = lambda xs: sorted(xs)[len(xs) // 2]
+        vs = run["variants"].values()
+        summary[mode] = {"write_ms_p50": med([v["phases_ms"]["write"]["p50"] for v in vs]),
+                         "total_ms_p50": med([v["phases_ms"]["total"]["p50"] for v in vs]),
+                         "bytes": med([v["bytes"] for v in vs]),
+                         "render_ms_p50": render_ms(fill_phases(app.SAMPLE, mode)[1], iterations)}
+    full = summary.get("full")
+    print(f"  {'mode':12} {'write ms':>10} {'total ms':>10} {'KiB':>8} {'render ms':>10}")
+    for mode, s in summary.items():
+        if full:
+            s["bytes_vs_full"] = round(s["bytes"] / full["bytes"], 3)
+            s["write_vs_full"] = round(s["write_ms_p50"] / full["write_ms_p50"], 3)
+            if s["render_ms_p50"] is not None:
+                s["render_vs_full"] = round(s["render_ms_p50"] / full["render_ms_p50"], 3)
+        render = "-" if s["render_ms_p50"] is None else f"{s['render_ms_p50']:.1f}"
+        print(f"  {mode:12} {s['write_ms_p50']:10.1f} {s['total_ms_p50']:10.1f} {s['bytes'] / 1024:8.0f} {render:>10}")
+    return {"summary": summary, "runs": runs}
+
+
+def bench_request(iterations=3):
+    """Peak traced memory of a whole ``POST /fill`` (cache miss, body fully read), per output mode."""
+    import app
+    client = app.app.test_client()
+    out = {}
+    for mode in app.OUTPUT_MODES:
+        peaks = []
+        for i in range(iterations + 1):
+            body = json.dumps({**app.SAMPLE, "_bench": f"{time.time()}-{i}"})
+            gc.collect()
+            tracemalloc.start()
+            r = client.post(f"/fill?mode={mode}", data=body, content_type="application/json")
+            n = sum(len(chunk) for chunk in r.response)
+            r.close()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            if i: peaks.append(peak / 1024)  # the first request warms caches
+        out[mode] = {"peak_kb": percentiles(peaks), "bytes": n}
+        print(f"  {mode:12} peak {out[mode]['peak_kb']['p50']:10.0f} KiB for a {n / 1024:.0f} KiB PDF", flush=True)
+    return out
+
+
+# ══ HTTP LOAD ════════════════════════════════════════════════════
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def _worker_rss_mb(master_pid):
+    # Peak RSS (VmHWM) of every gunicorn worker, from /proc; Linux only
+    out = {}
+    try:
+        pids = [p for p in os.listdir("/proc") if p.isdigit()]
+    except OSError:
+        return out
+    for p in pids:
+        try:
+            with open(f"/proc/{p}/status") as fh:
+                st = dict(l.split(":", 1) for l in fh if ":" in l)
+        except OSError:
+            continue
+        if int(st.get("PPid", "0")) == master_pid and "VmHWM" in st:
+            out[p] = round(int(st["VmHWM"].split()[0]) / 1024, 1)
+    return out
+
+
+def _post(url, body, timeout):
+    req = urllib.request.Request(url, data=body, headers={"Content-Type": "application/json"})
+    t = time.perf_counter()
+    try:
+        with urllib.request.urlopen(req, timeout=timeout) as r:
+            n = len(r.read())
+            return r.status, (time.perf_counter() - t) * 1000, n, r.headers.get("X-Cache")
+    except urllib.error.HTTPError as e:
+        return e.code, (time.perf_counter() - t) * 1000, 0, None
+    except OSError:
+        return 0, (time.perf_counter() - t) * 1000, 0, None
+
+
+def bench_http(url=None, workers=2, concurrency=4, requests=40, mode=None, timeout=120):
+    stub = proc = None
+    if url is None:
+        stub = SMTPStub()
+        port = _free_port()
+        env = {**os.environ, "SMTP_HOST": "127.0.0.1", "SMTP_PORT": str(stub.port), "SMTP_STARTTLS": "0",
+               "SMTP_USER": "bench", "SMTP_PASS": "bench", "NOTIFY_EMAIL": "bench@localhost",
+               "RESULT_CACHE_MB": "0", "RESULT_CACHE_DIR": ""}
+        proc = subprocess.Popen([sys.executable, "-m", "gunicorn", "app:app", "--bind", f"127.0.0.1:{port}",
+                                 "--workers", str(workers), "--timeout", "60", "--log-level", "warning"],
+                                cwd=HERE, env=env)
+        url = f"http://127.0.0.1:{port}"
+        deadline = time.monotonic() + 60
+        while True:
+            try:
+                urllib.request.urlopen(url + "/health", timeout=2).read(); break
+            except OSError:
+                if proc.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError("gunicorn did not come up")
+                time.sleep(0.2)
+    try:
+        target = url.rstrip("/") + "/fill" + (f"?mode={mode}" if mode else "")
+        payloads = list(variants().values())
+        # A nonce keeps every request distinct so the result cache can't short-circuit it
+        bodies = [json.dumps({**payloads[i % len(payloads)], "_bench": i}).encode() for i in range(requests)]
+        for b in bodies[:workers * 2]:  # warm every worker's template
+            _post(target, b, timeout)
+        t = time.perf_counter()
+        with cf.ThreadPoolExecutor(concurrency) as ex:
+            res = list(ex.map(lambda b: _post(target, b, timeout), bodies))
+        wall = time.perf_counter() - t
+        ok = [r for r in res if r[0] == 200]
+        out = {"url": url, "concurrency": concurrency, "requests": requests, "ok": len(ok),
+               "errors": {str(code): sum(r[0] == code for r in res) for code in {r[0] for r in res} if code != 200},
+               "rps": round(len(ok) / wall, 2), "latency_ms": percentiles([r[1] for r in ok]),
+               "bytes": percentiles([r[2] for r in ok])}
+        if proc is not None:
+            out["worker_peak_rss_mb"] = _worker_rss_mb(proc.pid)
+        if stub is not None:
+            deadline = time.monotonic() + 30
+            while stub.messages < len(ok) + workers * 2 and time.monotonic() < deadline:
+                time.sleep(0.1)
+            out["smtp"] = {"messages": stub.messages, "connections": stub.connections, "bytes": stub.bytes}
+        print(f"  {out['ok']}/{requests} ok, {out['rps']} req/s, p50 {out['latency_ms'].get('p50')} ms, "
+              f"p90 {out['latency_ms'].get('p90')} ms", flush=True)
+        return out
+    finally:
+        if proc is not None:
+            proc.send_signal(signal.SIGTERM)
+            try: proc.wait(15)
+            except subprocess.TimeoutExpired: proc.kill()
+        if stub is not None:
+            stub.close()
+
+
+# ══ REGRESSION CHECK ═════════════════════════════════════════════
+def metrics(results):
+    """Flatten a run to ``name -> (value, higher_is_better)``."""
+    m = {}
+    fill = results.get("fill")
+    if fill:
+        m["fill.peak_rss_mb"] = (fill["peak_rss_mb"], False)
+        for name, v in fill["variants"].items():
+            m[f"fill.{name}.total.p50"] = (v["phases_ms"]["total"]["p50"], False)
+            m[f"fill.{name}.total.p90"] = (v["phases_ms"]["total"]["p90"], False)
+            m[f"fill.{name}.bytes"] = (v["bytes"], False)
+            m[f"fill.{name}.alloc_peak_kb"] = (v["alloc_peak_kb"], False)
+    for mode, r in (results.get("request") or {}).items():
+        m[f"request.{mode}.peak_kb"] = (r["peak_kb"]["p50"], False)
+    for mode, s in (results.get("modes") or {}).get("summary", {}).items():
+        m[f"modes.{mode}.write_ms_p50"] = (s["write_ms_p50"], False)
+        m[f"modes.{mode}.bytes"] = (s["bytes"], False)
+        if s.get("render_ms_p50") is not None:
+            m[f"modes.{mode}.render_ms_p50"] = (s["render_ms_p50"], False)
+    http = results.get("http")
+    if http and http.get("ok"):
+        m["http.rps"] = (http["rps"], True)
+        m["http.latency.p50"] = (http["latency_ms"]["p50"], False)
+        m["http.latency.p90"] = (http["latency_ms"]["p90"], False)
+    return m
+
+
+def compare(results, baseline, threshold):
+    """Regressions beyond ``threshold`` (a fraction) as human-readable lines."""
+    new, old = metrics(results), metrics(baseline)
+    problems = []
+    for k, (v, higher_better) in new.items():
+        if k not in old or not old[k][0]: continue
+        change = (v - old[k][0]) / old[k][0]
+        if (-change if higher_better else change) > threshold:
+            problems.append(f"{k}: {old[k][0]} -> {v} ({change:+.0%})")
+    return problems
+
+
+def main(argv):
+    p = argparse.ArgumentParser(description="Benchmark fill_i129 and the /fill endpoint")
+    p.add_argument("what", choices=("fill", "modes", "request", "http", "all"))
+    p.add_argument("--mode", choices=("full", "incremental", "compact", "flat"), default="full")
+    p.add_argument("--iterations", type=int, default=5, help="fills per variant (fill)")
+    p.add_argument("--only", help="only variants whose name contains this (fill)")
+    p.add_argument("--url", help="existing server to load instead of starting gunicorn (http)")
+    p.add_argument("--workers", type=int, default=2, help="gunicorn workers to start (http)")
+    p.add_argument("--concurrency", type=int, default=4)
+    p.add_argument("--requests", type=int, default=40)
+    p.add_argument("--out", help="write results JSON here")
+    p.add_argument("--baseline", help="earlier results JSON to compare against")
+    p.add_argument("--threshold", type=float, default=0.2, help="allowed regression, as a fraction (0.2 = 20%%)")
+    args = p.parse_args(argv[1:])
+
+    results = {"meta": {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+                        "machine": platform.machine(), "cpus": os.cpu_count()}}
+    if args.what in ("fill", "all"):
+        print(f"fill_i129 ({args.mode}, {args.iterations} iterations):")
+        results["fill"] = bench_fill(args.iterations, args.mode, args.only)
+    if args.what == "modes":
+        print(f"fill_i129 per output mode ({args.iterations} iterations):")
+        results["modes"] = bench_modes(args.iterations, args.only)
+    if args.what in ("request", "all"):
+        print("POST /fill peak memory (tracemalloc):")
+        results["request"] = bench_request()
+    if args.what in ("http", "all"):
+        print(f"POST /fill ({args.concurrency} concurrent, {args.requests} requests):")
+        results["http"] = bench_http(args.url, args.workers, args.concurrency, args.requests,
+                                     args.mode if args.mode != "full" else None)
+    if args.out:
+        with open(args.out, "w") as fh:
+            json.dump(results, fh, indent=1)
+        print(f"wrote {args.out}")
+    if args.baseline:
+        with open(args.baseline) as fh:
+            problems = compare(results, json.load(fh), args.threshold)
+        for line in problems:
+            print(f"REGRESSION {line}")
+        print(f"{len(problems)} regression(s) beyond {args.threshold:.0%} against {args.baseline}")
+        return 1 if problems else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
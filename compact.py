@@ -0,0 +1,227 @@
+"""Compact output: only the pages a petition needs, written as tightly as possible.
+
+``prune`` cuts the filled clone down to the core form plus the supplements for
+the petition's classification (``app.compact_pages`` decides which), together
+with their widgets and fields and the template's auto-generated "Structure
+Bookmarks" outline.  ``CompactTemplate.write`` then serializes only what is
+still reachable from the catalog:
+
+- objects nothing points to any more (dropped pages, the embedded files the
+  official PDF carries but never references) are left out;
+- byte-identical streams (most checkbox appearances) are written once;
+- streams are deflated at level 9 and every other object is packed into
+  compressed object streams, with a cross-reference stream.
+
+Object numbers are kept from the template, so the serialized form of every
+shared template object can be computed once and reused for every request.
+"""
+import struct, zlib
+from pypdf.generic import (ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject,
+                           StreamObject)
+from incremental import _Counting
+
+INHERITABLE = ("/Resources", "/MediaBox", "/CropBox", "/Rotate")
+OBJSTM_SIZE = 100
+
+
+def prune(writer, keep):
+    """Reduce a cloned writer to the 0-based page indices in ``keep``; returns the dropped pages' object numbers."""
+    pages = writer.flattened_pages
+    kept = [pages[i] for i in keep if i < len(pages)]
+    dropped = {p.indirect_reference.idnum for p in pages} - {p.indirect_reference.idnum for p in kept}
+    widgets = {a.idnum for p in kept for a in p.get("/Annots", []) if isinstance(a, IndirectObject)}
+
+    tree = writer._pages.get_object()
+    for page in kept:
+        # Pages are re-parented to the root node, so bring inherited attributes along
+        for key in INHERITABLE:
+            node = page
+            while key not in node and "/Parent" in node:
+                node = node["/Parent"]
+            if node is not page and key in node:
+                page[NameObject(key)] = node.raw_get(key)
+        page[NameObject("/Parent")] = writer._pages
+    tree[NameObject("/Kids")] = ArrayObject(p.indirect_reference for p in kept)
+    tree[NameObject("/Count")] = NumberObject(len(kept))
+    writer.flattened_pages = kept
+
+    root = writer._root_object
+    if "/Outlines" in root:
+        del root["/Outlines"]
+
+    def keep_field(ref):
+        if ref.idnum in widgets: return True
+        node = ref.get_object()
+        kids = node.get("/Kids")
+        if kids is None: return False
+        left = [k for k in kids if keep_field(k)]
+        if len(left) != len(kids):
+            node[NameObject("/Kids")] = ArrayObject(left)
+        return bool(left)
+
+    if "/AcroForm" in root:
+        acroform = root["/AcroForm"]
+        acroform[NameObject("/Fields")] = ArrayObject(f for f in acroform.get("/Fields", []) if keep_field(f))
+    return dropped
+
+
+class _Buf(bytearray):
+    # pypdf's write_to_stream only needs .write
+    def write(self, b):
+        self += b
+
+
+def _serialize(obj, alias, buf):
+    """Write ``obj`` with references renumbered through ``alias``; returns the refs it contains."""
+    refs = []
+    def ser(o):
+        if isinstance(o, IndirectObject):
+            n = alias.get(o.idnum, o.idnum)
+            refs.append(n)
+            buf.extend(b"%d 0 R" % n)
+        elif isinstance(o, DictionaryObject):
+            buf.extend(b"<<")
+            for k, v in o.items():
+                k.write_to_stream(buf); buf.extend(b" "); ser(v); buf.extend(b"\n")
+            buf.extend(b">>")
+        elif isinstance(o, ArrayObject):
+            buf.extend(b"[")
+            for i, v in enumerate(o):
+                if i: buf.extend(b" ")
+                ser(v)
+            buf.extend(b"]")
+        else:
+            o.write_to_stream(buf)
+    ser(obj)
+    return refs
+
+
+def _encode_stream(obj):
+    """Stream dictionary (without /Length) and encoded data, deflated at level 9 where that helps."""
+    d = DictionaryObject({k: v for k, v in obj.items() if k != "/Length"})
+    data = obj._data
+    filters = d.get("/Filter")
+    if filters is None:
+        data = zlib.compress(data, 9)
+        d[NameObject("/Filter")] = NameObject("/FlateDecode")
+    elif filters in ("/FlateDecode", ["/FlateDecode"]) and "/DecodeParms" not in d:
+        try:
+            smaller = zlib.compress(zlib.decompress(data), 9)
+            if len(smaller) < len(data): data = smaller
+        except zlib.error:
+            pass
+    return d, data
+
+
+class CompactTemplate:
+    """Per-template caches for compact output: stream aliases and serialized shared objects."""
+
+    def __init__(self, template):
+        self.template = template
+        self._cache = {}   # idnum -> (serialized bytes, refs, is_stream)
+        self._keys = {}    # stream content key -> canonical idnum
+        self.alias = {}    # duplicate stream idnum -> canonical idnum
+        for i, obj in enumerate(template._objects):
+            if isinstance(obj, StreamObject):
+                key = self._stream_key(obj)
+                canonical = self._keys.setdefault(key, i + 1)
+                if canonical != i + 1: self.alias[i + 1] = canonical
+
+    @staticmethod
+    def _stream_key(obj):
+        buf = _Buf()
+        _serialize(DictionaryObject({k: v for k, v in obj.items() if k != "/Length"}), {}, buf)
+        return bytes(buf), obj._data
+
+    def _entry(self, idnum, obj, alias):
+        buf = _Buf()
+        if isinstance(obj, StreamObject):
+            d, data = _encode_stream(obj)
+            d[NameObject("/Length")] = NumberObject(len(data))
+            refs = _serialize(d, alias, buf)
+            buf.extend(b"\nstream\n"); buf.extend(data); buf.extend(b"\nendstream")
+            return bytes(buf), refs, True
+        refs = _serialize(obj, alias, buf)
+        return bytes(buf), refs, False
+
+    def write(self, writer, keep, out):
+        """Prune ``writer`` (a clone of this template) to ``keep`` and write it to ``out``."""
+        dropped = prune(writer, keep) if keep is not None else set()
+        template = self.template._objects
+        objects = writer._objects
+        alias = dict(self.alias)
+        # New streams (fresh appearances) are deduplicated against the template and each other
+        keys = {}
+        for i in range(len(template), len(objects)):
+            obj = objects[i]
+            if isinstance(obj, StreamObject):
+                key = self._stream_key(obj)
+                canonical = self._keys.get(key) or keys.setdefault(key, i + 1)
+                if canonical != i + 1: alias[i + 1] = canonical
+
+        def entry(idnum):
+            obj = objects[idnum - 1]
+            shared = idnum <= len(template) and obj is template[idnum - 1]
+            if shared:
+                e = self._cache.get(idnum)
+                if e is None:
+                    e = self._cache[idnum] = self._entry(idnum, obj, self.alias)
+                return e
+            return self._entry(idnum, obj, alias)
+
+        # Everything reachable from the catalog (and /Info), in discovery order
+        roots = [writer._root_object.indirect_reference.idnum]
+        info = getattr(writer, "_info_obj", None)
+        if isinstance(info, IndirectObject): roots.append(info.idnum)
+        # Leftover references to dropped pages are left dangling, which readers treat as null
+        entries, seen, todo = {}, set(roots) | dropped, list(reversed(roots))
+        order = []
+        while todo:
+            idnum = todo.pop()
+            if not 0 < idnum <= len(objects) or objects[idnum - 1] is None: continue
+            e = entries[idnum] = entry(idnum)
+            order.append(idnum)
+            for r in reversed(e[1]):
+                if r not in seen:
+                    seen.add(r); todo.append(r)
+
+        out = _Counting(out)
+        out.write(b"%PDF-1.7\n%\xe2\xe3\xcf\xd3\n")
+        xref = {}  # idnum -> (type, field2, field3)
+        plain = [i for i in order if not entries[i][2]]
+        next_id = len(objects) + 1
+        for i in order:
+            if entries[i][2]:
+                xref[i] = (1, out.pos, 0)
+                out.write(b"%d 0 obj\n" % i); out.write(entries[i][0]); out.write(b"\nendobj\n")
+        for start in range(0, len(plain), OBJSTM_SIZE):
+            chunk = plain[start:start + OBJSTM_SIZE]
+            stm_id, next_id = next_id, next_id + 1
+            header, body = [], _Buf()
+            for n, i in enumerate(chunk):
+                header.append(b"%d %d" % (i, len(body)))
+                body.extend(entries[i][0]); body.extend(b"\n")
+                xref[i] = (2, stm_id, n)
+            header = b" ".join(header) + b"\n"
+            data = zlib.compress(header + bytes(body), 6)
+            xref[stm_id] = (1, out.pos, 0)
+            out.write(b"%d 0 obj\n<</Type/ObjStm/N %d/First %d/Filter/FlateDecode/Length %d>>\nstream\n"
+                      % (stm_id, len(chunk), len(header), len(data)))
+            out.write(data); out.write(b"\nendstream\nendobj\n")
+
+        xref_id = next_id
+        xref[xref_id] = (1, out.pos, 0)
+        index, rows = [], []
+        for idnum in sorted(xref):
+            if index and index[-2] + index[-1] == idnum:
+                index[-1] += 1
+            else:
+                index += [idnum, 1]
+            rows.append(struct.pack(">BIH", *xref[idnum]))
+        data = zlib.compress(b"".join(rows))
+        trailer = b"/Root %d 0 R" % roots[0] + (b"/Info %d 0 R" % roots[1] if len(roots) > 1 else b"")
+        xref_pos = out.pos
+        out.write(b"%d 0 obj\n<</Type/XRef/Size %d/Index[%s]/W[1 4 2]%s/Filter/FlateDecode/Length %d>>\nstream\n"
+                  % (xref_id, xref_id + 1, b" ".join(b"%d" % n for n in index), trailer, len(data)))
+        out.write(data)
+        out.write(b"\nendstream\nendobj\nstartxref\n%d\n%%%%EOF\n" % xref_pos)
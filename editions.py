@@ -0,0 +1,209 @@
+"""Registry of I-129 form editions.
+
+USCIS revises the form every year or two, and during a transition both
+editions have to be produced.  Each edition is a PDF in the template
+directory: ``i-129-YYYY-MM-DD.pdf`` is the edition of that date, and a plain
+``i-129.pdf`` is the registry's ``default`` edition.  Every edition has its own
+field manifest (``<pdf>.fields.json``) and a ``Layout``: the mapping plan and the
+page tables for compact output.  An edition without a layout of its own uses
+the newest layout no newer than itself.
+
+A payload picks its edition explicitly with ``formEdition``.  Otherwise its
+``filingDate`` (default today) picks the newest edition dated on or before it.
+Parsed templates are loaded on first use and kept in an LRU that is bounded
+by their combined resident size.
+"""
+import datetime, logging, os, re, threading, time
+from field_manifest import build_manifest, file_sha256, load_manifest
+from template_cache import TemplateCache, prepare_template
+
+log = logging.getLogger(__name__)
+
+EDITION_FILE = re.compile(r"i-129(?:-(\d{4}-\d{2}-\d{2}))?\.pdf")
+
+
+class UnknownEdition(ValueError):
+    pass
+
+
+class Layout:
+    """How one edition's fields and pages are used: its mapping plan and compact-mode page tables."""
+
+    def __init__(self, plan, core_pages, supplement_pages, attachment_pages=()):
+        self.plan = plan
+        self.core_pages = core_pages
+        self.supplement_pages = supplement_pages
+        self.attachment_pages = attachment_pages
+
+
+class Edition:
+    def __init__(self, name, path, layout):
+        self.name = name
+        self.date = datetime.date.fromisoformat(name)
+        self.path = path
+        self.layout = layout
+        self.cache = None
+        self.last_used = 0.0
+        self.loads = 0
+        self._manifest = None
+        self._manifest_lock = threading.Lock()
+        self._stat = None
+        self._sha256 = None
+
+    def _check(self):
+        st = os.stat(self.path)
+        if (st.st_mtime_ns, st.st_size) != self._stat:
+            self._stat, self._sha256, self._manifest = (st.st_mtime_ns, st.st_size), None, None
+
+    @property
+    def sha256(self):
+        """Hash of the PDF (for cache keys), without loading the template."""
+        self._check()
+        if self._sha256 is None: self._sha256 = file_sha256(self.path)
+        return self._sha256
+
+    @property
+    def file_size(self):
+        self._check()
+        return self._stat[1]
+
+
+class TemplateRegistry:
+    def __init__(self, directory, layouts, default, max_bytes=512 << 20):
+        self.directory = directory
+        self.layouts = dict(sorted(layouts.items()))
+        self.default = default
+        self.max_bytes = max_bytes
+        self.editions = {}
+        self.evictions = 0
+        self._per_file_byte = 0.0  # largest resident/file size ratio seen, see _charge
+        self._lock = threading.Lock()
+        self.discover()
+
+    def _layout(self, name):
+        older = [n for n in self.layouts if n <= name]
+        key = older[-1] if older else next(iter(self.layouts))
+        if key != name:
+            log.warning(f"No layout for I-129 edition {name}; using the {key} layout")
+        return self.layouts[key]
+
+    def discover(self):
+        """(Re)scan the template directory; returns the edition names found."""
+        found = {}
+        for fname in sorted(os.listdir(self.directory)):
+            m = EDITION_FILE.fullmatch(fname)
+            if not m: continue
+            name = m.group(1) or self.default
+            try:
+                datetime.date.fromisoformat(name)
+            except ValueError:
+                log.warning(f"Ignoring {fname}: {name!r} is not a YYYY-MM-DD edition date")
+                continue
+            if name in found:
+                log.warning(f"Ignoring {fname}: edition {name} is already {found[name]}")
+                continue
+            found[name] = os.path.join(self.directory, fname)
+        with self._lock:
+            for name, path in found.items():
+                ed = self.editions.get(name)
+                if ed is None or ed.path != path:
+                    self.editions[name] = Edition(name, path, self._layout(name))
+            for name in set(self.editions) - set(found):
+                del self.editions[name]
+            self.editions = dict(sorted(self.editions.items()))
+        return list(self.editions)
+
+    def pick(self, data):
+        """The edition for a payload: ``formEdition`` if given, else by ``filingDate`` (default today)."""
+        name = data.get("formEdition")
+        if name:
+            if name not in self.editions and name not in self.discover():
+                raise UnknownEdition(f"Unknown form edition {name!r}; available: {', '.join(self.editions)}")
+            return self.editions[name]
+        if not self.editions:
+            raise UnknownEdition(f"No I-129 editions in {self.directory}")
+        day = data.get("filingDate")
+        try:
+            day = datetime.date.fromisoformat(day) if day else datetime.date.today()
+        except (TypeError, ValueError):
+            raise UnknownEdition(f"filingDate must be YYYY-MM-DD, not {day!r}")
+        eds = list(self.editions.values())
+        return next((e for e in reversed(eds) if e.date <= day), eds[0])
+
+    def by_path(self, path):
+        path = os.path.abspath(path)
+        ed = next((e for e in self.editions.values() if os.path.abspath(e.path) == path), None)
+        if ed is None: raise UnknownEdition(f"{path} is not an edition in {self.directory}")
+        return ed
+
+    def template(self, edition):
+        """The edition's loaded ``TemplateCache``, evicting least recently used editions over budget."""
+        with self._lock:
+            if edition.cache is None:
+                # Make room first, so a load never briefly holds more editions than fit
+                self._evict(keep=edition, incoming=int(self._per_file_byte * edition.file_size))
+                edition.cache = TemplateCache(edition.path, constants=edition.layout.plan.constants)
+                edition.loads += 1
+            cache = edition.cache
+            edition.last_used = time.monotonic()
+        cache.template()
+        if edition._manifest is None:
+            edition._manifest = cache.manifest  # kept for /preview after the template is evicted
+        with self._lock:
+            self._evict(keep=edition)
+        return cache
+
+    def manifest(self, edition):
+        """The edition's field manifest, without loading its template into the cache.
+
+        Read from disk when current; otherwise built once from the PDF and kept
+        on the edition, so only the first call does any PDF work.
+        """
+        cache = edition.cache
+        if cache is not None and cache.manifest is not None:
+            return cache.manifest
+        edition._check()
+        if edition._manifest is None:
+            with edition._manifest_lock:
+                if edition._manifest is None:
+                    manifest = load_manifest(edition.path)
+                    if manifest is None:
+                        log.warning(f"No current field manifest for {edition.path}; building it in memory "
+                                    "(run `python field_manifest.py build` to persist it)")
+                        manifest = build_manifest(prepare_template(edition.path), edition.path)
+                    edition._manifest = manifest
+        return edition._manifest
+
+    def _charge(self, ed):
+        # RSS growth undercounts a load that reuses memory freed by an eviction, so
+        # nothing is charged less than the largest size per file byte seen so far
+        parts = ed.cache.loaded_parts() if ed.cache else 0
+        if not parts: return 0
+        size = ed.cache.resident_bytes
+        self._per_file_byte = max(self._per_file_byte, size / (ed.file_size * parts))
+        return max(size, int(self._per_file_byte * ed.file_size * parts))
+
+    def _evict(self, keep, incoming=0):
+        loaded = sorted((e for e in self.editions.values() if e.cache is not None and e is not keep),
+                        key=lambda e: e.last_used)
+        total = sum(self._charge(e) for e in loaded) + self._charge(keep) + incoming
+        while loaded and total > self.max_bytes:
+            ed = loaded.pop(0)
+            total -= self._charge(ed)
+            log.info(f"Evicting I-129 edition {ed.name} from the template cache")
+            ed.cache = None
+            self.evictions += 1
+
+    def resident_bytes(self):
+        return sum(self._charge(e) for e in self.editions.values())
+
+    def stats(self):
+        with self._lock:
+            editions = {e.name: {"file": os.path.basename(e.path), "loaded": e.cache is not None, "loads": e.loads,
+                                 "resident_mb": round(self._charge(e) / (1 << 20), 1),
+                                 "layout": next((n for n, l in self.layouts.items() if l is e.layout), None),
+                                 **({"cache": e.cache.stats()} if e.cache is not None else {})}
+                        for e in self.editions.values()}
+            return {"editions": editions, "default": self.default, "evictions": self.evictions,
+                    "budget_mb": round(self.max_bytes / (1 << 20), 1),
+                    "resident_mb": round(self.resident_bytes() / (1 << 20), 1)}
@@ -0,0 +1,132 @@
+"""Precomputed index of every widget in the I-129 template.
+
+The manifest maps each field name (the widget's partial ``/T``, which is what
+``fill_i129`` uses) to its page, fully qualified name, field type, widget
+object references and allowed appearance states.  It is stored next to the
+template as ``<template>.fields.json`` and loaded at startup, so the fill path
+never has to scan pages to find a field.
+
+    python field_manifest.py build [template.pdf]   # (re)write the manifest
+    python field_manifest.py check [template.pdf]   # verify fill_i129 against it
+"""
+import hashlib, json, os, sys
+import pypdf
+
+VERSION = 1
+
+
+def manifest_path(pdf_path):
+    return os.path.splitext(pdf_path)[0] + ".fields.json"
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _qualified_name(obj):
+    parts = []
+    while obj is not None:
+        if "/T" in obj: parts.append(str(obj["/T"]))
+        obj = obj["/Parent"] if "/Parent" in obj else None
+    return ".".join(reversed(parts))
+
+
+def _states(annot):
+    ap = annot.get("/AP")
+    normal = ap.get("/N") if ap is not None else None
+    return sorted(str(k) for k in normal.keys()) if hasattr(normal, "keys") else []
+
+
+def build_manifest(writer, pdf_path):
+    """Index the widgets of a prepared writer (see ``template_cache.prepare_template``)."""
+    fields = {}
+    for pi, page in enumerate(writer.pages):
+        if "/Annots" not in page: continue
+        for ref in page["/Annots"]:
+            annot = ref.get_object()
+            if annot.get("/Subtype") != "/Widget" or "/T" not in annot: continue
+            name = str(annot["/T"])
+            entry = fields.get(name)
+            # A name used on several pages resolves to the last one, as it always has
+            if entry is None or entry["page"] != pi:
+                entry = fields[name] = {"qualified": _qualified_name(annot), "type": str(annot.get("/FT", "")),
+                                        "page": pi, "widgets": [], "states": []}
+                if "/MaxLen" in annot:
+                    entry["max_len"] = int(annot["/MaxLen"])
+            entry["widgets"].append([ref.idnum, ref.generation])
+            entry["states"] = sorted(set(entry["states"]) | set(_states(annot)))
+    return {"version": VERSION, "pypdf": pypdf.__version__,
+            "template": {"file": os.path.basename(pdf_path), "sha256": file_sha256(pdf_path)},
+            "fields": fields}
+
+
+def load_manifest(pdf_path):
+    """The on-disk manifest, or None if it is missing or stale for this template/pypdf."""
+    try:
+        with open(manifest_path(pdf_path)) as fh:
+            m = json.load(fh)
+    except (OSError, ValueError):
+        return None
+    if (m.get("version") != VERSION or m.get("pypdf") != pypdf.__version__
+            or m.get("template", {}).get("sha256") != file_sha256(pdf_path)):
+        return None
+    return m
+
+
+def save_manifest(manifest, pdf_path):
+    with open(manifest_path(pdf_path), "w") as fh:
+        json.dump(manifest, fh, indent=0, sort_keys=True)
+        fh.write("\n")
+
+
+def check_mapping(manifest, payloads, map_fields):
+    """Run ``map_fields`` over probe payloads and report names/states the template lacks."""
+    fields = manifest["fields"]
+    problems = set()
+
+    class Recorder:
+        def set(self, key, value):
+            entry = fields.get(key)
+            if entry is None:
+                problems.add(f"unknown field {key!r}")
+            elif entry["type"] == "/Btn":
+                if value and str(value) != "/Off" and str(value) not in entry["states"]:
+                    problems.add(f"{key!r}: state {value!r} not in {entry['states']}")
+            elif value and str(value).startswith("/"):
+                problems.add(f"{key!r}: state {value!r} set on {entry['type']} field")
+
+    for data in payloads:
+        map_fields(data, Recorder())
+    return sorted(problems)
+
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in ("build", "check"):
+        print("usage: python field_manifest.py build|check [template.pdf]", file=sys.stderr)
+        return 2
+    from template_cache import prepare_template
+    import app
+    pdf_path = os.path.abspath(argv[2]) if len(argv) > 2 else app.PDF_PATH
+    if argv[1] == "build":
+        save_manifest(build_manifest(prepare_template(pdf_path), pdf_path), pdf_path)
+        print(f"wrote {manifest_path(pdf_path)}")
+        return 0
+    manifest = load_manifest(pdf_path)
+    if manifest is None:
+        print(f"{manifest_path(pdf_path)} is missing or stale; run `python field_manifest.py build`")
+        return 1
+    edition = app.TEMPLATES.by_path(pdf_path)
+    problems = check_mapping(manifest, app.probe_payloads(), lambda d, f: app.map_fields(d, f, edition.layout))
+    problems += app.SCHEMA.overflows(edition.layout.plan.text_sources(), manifest["fields"])
+    for p in problems:
+        print(p)
+    print(f"{len(problems)} problem(s) in fill_i129 for edition {edition.name} against {len(manifest['fields'])} template fields")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
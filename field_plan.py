@@ -0,0 +1,188 @@
+"""Declarative field mapping, compiled once into a flat instruction table.
+
+The questionnaire-to-form mapping (``app.FIELD_SPEC``) is a list of entries:
+
+- ``Text(field, *sources, default=None)``: the first non-empty source, where a
+  source is a payload key, a ``Join`` of keys, a ``Lookup`` through a table or
+  a ``Get`` (a key with a default for when it is absent, not merely empty);
+- ``Flag(key, yes_field, no_field=None, ...)``: a yes/no checkbox pair;
+- ``Choice(key, {answer: field}, ...)``: a group of boxes, one of which is on;
+- ``Const(field, value)``: an answer that never changes;
+- ``When(key, value, *entries)`` / ``Unless(...)``: entries for one answer only
+  (a missing key counts as ``""``).
+
+``compile_plan`` flattens the spec into ``Plan.rows``.  Values that do not
+depend on the payload (every ``Const`` and the boxes of a ``Choice`` that no
+answer selects) go to ``Plan.constants`` instead.  Those are written into the
+cached template once, at load time (see ``TemplateCache``), not per request.
+"""
+from itertools import islice
+
+# Row kinds; every row is (kind, field, a, b, c)
+KEY, TEXT, IF, UNLESS, CHOICE, SKIP = range(6)
+
+
+class Join:
+    """Payload values joined with spaces, e.g. first and last name."""
+
+    def __init__(self, *keys):
+        self.keys = keys
+
+    def __call__(self, data):
+        return " ".join(str(data.get(k, "")) for k in self.keys).strip()
+
+
+class Lookup:
+    """A payload value translated through ``table`` (unknown values pass through)."""
+
+    def __init__(self, key, table):
+        self.key, self.table = key, table
+        self.keys = (key,)
+
+    def __call__(self, data):
+        v = data.get(self.key, "")
+        return self.table.get(v, v)
+
+
+class Get:
+    """A payload value, or ``default`` when the key is absent; an empty answer stays empty."""
+
+    def __init__(self, key, default):
+        self.key, self.default = key, default
+        self.keys = (key,)
+
+    def __call__(self, data):
+        return data.get(self.key, self.default)
+
+
+class Text:
+    def __init__(self, field, *sources, default=None):
+        self.field, self.sources, self.default = field, sources, default
+
+
+class Flag:
+    """``yes_field`` gets ``yes`` when ``key`` is ``when``; otherwise ``no_field`` gets ``no``."""
+
+    def __init__(self, key, yes_field, no_field=None, yes="/Y", no="/Y", when="yes"):
+        self.key, self.yes_field, self.no_field, self.yes, self.no, self.when = key, yes_field, no_field, yes, no, when
+
+
+class Choice:
+    """One box per answer: ``options`` maps answers to a field, or to ``(field, state)``.
+
+    ``default`` stands in for a missing key; ``otherwise`` is selected for an
+    answer that is not in ``options``.  ``unused`` boxes belong to the group but
+    no answer selects them, so they are always off.
+    """
+
+    def __init__(self, key, options, state="/1", default=None, otherwise=None, unused=()):
+        self.key, self.default, self.otherwise, self.unused = key, default, otherwise, tuple(unused)
+        self.options = {k: v if isinstance(v, tuple) else (v, state) for k, v in options.items()}
+
+
+class Const:
+    def __init__(self, field, value):
+        self.field, self.value = field, value
+
+
+class When:
+    def __init__(self, key, value, *entries):
+        self.key, self.value, self.entries = key, value, entries
+        self.expect = True
+
+
+class Unless(When):
+    def __init__(self, key, value, *entries):
+        super().__init__(key, value, *entries)
+        self.expect = False
+
+
+class Plan:
+    """The compiled mapping: ``rows`` evaluated per payload, ``constants`` baked into the template."""
+
+    def __init__(self, rows, constants, keys):
+        self.rows = rows
+        self.constants = constants
+        self.keys = keys
+
+    def text_sources(self):
+        """``(key, field)`` for every text field filled straight from a payload key."""
+        for kind, field, a, b, c in self.rows:
+            if kind == KEY:
+                yield a, field
+            elif kind == TEXT:
+                yield from ((src if src.__class__ is str else src.key, field) for src in a if src.__class__ in (str, Get))
+
+    def apply(self, data, fields, constants=False):
+        """Call ``fields.set(name, value)`` for every row; ``constants=True`` includes the baked ones."""
+        s = fields.set
+        get = data.get
+        if constants:
+            for field, value in self.constants.items():
+                s(field, value)
+        rows = iter(self.rows)
+        for kind, field, a, b, c in rows:
+            if kind == KEY:
+                s(field, get(a))
+            elif kind == IF:
+                s(field, c if get(a) == b else "/Off")
+            elif kind == UNLESS:
+                s(field, c if get(a) != b else "/Off")
+            elif kind == TEXT:
+                for src in a:
+                    v = get(src) if src.__class__ is str else src(data)
+                    if v: break
+                else:
+                    v = b
+                s(field, v)
+            elif kind == CHOICE:
+                chosen = c.get(get(a, b[0])) or c.get(b[1])
+                for box, state in field:
+                    s(box, state if box == chosen else "/Off")
+            elif (get(a, "") == b) != c:
+                next(islice(rows, field, field), None)  # SKIP: jump over a When block
+
+
+def compile_plan(spec):
+    rows, constants, keys = [], {}, set()
+
+    def add(entry):
+        if isinstance(entry, When):
+            keys.add(entry.key)
+            at = len(rows)
+            rows.append(None)
+            for e in entry.entries:
+                add(e)
+            rows[at] = (SKIP, len(rows) - at - 1, entry.key, entry.value, entry.expect)
+        elif isinstance(entry, Const):
+            constants[entry.field] = entry.value
+        elif isinstance(entry, Text):
+            for src in entry.sources:
+                keys.update((src,) if isinstance(src, str) else src.keys)
+            if len(entry.sources) == 1 and isinstance(entry.sources[0], str) and entry.default is None:
+                rows.append((KEY, entry.field, entry.sources[0], None, None))
+            else:
+                rows.append((TEXT, entry.field, entry.sources, entry.default, None))
+        elif isinstance(entry, Flag):
+            keys.add(entry.key)
+            rows.append((IF, entry.yes_field, entry.key, entry.when, entry.yes))
+            if entry.no_field:
+                rows.append((UNLESS, entry.no_field, entry.key, entry.when, entry.no))
+        elif isinstance(entry, Choice):
+            keys.add(entry.key)
+            boxes = tuple(dict.fromkeys(entry.options.values()))
+            options = {k: field for k, (field, _) in entry.options.items()}
+            rows.append((CHOICE, boxes, entry.key, (entry.default, entry.otherwise), options))
+            for field in entry.unused:
+                constants[field] = "/Off"
+        else:
+            raise TypeError(f"Unknown field spec entry {entry!r}")
+
+    for entry in spec:
+        add(entry)
+    # A baked field must never be overwritten per request, or clones would disagree with previews
+    dynamic = {r[1] for r in rows if r[0] in (KEY, TEXT, IF, UNLESS)} | {b for r in rows if r[0] == CHOICE for b, _ in r[1]}
+    overlap = dynamic & constants.keys()
+    if overlap:
+        raise ValueError(f"Fields both constant and payload-dependent: {sorted(overlap)}")
+    return Plan(rows, constants, frozenset(keys))
@@ -0,0 +1,259 @@
+"""Flattened output: the answers drawn into the page content, with no form left.
+
+A filled AcroForm makes every viewer (and the archival/print pipeline) parse
+~970 widgets and their appearances before it can draw a page.  ``flat`` output
+draws each widget's appearance straight into its page instead.  The widgets,
+the field tree and ``/AcroForm`` are removed, so what is left is plain page
+content, which ``CompactTemplate.write`` then serializes.
+
+Everything that does not depend on the answers is worked out once per
+template by ``FlattenTemplate``: font metrics from the ``/DR`` fonts, each
+widget's placement, the XObject that draws every checkbox state (and the
+current appearance of widgets left unanswered), and each page's new
+``/Resources`` and ``/Annots``.  Per request only the text of the answered
+fields is laid out.  The layout (2pt padding, vertical centring, comb cells)
+follows pypdf's own generated appearances, so ``flat`` looks like ``full``.
+Text is encoded as WinAnsi, the encoding of the form's fonts; characters
+outside it are drawn as ``?``.
+"""
+import logging
+from pypdf.generic import ArrayObject, DecodedStreamObject, DictionaryObject, IndirectObject, NameObject, StreamObject
+
+log = logging.getLogger(__name__)
+
+MULTILINE, COMB = 1 << 12, 1 << 24
+HIDDEN = 2 | 32  # annotation flags Hidden and NoView
+# Metrics for a core font without a descriptor (Helvetica)
+CORE_WIDTH, CORE_ASCENT, CORE_BBOX = 556, 718, (-166, -225, 1000, 931)
+
+
+def _get(d, key, default=None):
+    # DictionaryObject.get does not resolve indirect references
+    v = d.get(key, default)
+    return v.get_object() if isinstance(v, IndirectObject) else v
+
+
+def _num(x):
+    return b"%d" % x if x == int(x) else (b"%.3f" % x).rstrip(b"0")
+
+
+def _escape(b):
+    return b.replace(b"\\", b"\\\\").replace(b"(", b"\\(").replace(b")", b"\\)")
+
+
+class FontMetrics:
+    """Widths and vertical metrics of a simple (8-bit, WinAnsi) font, in text space units per 1pt."""
+
+    def __init__(self, font):
+        first, widths = font.get("/FirstChar", 0), _get(font, "/Widths") or []
+        desc = _get(font, "/FontDescriptor") or {}
+        self.widths = [desc.get("/MissingWidth", CORE_WIDTH if not widths else 0) / 1000] * 256
+        for i, w in enumerate(widths):
+            if 0 <= first + i < 256: self.widths[first + i] = w / 1000
+        bbox = [float(v) for v in _get(desc, "/FontBBox", CORE_BBOX)]
+        self.ascent = float(desc.get("/Ascent", CORE_ASCENT if not desc else bbox[3])) / 1000
+        self.top = bbox[3] / 1000
+        self.leading = (bbox[3] - bbox[1]) / 1000
+
+    def width(self, b):
+        w = self.widths
+        return sum(w[c] for c in b)
+
+
+class _Appearance:
+    """A widget drawn from its existing appearance streams, by state."""
+
+    def __init__(self, states, default):
+        self.states, self.default = states, default
+
+    def draw(self, value):
+        if value is None: return self.default
+        return self.states.get(value, self.default if not self.states else b"")
+
+
+class _Text:
+    """A text or combo box widget, laid out like pypdf's generated appearance."""
+
+    def __init__(self, x, y, w, h, font, metrics, size, color, align, multiline, comb, default):
+        self.w, self.h, self.metrics, self.size, self.align = w, h, metrics, size, align
+        self.multiline, self.comb, self.default = multiline, comb, default
+        self.font, self.color = font, color
+        self.head = b"q 1 0 0 1 %s %s cm 2 0 %s %s re W n BT\n" % (_num(x), _num(y), _num(round(w - 6, 3)),
+                                                                    _num(round(h, 3)))
+
+    def draw(self, value):
+        if value is None: return self.default
+        m, size, w = self.metrics, self.size, self.w
+        text = value.encode("cp1252", "replace")
+        if not size:
+            if self.multiline:
+                size = 12
+            else:
+                size = round(max(min(self.h / m.leading, (w - 4) / (m.width(text) or 1)), 4.0), 1)
+        if self.comb:
+            lines = [text[i:i + 1] for i in range(min(len(text), self.comb))]
+        else:
+            lines = text.splitlines() or [b""]
+        if self.multiline:
+            y = self.h - m.top * size
+        else:
+            y = (self.h - m.ascent * size) / 2
+        out = [self.head, b"%s %s Tf %s\n" % (self.font, _num(size), self.color)]
+        cx = 0.0
+        for n, line in enumerate(lines):
+            lw = m.width(line) * size
+            if self.comb:
+                cell = w / self.comb
+                x = n * cell + (cell - lw) / 2
+            elif self.align == 2:
+                x = w - 2 - lw
+            elif self.align == 1:
+                x = (w - lw) / 2
+            else:
+                x = 2
+            dy = y if n == 0 else 0 if self.comb else -size * m.leading
+            out.append(b"%s %s Td (%s) Tj\n" % (_num(round(x - cx, 3)), _num(round(dy, 3)), _escape(line)))
+            cx = x
+        out.append(b"ET Q\n")
+        return b"".join(out)
+
+
+def _inherited(node, key, default=None):
+    # Field attributes (/FT, /Ff, /DA, /Q, /MaxLen) and page /Resources are inheritable
+    while key not in node and "/Parent" in node:
+        node = node["/Parent"]
+    return _get(node, key, default)
+
+
+def _parse_da(da):
+    """Font name, size and colour operator of a default appearance string."""
+    tokens = str(da or "").split()
+    font, size, color = "/Helv", 0.0, b"0 g"
+    for i, t in enumerate(tokens):
+        if t == "Tf" and i >= 2:
+            font, size = tokens[i - 2], float(tokens[i - 1])
+        elif t in ("g", "rg", "k"):
+            n = {"g": 1, "rg": 3, "k": 4}[t]
+            color = " ".join(tokens[i - n:i + 1]).encode()
+    return font, size, color
+
+
+def _placement(stream, rect):
+    """``cm`` operands that map an appearance stream's (transformed) /BBox onto the widget's /Rect."""
+    x1, y1, x2, y2 = (float(v) for v in stream["/BBox"])
+    a, b, c, d, e, f = (float(v) for v in _get(stream, "/Matrix", (1, 0, 0, 1, 0, 0)))
+    xs = [a * x + c * y + e for x in (x1, x2) for y in (y1, y2)]
+    ys = [b * x + d * y + f for x in (x1, x2) for y in (y1, y2)]
+    sx = (rect[2] - rect[0]) / ((max(xs) - min(xs)) or 1)
+    sy = (rect[3] - rect[1]) / ((max(ys) - min(ys)) or 1)
+    return sx, sy, rect[0] - min(xs) * sx, rect[1] - min(ys) * sy
+
+
+class FlattenTemplate:
+    """Per-template caches for flattened output: font metrics, widget drawing and page resources."""
+
+    def __init__(self, template, manifest):
+        self.template = template
+        field_of = {idnum: name for name, entry in manifest["fields"].items() for idnum, _ in entry["widgets"]}
+        acroform = _get(template._root_object, "/AcroForm") or {}
+        dr_fonts = _get(_get(acroform, "/DR") or {}, "/Font") or {}
+        self.fonts = {}  # DA font name -> (resource name, font ref, FontMetrics)
+        self.pages = {}  # page index -> (widgets [(field, drawer)], resources, annots)
+        self.widgets = 0
+        for index, page in enumerate(template.flattened_pages):
+            xobjects, fonts, widgets, annots = {}, {}, [], ArrayObject()
+            all_annots = _get(page, "/Annots") or []
+            for ref in all_annots:
+                annot = ref.get_object()
+                if annot.get("/Subtype") != "/Widget":
+                    annots.append(ref)
+                    continue
+                if annot.get("/F", 0) & HIDDEN: continue
+                idnum = ref.idnum if isinstance(ref, IndirectObject) else None
+                widgets.append((field_of.get(idnum), self._drawer(annot, acroform, dr_fonts, xobjects, fonts)))
+            if not widgets and len(annots) == len(all_annots): continue
+            resources = DictionaryObject(_inherited(page, "/Resources") or {})
+            for key, new in (("/XObject", xobjects), ("/Font", fonts)):
+                if not new: continue
+                merged = DictionaryObject(_get(resources, key) or {})
+                merged.update(new)
+                resources[NameObject(key)] = merged
+            self.pages[index] = (widgets, resources, annots)
+            self.widgets += len(widgets)
+        # Only the catalog and the pages are modified, so a clone need copy nothing else
+        self.mutable = sorted({template._root_object.indirect_reference.idnum} |
+                              {template.flattened_pages[i].indirect_reference.idnum for i in self.pages})
+
+    def _font(self, name, dr_fonts):
+        entry = self.fonts.get(name)
+        if entry is None:
+            if name not in dr_fonts:
+                log.warning(f"Font {name} is not in the form's /DR; flattening with /Helv")
+                return self._font("/Helv", dr_fonts) if name != "/Helv" and "/Helv" in dr_fonts else None
+            ref = dr_fonts.raw_get(name)
+            entry = self.fonts[name] = (f"/FlF{len(self.fonts)}", ref, FontMetrics(ref.get_object()))
+        return entry
+
+    def _drawer(self, annot, acroform, dr_fonts, xobjects, fonts):
+        rect = [float(v) for v in annot["/Rect"]]
+        rect = [min(rect[0], rect[2]), min(rect[1], rect[3]), max(rect[0], rect[2]), max(rect[1], rect[3])]
+
+        def do(ref):
+            stream = ref.get_object()
+            if not isinstance(stream, StreamObject) or "/BBox" not in stream: return b""
+            name = f"/FlX{ref.idnum}"
+            xobjects[NameObject(name)] = ref
+            return b"q %s 0 0 %s %s %s cm %s Do Q\n" % (*(_num(round(v, 4)) for v in _placement(stream, rect)),
+                                                         name.encode())
+
+        ap = _get(annot, "/AP") or {}
+        normal, normal_raw = _get(ap, "/N"), ap.get("/N")
+        if isinstance(normal, StreamObject):
+            default, states = do(normal_raw), {}
+        elif isinstance(normal, DictionaryObject):
+            states = {str(k): do(normal.raw_get(k)) for k in normal}
+            default = states.get(str(annot.get("/AS", "/Off")), b"")
+        else:
+            default, states = b"", {}
+        if _inherited(annot, "/FT") not in ("/Tx", "/Ch"):
+            return _Appearance(states, default)
+
+        font, size, color = _parse_da(_inherited(annot, "/DA", acroform.get("/DA")))
+        entry = self._font(font, dr_fonts)
+        if entry is None: return _Appearance(states, default)
+        res_name, ref, metrics = entry
+        fonts[NameObject(res_name)] = ref
+        flags = _inherited(annot, "/Ff", 0)
+        comb = int(_inherited(annot, "/MaxLen", 0)) if flags & COMB else 0
+        return _Text(rect[0], rect[1], rect[2] - rect[0], rect[3] - rect[1], res_name.encode(), metrics, size,
+                     color, int(_inherited(annot, "/Q", 0)), bool(flags & MULTILINE), comb, default)
+
+    def apply(self, writer, fields):
+        """Draw ``fields`` (a ``FieldBatch``) into the pages of ``writer`` and remove the form.
+
+        ``writer`` is a clone with at least ``self.mutable`` copied.
+        """
+        values = fields.values
+        save = DecodedStreamObject()
+        save.set_data(b"q\n")
+        save = writer._add_object(save)
+        for index, (widgets, resources, annots) in self.pages.items():
+            page = writer.flattened_pages[index]
+            ops = [b"Q\n"]
+            for field, drawer in widgets:
+                ops.append(drawer.draw(values.get(field)))
+            stream = DecodedStreamObject()
+            stream.set_data(b"".join(ops))
+            contents = page.raw_get("/Contents") if "/Contents" in page else ArrayObject()
+            if isinstance(contents, IndirectObject) and not isinstance(contents.get_object(), StreamObject):
+                contents = contents.get_object()
+            contents = list(contents) if isinstance(contents, ArrayObject) else [contents]
+            # The original content is wrapped in q/Q so whatever state it leaves cannot shift the widgets
+            page[NameObject("/Contents")] = ArrayObject([save, *contents, writer._add_object(stream)])
+            page[NameObject("/Resources")] = resources
+            if annots:
+                page[NameObject("/Annots")] = annots
+            elif "/Annots" in page:
+                del page["/Annots"]
+        if "/AcroForm" in writer._root_object:
+            del writer._root_object["/AcroForm"]
@@ -0,0 +1,64 @@
+"""Batched AcroForm filling.
+
+``fill_i129`` used to call ``update_page_form_field_values`` once per field,
+and each call walked every annotation on the page.  ``FieldBatch`` collects the
+whole field map first and writes every widget exactly once, going straight to
+the widget objects listed in the field manifest (see ``field_manifest.py``).
+"""
+import copy, logging
+from pypdf.generic import ArrayObject, IndirectObject, NameObject
+
+log = logging.getLogger(__name__)
+
+
+class FieldBatch:
+    """Field name → value map for one document, applied in a single pass."""
+
+    def __init__(self, manifest):
+        self.fields = manifest["fields"]
+        self.values = {}
+        self.touched = set()  # object numbers of the field/widget dictionaries written to
+
+    def set(self, key, value):
+        if not value or key not in self.fields: return
+        self.values[key] = str(value)
+
+    def __len__(self):
+        return len(self.values)
+
+    def by_page(self):
+        pages = {}
+        for key, value in self.values.items():
+            pages.setdefault(self.fields[key]["page"], {})[key] = value
+        return pages
+
+    def apply(self, writer):
+        writer.set_need_appearances_writer(False)
+        # Write in first-set order so new appearance streams are numbered
+        # exactly as the old one-call-per-field code numbered them
+        stubs = {}
+        for key, value in self.values.items():
+            entry = self.fields[key]
+            stub = stubs.get(entry["page"])
+            if stub is None:
+                stub = stubs[entry["page"]] = copy.copy(writer.pages[entry["page"]])
+            for idnum, gen in entry["widgets"]:
+                ref = IndirectObject(idnum, gen, writer)
+                stub[NameObject("/Annots")] = ArrayObject([ref])
+                self.touched.add(idnum)
+                annot = ref.get_object()
+                if not ("/FT" in annot and "/T" in annot) and "/Parent" in annot:
+                    self.touched.add(annot.raw_get("/Parent").idnum)
+                try:
+                    writer.update_page_form_field_values(stub, {key: value}, auto_regenerate=None)
+                except Exception as e:
+                    log.warning(f"Could not set {key}: {e}")
+
+
+def prefill(writer, manifest, values):
+    """Write ``values`` (field name → value) into a template writer once; returns the applied batch."""
+    batch = FieldBatch(manifest)
+    for key, value in values.items():
+        batch.set(key, value)
+    batch.apply(writer)
+    return batch
@@ -0,0 +1,117 @@
+"""Incremental-update output for filled forms.
+
+Instead of re-serializing the whole 2.3 MB template, the original bytes are
+copied through from a memory map and a PDF incremental-update section is
+appended.  That section holds only the objects that filling changed (field and
+widget dictionaries, new appearance streams and the AcroForm without /XFA) plus
+a cross-reference section pointing back at the original one.
+
+The template is encrypted (empty user password), so appended objects are
+encrypted with the original file key.  The original uses cross-reference
+streams, so the update does too.
+"""
+import mmap, struct, time
+from pypdf import PdfReader, PdfWriter
+from pypdf.generic import ArrayObject, NameObject, NumberObject, StreamObject
+from field_manifest import build_manifest
+from form_fill import prefill
+from template_cache import _mutable_ids, clone_writer
+
+
+class IncrementalTemplate:
+    """The template opened with its original object numbering, ready to clone and append to."""
+
+    def __init__(self, path, constants=None):
+        t = time.perf_counter()
+        self.path = path
+        with open(path, "rb") as fh:
+            self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+        # incremental=True needs pypdf>=5; _encryption, _startxref and the
+        # writer's _original_hash are internals, hence the pypdf>=6.20,<7 pin.
+        reader = PdfReader(path)
+        if reader.is_encrypted:
+            reader.decrypt("")
+        self.encryption = reader._encryption
+        self.prev = reader._startxref
+        self.trailer = {k: reader.trailer.raw_get(k) for k in ("/Root", "/Encrypt", "/Info", "/ID")
+                        if k in reader.trailer}
+
+        writer = PdfWriter(reader, incremental=True)
+        acroform = writer._root_object["/AcroForm"].get_object()
+        if "/XFA" in acroform:
+            del acroform["/XFA"]
+        self.manifest = build_manifest(writer, path)
+        baked = prefill(writer, self.manifest, constants or {})
+        self.writer = writer
+        self.mutable = _mutable_ids(writer)
+        self._mutable_set = set(self.mutable)
+        # Objects the prepared template already differs in: the AcroForm (minus /XFA), the
+        # fields holding baked constants and any appearance streams baking created
+        self.base_changed = {i + 1 for i, (obj, h) in enumerate(zip(writer._objects, writer._original_hash))
+                             if obj is not None and obj.hash_bin() != h}
+        self.base_changed |= baked.touched | set(range(len(writer._original_hash) + 1, len(writer._objects) + 1))
+        self.load_ms = (time.perf_counter() - t) * 1000
+
+    def checkout(self):
+        return clone_writer(self.writer, self.mutable), self.manifest
+
+    def changed_ids(self, writer, touched):
+        """Objects to append: template-level changes, ``touched`` fields, replaced and new objects.
+
+        Content hashes can't be compared here because ``clone_writer`` re-binds
+        references and pypdf hashes references by owning document.
+        """
+        template = self.writer._objects
+        ids = self.base_changed | set(touched)
+        ids.add(writer._root_object["/AcroForm"].indirect_reference.idnum)
+        ids.update(i + 1 for i, (a, b) in enumerate(zip(writer._objects, template)) if a is not b and i + 1 not in self._mutable_set)
+        ids.update(range(len(template) + 1, len(writer._objects) + 1))
+        return sorted(i for i in ids if writer._objects[i - 1] is not None)
+
+    def write(self, writer, touched, out):
+        """Write the original file followed by an update section for ``writer``'s changes."""
+        out = _Counting(out)
+        out.write(self.mm)
+        if self.mm[-1:] not in (b"\n", b"\r"):
+            out.write(b"\n")
+
+        offsets = {}
+        for idnum in self.changed_ids(writer, touched):
+            obj = writer._objects[idnum - 1]
+            if self.encryption is not None:
+                obj = self.encryption.encrypt_object(obj, idnum, 0)
+            offsets[idnum] = out.pos
+            out.write(f"{idnum} 0 obj\n".encode())
+            obj.write_to_stream(out)
+            out.write(b"\nendobj\n")
+
+        xref_id = len(writer._objects) + 1
+        offsets[xref_id] = xref_pos = out.pos
+        index, rows = [], []
+        for idnum in sorted(offsets):
+            if index and index[-2] + index[-1] == idnum:
+                index[-1] += 1
+            else:
+                index += [idnum, 1]
+            rows.append(struct.pack(">BIH", 1, offsets[idnum], 0))
+        xref = StreamObject()
+        xref.update({NameObject("/Type"): NameObject("/XRef"), NameObject("/Size"): NumberObject(xref_id + 1),
+                     NameObject("/Index"): ArrayObject(NumberObject(n) for n in index),
+                     NameObject("/W"): ArrayObject(NumberObject(n) for n in (1, 4, 2)),
+                     NameObject("/Prev"): NumberObject(self.prev)})
+        for k, v in self.trailer.items():
+            xref[NameObject(k)] = v
+        xref.set_data(b"".join(rows))
+        out.write(f"{xref_id} 0 obj\n".encode())
+        xref.write_to_stream(out)
+        out.write(f"\nendobj\nstartxref\n{xref_pos}\n%%EOF\n".encode())
+
+
+class _Counting:
+    # Tracks byte offsets for the xref without needing a seekable output
+    def __init__(self, out):
+        self.out, self.pos = out, 0
+
+    def write(self, b):
+        self.out.write(b)
+        self.pos += len(b)
@@ -0,0 +1,198 @@
+"""Asynchronous petition jobs for ``POST /jobs`` / ``GET /jobs/<id>``.
+
+A job is a row in a SQLite database plus, once finished, ``<id>.pdf`` next to
+it.  Both live in one directory shared by every gunicorn worker, so any worker
+can answer a status poll.  Fills run in a fork-based process pool in the
+worker that accepted the job.  The child writes the PDF and marks the row done,
+so the document never travels back through a pipe.
+
+Backpressure is global: once ``capacity`` jobs are queued or running across all
+workers, new submissions are refused.  Finished jobs (and their PDFs) are
+deleted ``ttl`` seconds after completion.  Jobs whose worker died are marked
+failed the next time anyone sweeps.
+"""
+import concurrent.futures as cf
+import contextlib, logging, multiprocessing, os, re, sqlite3, tempfile, threading, time, uuid
+
+log = logging.getLogger(__name__)
+
+JOB_ID = re.compile(r"[0-9a-f]{32}")
+PENDING = ("queued", "running")
+COUNT_PENDING = "SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')"
+
+
+class QueueFull(Exception):
+    pass
+
+
+class JobStore:
+    def __init__(self, directory, ttl=3600.0):
+        self.directory = directory
+        self.ttl = ttl
+        self.path = os.path.join(directory, "jobs.sqlite3")
+        os.makedirs(directory, exist_ok=True)
+        with self._db() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, status TEXT NOT NULL, mode TEXT, filename TEXT, owner INTEGER,
+                created REAL NOT NULL, started REAL, finished REAL, bytes INTEGER, error TEXT)""")
+            db.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+
+    @contextlib.contextmanager
+    def _db(self):
+        # One short-lived connection per operation: safe across fork and threads
+        db = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        db.row_factory = sqlite3.Row
+        try:
+            yield db
+        finally:
+            db.close()
+
+    def pdf_path(self, job_id):
+        return os.path.join(self.directory, f"{job_id}.pdf")
+
+    def create(self, job_id, mode, filename, capacity=None):
+        """Insert a queued job; raises ``QueueFull`` if ``capacity`` jobs are already pending.
+
+        The count and the insert are one write transaction, so workers submitting
+        at the same time cannot both take the last slot.
+        """
+        with self._db() as db:
+            db.execute("BEGIN IMMEDIATE")
+            try:
+                if capacity is not None and db.execute(COUNT_PENDING).fetchone()[0] >= capacity:
+                    raise QueueFull(f"{capacity} jobs already pending")
+                db.execute("INSERT INTO jobs (id, status, mode, filename, owner, created) VALUES (?, 'queued', ?, ?, ?, ?)",
+                           (job_id, mode, filename, os.getpid(), time.time()))
+            except BaseException:
+                db.execute("ROLLBACK")
+                raise
+            db.execute("COMMIT")
+
+    def mark(self, job_id, status, **cols):
+        cols["status"] = status
+        with self._db() as db:
+            db.execute(f"UPDATE jobs SET {', '.join(f'{k} = ?' for k in cols)} WHERE id = ?",
+                       (*cols.values(), job_id))
+
+    def get(self, job_id):
+        if not JOB_ID.fullmatch(job_id or ""): return None
+        with self._db() as db:
+            row = db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return dict(row) if row else None
+
+    def pending(self):
+        with self._db() as db:
+            return db.execute(COUNT_PENDING).fetchone()[0]
+
+    def put_pdf(self, job_id, pdf_bytes):
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb") as fh:
+            fh.write(pdf_bytes)
+        os.replace(tmp, self.pdf_path(job_id))
+
+    def sweep(self):
+        """Delete expired jobs and fail pending ones whose worker no longer exists."""
+        now = time.time()
+        with self._db() as db:
+            expired = [r[0] for r in db.execute("SELECT id FROM jobs WHERE finished IS NOT NULL AND finished < ?",
+                                                (now - self.ttl,))]
+            for job_id in expired:
+                with contextlib.suppress(FileNotFoundError): os.remove(self.pdf_path(job_id))
+                db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            for job_id, owner in db.execute("SELECT id, owner FROM jobs WHERE status IN ('queued', 'running')").fetchall():
+                if not _alive(owner):
+                    db.execute("UPDATE jobs SET status = 'failed', error = 'worker exited', finished = ? WHERE id = ?",
+                               (now, job_id))
+        return len(expired)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        pass
+    return True
+
+
+def _run(store, job_id, fn, data, mode):
+    # Runs in a pool process
+    store.mark(job_id, "running", started=time.time())
+    try:
+        pdf = fn(data, mode)
+        store.put_pdf(job_id, pdf)
+    except Exception as e:
+        store.mark(job_id, "failed", finished=time.time(), error=f"{type(e).__name__}: {e}")
+        raise
+    store.mark(job_id, "done", finished=time.time(), bytes=len(pdf))
+    return len(pdf)
+
+
+class JobQueue:
+    """Accepts jobs into ``store`` and runs ``fn(data, mode) -> pdf bytes`` in a process pool."""
+
+    def __init__(self, fn, store, processes=2, capacity=20, on_done=None, sweep_interval=30.0):
+        self.fn = fn
+        self.store = store
+        self.processes = processes
+        self.capacity = capacity
+        self.on_done = on_done
+        self.sweep_interval = sweep_interval
+        self._pool = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._last_sweep = 0.0
+
+    def _executor(self):
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():
+                self._pool = cf.ProcessPoolExecutor(self.processes, mp_context=multiprocessing.get_context("fork"))
+                self._pid = os.getpid()
+            return self._pool
+
+    def maybe_sweep(self):
+        if time.monotonic() - self._last_sweep < self.sweep_interval: return
+        self._last_sweep = time.monotonic()
+        try:
+            self.store.sweep()
+        except sqlite3.Error as e:
+            log.warning(f"Job sweep failed: {e}")
+
+    def submit(self, data, mode, filename):
+        """Queue one fill and return its job id; raises ``QueueFull`` when at capacity."""
+        self.maybe_sweep()
+        job_id = uuid.uuid4().hex
+        self.store.create(job_id, mode, filename, self.capacity)
+        try:
+            fut = self._executor().submit(_run, self.store, job_id, self.fn, data, mode)
+        except Exception as e:
+            self.store.mark(job_id, "failed", finished=time.time(), error=str(e))
+            raise
+        fut.add_done_callback(lambda f: self._finished(f, job_id, data))
+        return job_id
+
+    def _finished(self, fut, job_id, data):
+        try:
+            fut.result()
+        except cf.process.BrokenProcessPool as e:
+            self.store.mark(job_id, "failed", finished=time.time(), error=f"fill process died: {e}")
+            with self._lock:
+                self._pool = None
+            return
+        except Exception:
+            return  # already recorded by _run
+        if self.on_done:
+            try:
+                self.on_done(job_id, data)
+            except Exception as e:
+                log.warning(f"Job {job_id} completion hook failed: {e}")
+
+    def stats(self):
+        try:
+            pending = self.store.pending()
+        except sqlite3.Error:
+            pending = None
+        return {"pending": pending, "capacity": self.capacity, "processes": self.processes,
+                "ttl": self.store.ttl}
@@ -0,0 +1,223 @@
+"""Background delivery of submission e-mails.
+
+``/fill`` used to open an SMTP connection, STARTTLS, log in and upload the
+PDF before answering.  ``Mailer.submit`` now only puts the job on a bounded
+in-process queue.  Worker threads keep one authenticated connection each and
+reuse it between messages.  Failed sends are retried with exponential
+backoff, and messages that still fail (or don't fit in the queue) are written
+to a dead-letter directory as ``.eml`` files so they can be resent by hand.
+"""
+import collections, email.mime.application, email.mime.multipart, email.mime.text
+import atexit, json, logging, os, queue, smtplib, threading, time, uuid
+
+log = logging.getLogger(__name__)
+
+
+def build_message(sender, to, data, pdf_bytes):
+    if not isinstance(pdf_bytes, bytes):
+        pdf_bytes = pdf_bytes.getvalue()  # a PdfSpool shared with the HTTP response
+    msg = email.mime.multipart.MIMEMultipart()
+    msg["From"] = sender; msg["To"] = to
+    ben = f"{data.get('benFirstName','')} {data.get('benLastName','')}".strip()
+    msg["Subject"] = f"I-129 Submission – {ben} | {data.get('classification','')}"
+    pet = data.get("companyName","") or f"{data.get('petFirstName','')} {data.get('petLastName','')}".strip()
+    msg.attach(email.mime.text.MIMEText(f"New I-129\nPetitioner: {pet}\nBeneficiary: {ben}\nClassification: {data.get('classification','')}\nJob: {data.get('jobTitle','')}\nDates: {data.get('startDate','')} to {data.get('endDate','')}\n"))
+    att = email.mime.application.MIMEApplication(pdf_bytes, _subtype="pdf")
+    att.add_header("Content-Disposition","attachment",filename=f"I-129_{ben.replace(' ','_')}.pdf")
+    msg.attach(att)
+    return msg
+
+
+class _Job:
+    __slots__ = ("id", "data", "pdf", "attempts", "queued_at", "error")
+
+    def __init__(self, data, pdf):
+        self.id = uuid.uuid4().hex
+        self.data, self.pdf = data, pdf
+        self.attempts = 0
+        self.queued_at = time.monotonic()
+        self.error = None
+
+
+class Mailer:
+    """Bounded queue + worker threads delivering over reused SMTP connections."""
+
+    def __init__(self, host, port, user, password, to, starttls=True, queue_size=100, workers=1,
+                 max_attempts=5, retry_base=2.0, idle_timeout=60.0, deadletter_dir="deadletter",
+                 connect_timeout=30.0):
+        self.host, self.port, self.user, self.password, self.to = host, port, user, password, to
+        self.starttls = starttls
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.idle_timeout = idle_timeout
+        self.deadletter_dir = deadletter_dir
+        self.connect_timeout = connect_timeout
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._latencies = collections.deque(maxlen=500)
+        self._retrying = {}  # job id -> (Timer, job) waiting out a backoff, outside the queue
+        self.counts = collections.Counter()
+        self._pid = None
+
+    @property
+    def configured(self):
+        return all([self.host, self.user, self.password, self.to])
+
+    def submit(self, data, pdf_bytes):
+        """Queue one notification; never blocks the caller."""
+        if not self.configured: return False
+        self._ensure_started()
+        job = _Job(data, pdf_bytes)
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            job.error = "queue full"
+            self._count("dropped")
+            self._dead_letter(job)
+            return False
+        self._count("queued")
+        return True
+
+    def _ensure_started(self):
+        # Threads don't survive gunicorn's fork, so start them in the worker that uses them
+        if self._pid == os.getpid(): return
+        with self._start_lock:
+            if self._pid == os.getpid(): return
+            self._threads = [threading.Thread(target=self._run, name=f"mailer-{i}", daemon=True)
+                             for i in range(self.workers)]
+            for t in self._threads: t.start()
+            self._pid = os.getpid()
+
+    def _count(self, key, n=1):
+        with self._stats_lock:
+            self.counts[key] += n
+
+    # ── worker ────────────────────────────────────────────────────
+    def _connect(self):
+        srv = smtplib.SMTP(self.host, self.port, timeout=self.connect_timeout)
+        if self.starttls: srv.starttls()
+        srv.login(self.user, self.password)
+        self._count("connections")
+        return srv
+
+    def _run(self):
+        srv, last_used = None, 0.0
+        while True:
+            try:
+                job = self._queue.get(timeout=self.idle_timeout if srv else None)
+            except queue.Empty:
+                srv = self._close(srv)
+                continue
+            if srv and time.monotonic() - last_used > self.idle_timeout:
+                srv = self._close(srv)
+            try:
+                msg = build_message(self.user, self.to, job.data, job.pdf)
+                reused = srv is not None
+                try:
+                    srv = srv or self._connect()
+                    srv.send_message(msg)
+                except (smtplib.SMTPServerDisconnected, ConnectionError):
+                    if not reused: raise
+                    # The kept-alive connection went stale; reconnect once before counting a failure
+                    srv = self._connect()
+                    srv.send_message(msg)
+                last_used = time.monotonic()
+                with self._stats_lock:
+                    self.counts["sent"] += 1
+                    self._latencies.append(last_used - job.queued_at)
+            except Exception as e:
+                srv = self._close(srv)
+                self._retry(job, e)
+            finally:
+                self._queue.task_done()
+
+    def _close(self, srv):
+        if srv is not None:
+            try: srv.quit()
+            except Exception: pass
+        return None
+
+    def _retry(self, job, exc):
+        job.attempts += 1
+        job.error = f"{type(exc).__name__}: {exc}"
+        if job.attempts >= self.max_attempts:
+            log.warning(f"Email failed after {job.attempts} attempts: {job.error}")
+            self._count("failed")
+            self._dead_letter(job)
+            return
+        delay = self.retry_base * 2 ** (job.attempts - 1)
+        log.info(f"Email attempt {job.attempts} failed ({job.error}); retrying in {delay:.0f}s")
+        self._count("retries")
+        t = threading.Timer(delay, self._requeue, [job])
+        t.daemon = True
+        with self._stats_lock:
+            self._retrying[job.id] = (t, job)
+        t.start()
+
+    def _requeue(self, job):
+        with self._stats_lock:
+            if self._retrying.pop(job.id, None) is None: return  # drain() has dead-lettered it
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            self._count("dropped")
+            self._dead_letter(job)
+
+    def _dead_letter(self, job):
+        try:
+            os.makedirs(self.deadletter_dir, exist_ok=True)
+            base = os.path.join(self.deadletter_dir, f"{time.strftime('%Y%m%dT%H%M%S')}-{job.id}")
+            with open(base + ".eml", "wb") as fh:
+                fh.write(build_message(self.user, self.to, job.data, job.pdf).as_bytes())
+            with open(base + ".json", "w") as fh:
+                json.dump({"error": job.error, "attempts": job.attempts, "data": job.data}, fh)
+            self._count("dead_lettered")
+        except Exception as e:
+            log.error(f"Could not dead-letter email {job.id}: {e}")
+
+    # ── lifecycle / metrics ───────────────────────────────────────
+    def drain(self, timeout=10.0):
+        """Wait for queued mail and due retries to go out, then dead-letter whatever is left."""
+        if self._pid != os.getpid(): return
+        deadline = time.monotonic() + timeout
+        while (self._queue.unfinished_tasks or self._retrying) and time.monotonic() < deadline:
+            time.sleep(0.05)
+        with self._stats_lock:
+            waiting, self._retrying = list(self._retrying.values()), {}
+        for timer, job in waiting:
+            timer.cancel()
+            self._dead_letter(job)
+        while True:
+            try: job = self._queue.get_nowait()
+            except queue.Empty: break
+            job.error = job.error or "shutdown before delivery"
+            self._dead_letter(job)
+            self._queue.task_done()
+
+    def stats(self):
+        with self._stats_lock:
+            lat = sorted(self._latencies)
+            counts = dict(self.counts)
+        pct = lambda p: round(lat[min(len(lat) - 1, int(p * len(lat)))] * 1000, 1) if lat else None
+        return {"configured": self.configured, "depth": self._queue.qsize(), "capacity": self._queue.maxsize,
+                "retrying": len(self._retrying),
+                "workers": len(self._threads), "latency_ms_p50": pct(0.5), "latency_ms_p95": pct(0.95),
+                **{k: counts.get(k, 0) for k in ("queued", "sent", "retries", "failed", "dropped",
+                                                  "dead_lettered", "connections")}}
+
+
+def from_env(environ=os.environ, base_dir="."):
+    m = Mailer(environ.get("SMTP_HOST",""), int(environ.get("SMTP_PORT","587")),
+               environ.get("SMTP_USER",""), environ.get("SMTP_PASS",""), environ.get("NOTIFY_EMAIL",""),
+               starttls=environ.get("SMTP_STARTTLS","1") != "0",
+               queue_size=int(environ.get("MAIL_QUEUE_SIZE","100")),
+               workers=int(environ.get("MAIL_WORKERS","1")),
+               max_attempts=int(environ.get("MAIL_MAX_ATTEMPTS","5")),
+               retry_base=float(environ.get("MAIL_RETRY_BASE","2")),
+               idle_timeout=float(environ.get("MAIL_IDLE_TIMEOUT","60")),
+               deadletter_dir=environ.get("MAIL_DEADLETTER_DIR", os.path.join(base_dir, "deadletter")))
+    atexit.register(m.drain, float(environ.get("MAIL_DRAIN_SECONDS","10")))
+    return m
@@ -0,0 +1,176 @@
+"""Per-phase timing shared across gunicorn workers, exported for Prometheus.
+
+Each process (gunicorn worker or batch child) adds its observations to its own
+memory-mapped file of float64 slots in ``METRICS_DIR``.  ``render`` sums every
+file in that directory, so ``/metrics`` reports the whole server whichever worker
+answers the scrape.  A file is kept after its process exits, so counters never
+go backwards.
+
+The default directory is keyed by process group, which gunicorn's master,
+its workers and their children all share, so a restarted server starts from zero.
+"""
+import contextlib, hashlib, mmap, os, re, struct, tempfile, threading, time
+
+_DIR_PREFIX = "i129-metrics-"
+
+
+def _default_dir():
+    root = tempfile.gettempdir()
+    # Remove directories left behind by process groups that no longer exist
+    for name in os.listdir(root):
+        m = re.fullmatch(_DIR_PREFIX + r"(\d+)", name)
+        if not m or int(m.group(1)) == os.getpgrp(): continue
+        try:
+            os.killpg(int(m.group(1)), 0)
+        except ProcessLookupError:
+            path = os.path.join(root, name)
+            for f in os.listdir(path):
+                with contextlib.suppress(OSError): os.remove(os.path.join(path, f))
+            with contextlib.suppress(OSError): os.rmdir(path)
+        except OSError:
+            pass
+    return os.path.join(root, f"{_DIR_PREFIX}{os.getpgrp()}")
+
+
+class _Store:
+    """Fixed-layout array of float64 slots, one mmap'ed file per process."""
+
+    def __init__(self):
+        self.size = 0
+        self.metrics = []
+        self.dir = None
+        self._pid = None
+        self._mm = None
+        self._lock = threading.Lock()
+
+    def allocate(self, metric, n):
+        self.metrics.append(metric)
+        start, self.size = self.size, self.size + n
+        return start
+
+    @property
+    def layout(self):
+        sig = "|".join(f"{m.name}:{m.labels}:{getattr(m, 'buckets', '')}" for m in self.metrics)
+        return hashlib.sha256(sig.encode()).hexdigest()[:12]
+
+    def _file(self):
+        # Opened lazily so each forked process gets its own file
+        if self._pid != os.getpid():
+            self.dir = self.dir or os.environ.get("METRICS_DIR") or _default_dir()
+            os.makedirs(self.dir, exist_ok=True)
+            path = os.path.join(self.dir, f"{self.layout}-{os.getpid()}.db")
+            with open(path, "a+b") as fh:
+                if os.path.getsize(path) < self.size * 8:
+                    fh.truncate(self.size * 8)
+                self._mm = mmap.mmap(fh.fileno(), self.size * 8)
+            self._pid = os.getpid()
+        return self._mm
+
+    def add(self, slot, amount):
+        with self._lock:
+            mm = self._file()
+            (v,) = struct.unpack_from("<d", mm, slot * 8)
+            struct.pack_into("<d", mm, slot * 8, v + amount)
+
+    def totals(self):
+        """Slot-wise sum over every process file with the current layout."""
+        self._file()
+        out = [0.0] * self.size
+        prefix = self.layout + "-"
+        for name in os.listdir(self.dir):
+            if not (name.startswith(prefix) and name.endswith(".db")): continue
+            try:
+                with open(os.path.join(self.dir, name), "rb") as fh:
+                    data = fh.read(self.size * 8)
+            except OSError:
+                continue
+            if len(data) < self.size * 8: continue
+            for i, v in enumerate(struct.unpack(f"<{self.size}d", data)):
+                out[i] += v
+        return out
+
+
+STORE = _Store()
+
+
+class Counter:
+    def __init__(self, name, help, label, values):
+        self.name, self.help, self.label, self.labels = name, help, label, tuple(values)
+        self._base = STORE.allocate(self, len(self.labels))
+
+    def inc(self, value, amount=1):
+        STORE.add(self._base + self.labels.index(value), amount)
+
+    def render(self, totals):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for i, v in enumerate(self.labels):
+            yield f'{self.name}_total{{{self.label}="{v}"}} {totals[self._base + i]:g}'
+
+
+class Histogram:
+    def __init__(self, name, help, label, values, buckets):
+        self.name, self.help, self.label, self.labels = name, help, label, tuple(values)
+        self.buckets = tuple(buckets)
+        self._width = len(self.buckets) + 2  # per-bucket counts, +Inf, sum
+        self._base = STORE.allocate(self, len(self.labels) * self._width)
+
+    def observe(self, value, seconds):
+        base = self._base + self.labels.index(value) * self._width
+        i = next((i for i, b in enumerate(self.buckets) if seconds <= b), len(self.buckets))
+        STORE.add(base + i, 1)
+        STORE.add(base + self._width - 1, seconds)
+
+    def render(self, totals):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for n, v in enumerate(self.labels):
+            base = self._base + n * self._width
+            cumulative = 0
+            for i, b in enumerate(self.buckets + ("+Inf",)):
+                cumulative += totals[base + i]
+                yield f'{self.name}_bucket{{{self.label}="{v}",le="{b}"}} {cumulative:g}'
+            yield f'{self.name}_sum{{{self.label}="{v}"}} {totals[base + self._width - 1]:.6f}'
+            yield f'{self.name}_count{{{self.label}="{v}"}} {cumulative:g}'
+
+
+# ══ METRICS ══════════════════════════════════════════════════════
+# template_*: one-off per process load; the rest are per request
+PHASES = ("template_parse", "template_append", "template_manifest", "template_bake", "validate", "clone", "map_fields",
+          "fill_fields", "write", "cache", "email")
+PHASE_SECONDS = Histogram("i129_phase_seconds", "Time spent per fill phase", "phase", PHASES,
+                          (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10))
+ENDPOINTS = ("fill", "fill_batch", "create_job", "get_job", "preview", "test", "other")
+REQUEST_SECONDS = Histogram("i129_request_seconds", "Time to produce a response (streamed bodies excluded)",
+                            "endpoint", ENDPOINTS, (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60))
+RESULT_CACHE = Counter("i129_result_cache", "Result cache lookups for /fill", "result", ("hit", "miss"))
+
+
+def render():
+    totals = STORE.totals()
+    return "\n".join(line for m in STORE.metrics for line in m.render(totals)) + "\n"
+
+
+class Timings:
+    """Phase timings for one request: observed into ``PHASE_SECONDS`` and kept for ``Server-Timing``."""
+
+    def __init__(self):
+        self.ms = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - t)
+
+    def add(self, name, seconds):
+        self.ms[name] = self.ms.get(name, 0.0) + seconds * 1000
+        PHASE_SECONDS.observe(name, seconds)
+
+    def server_timing(self, total_s=None):
+        parts = [f"{k};dur={v:.1f}" for k, v in self.ms.items()]
+        if total_s is not None:
+            parts.append(f"total;dur={total_s * 1000:.1f}")
+        return ", ".join(parts)
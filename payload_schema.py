@@ -0,0 +1,244 @@
+"""Validation and normalization of questionnaire payloads, ahead of any PDF work.
+
+``app.PAYLOAD_SCHEMA`` maps payload keys to field types:
+
+- ``Str(max_len)``: a string (numbers are accepted), whitespace collapsed
+  unless ``multiline``;
+- ``Code(pattern, description, max_len, strip, upper)``: an identifier such
+  as a FEIN or receipt number, matched after removing ``strip`` characters;
+- ``Enum(*values)``: one of ``values``, matched case-insensitively;
+- ``YesNo()``: ``"yes"`` or ``"no"`` from booleans, 1/0, y/n, true/false;
+- ``Date(*literals)``: ``YYYY-MM-DD`` or ``MM/DD/YYYY``, written as the form's
+  ``MM/DD/YYYY`` (``iso=True`` keeps ``YYYY-MM-DD``);
+- ``Unit(companion)``: an apartment, suite or floor number; a leading
+  designator (``Suite 400``) is dropped and its kind stored under ``companion``;
+- ``Integer(lo, hi)``, ``Amount(max_len)`` and ``Email()``.
+
+Every type has a ``max_len``, the longest value it returns, which
+``Schema.overflows`` checks against the form fields a key fills.
+``compile_schema`` turns the table into a ``Schema``, one normalizer per key.
+``Schema.validate`` returns a normalized copy of the payload or raises
+``PayloadError`` listing every bad key.  Keys the schema does not know pass
+through unchanged.  Empty values (``""`` or ``null``) are always accepted as
+``""``: no answer is required.
+"""
+import datetime, re
+
+MAX_TEXT = 200  # default for Str without a max_len
+
+
+class PayloadError(ValueError):
+    def __init__(self, errors):
+        self.errors = errors  # [{"field": key, "error": message}]
+        super().__init__("; ".join(f"{e['field']}: {e['error']}" for e in errors))
+
+
+class Invalid(ValueError):
+    pass
+
+
+def _str(value):
+    # Scalars a JSON client may reasonably send for a text answer
+    if isinstance(value, str): return value.strip()
+    if isinstance(value, bool): raise Invalid("must be a string, not a boolean")
+    if isinstance(value, int): return str(value)
+    if isinstance(value, float): return str(int(value)) if value.is_integer() else repr(value)
+    raise Invalid(f"must be a string, not {type(value).__name__}")
+
+
+class Str:
+    def __init__(self, max_len=MAX_TEXT, multiline=False):
+        self.max_len, self.multiline = max_len, multiline
+
+    def __call__(self, value):
+        s = _str(value)
+        s = "\n".join(" ".join(line.split()) for line in s.splitlines()) if self.multiline else " ".join(s.split())
+        if len(s) > self.max_len: raise Invalid(f"is {len(s)} characters long; at most {self.max_len} fit")
+        return s
+
+
+class Code:
+    """An identifier: ``strip`` characters removed, optionally upper-cased, then matched against ``pattern``."""
+
+    def __init__(self, pattern, description, max_len, strip=" -", upper=True, literals=()):
+        self.pattern, self.description, self.max_len = re.compile(pattern, re.ASCII), description, max_len
+        self.strip, self.upper = str.maketrans("", "", strip), upper
+        self.literals = {v.lower(): v for v in literals}
+
+    def __call__(self, value):
+        s = _str(value)
+        literal = self.literals.get(s.lower())
+        if literal: return literal
+        s = s.translate(self.strip)
+        if self.upper: s = s.upper()
+        if len(s) > self.max_len or not self.pattern.fullmatch(s): raise Invalid(f"must be {self.description}")
+        return s
+
+
+class Enum:
+    def __init__(self, *values):
+        self.values = {str(v).lower(): v for v in values}
+        self.max_len = max(len(str(v)) for v in values)
+
+    def __call__(self, value):
+        v = self.values.get(_str(value).lower())
+        if v is None: raise Invalid(f"must be one of {', '.join(map(repr, self.values.values()))}")
+        return v
+
+
+class YesNo:
+    max_len = 3
+    WORDS = {"yes": "yes", "y": "yes", "true": "yes", "1": "yes", "no": "no", "n": "no", "false": "no", "0": "no"}
+
+    def __call__(self, value):
+        if isinstance(value, bool): return "yes" if value else "no"
+        v = self.WORDS.get(_str(value).lower())
+        if v is None: raise Invalid("must be yes or no")
+        return v
+
+
+class Date:
+    """A calendar date as ``YYYY-MM-DD`` or ``MM/DD/YYYY``, or one of ``literals`` (such as ``D/S``)."""
+    FORMATS = (re.compile(r"(\d{4})-(\d{1,2})-(\d{1,2})", re.ASCII), re.compile(r"(\d{1,2})/(\d{1,2})/(\d{4})", re.ASCII))
+
+    def __init__(self, *literals, iso=False):
+        self.literals = {v.lower(): v for v in literals}
+        self.iso = iso
+        self.max_len = max([10, *map(len, literals)])
+
+    def __call__(self, value):
+        s = _str(value)
+        literal = self.literals.get(s.lower())
+        if literal: return literal
+        m = self.FORMATS[0].fullmatch(s)
+        if m:
+            y, mo, d = m.groups()
+        else:
+            m = self.FORMATS[1].fullmatch(s)
+            if not m: raise Invalid("must be a date as YYYY-MM-DD or MM/DD/YYYY")
+            mo, d, y = m.groups()
+        try:
+            day = datetime.date(int(y), int(mo), int(d))
+        except ValueError:
+            raise Invalid(f"{s!r} is not a calendar date")
+        if not 1900 <= day.year <= 2200: raise Invalid(f"year {day.year} is out of range")
+        return day.isoformat() if self.iso else f"{day.month:02d}/{day.day:02d}/{day.year}"
+
+
+class Unit:
+    """An Apt/Ste/Flr number, returned with its kind (``apt``, ``ste``, ``flr`` or ``""``) for ``companion``."""
+    KINDS = {"apt": "apt", "apartment": "apt", "unit": "apt", "ste": "ste", "suite": "ste",
+             "flr": "flr", "fl": "flr", "floor": "flr"}
+    PATTERN = re.compile(r"(?:(apartment|apt|unit|suite|ste|floor|flr|fl)\b\.?)?\s*#?\s*(.*)", re.I | re.S)
+
+    def __init__(self, companion, max_len=6):
+        self.companion, self.max_len = companion, max_len
+
+    def __call__(self, value):
+        kind, number = self.PATTERN.fullmatch(_str(value)).groups()
+        number = " ".join(number.split())
+        if not number: raise Invalid("needs a number after the Apt/Ste/Flr designator")
+        if len(number) > self.max_len:
+            raise Invalid(f"{number!r} is {len(number)} characters long; at most {self.max_len} fit")
+        return number, {self.companion: self.KINDS[kind.lower()] if kind else ""}
+
+
+class Integer:
+    PATTERN = re.compile(r"\d{1,15}", re.ASCII)  # int() rejects superscripts and very long digit strings
+
+    def __init__(self, lo=0, hi=None):
+        self.lo, self.hi = lo, hi
+        self.max_len = None if hi is None else len(str(hi))
+
+    def __call__(self, value):
+        s = _str(value).replace(",", "")
+        if not self.PATTERN.fullmatch(s): raise Invalid("must be a whole number")
+        n = int(s)
+        if n < self.lo or (self.hi is not None and n > self.hi):
+            raise Invalid(f"must be between {self.lo} and {self.hi}" if self.hi is not None else f"must be at least {self.lo}")
+        return str(n)
+
+
+class Amount:
+    """A dollar amount; ``$`` and thousands separators are dropped."""
+    PATTERN = re.compile(r"-?\d+(\.\d{1,2})?", re.ASCII)
+
+    def __init__(self, max_len=15):
+        self.max_len = max_len
+
+    def __call__(self, value):
+        s = _str(value).replace("$", "").replace(",", "").replace(" ", "")
+        if not self.PATTERN.fullmatch(s): raise Invalid("must be a dollar amount such as 120000 or 52.50")
+        if len(s) > self.max_len: raise Invalid(f"is longer than the form's {self.max_len} characters")
+        return s
+
+
+class Email:
+    PATTERN = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s.]+")
+
+    def __init__(self, max_len=100):
+        self.max_len = max_len
+
+    def __call__(self, value):
+        s = _str(value)
+        if len(s) > self.max_len or not self.PATTERN.fullmatch(s): raise Invalid("must be an e-mail address")
+        return s
+
+
+class Schema:
+    """The compiled schema: ``normalizers`` maps each known key to its field type."""
+
+    def __init__(self, normalizers):
+        self.normalizers = normalizers
+
+    def validate(self, data):
+        """A normalized copy of ``data``; raises ``PayloadError`` with every problem found."""
+        if not isinstance(data, dict):
+            raise PayloadError([{"field": "", "error": "the payload must be a JSON object"}])
+        out, errors, derived, norm = {}, [], {}, self.normalizers.get
+        for key, value in data.items():
+            f = norm(key)
+            if f is None or value is None or value == "":
+                out[key] = "" if value is None and f is not None else value
+                continue
+            try:
+                v = f(value)
+            except Invalid as e:
+                errors.append({"field": key, "error": str(e)})
+                continue
+            if v.__class__ is tuple:  # (value, {companion key: value}), from Unit
+                v, more = v
+                derived.update(more)
+            out[key] = v
+        if errors: raise PayloadError(errors)
+        # A companion the payload answers itself takes precedence
+        for key, value in derived.items():
+            if value and not out.get(key): out[key] = value
+        return out
+
+    def overflows(self, sources, fields):
+        """Problems where a key's longest value does not fit a form field it fills.
+
+        ``sources`` are ``(key, field name)`` pairs (``Plan.text_sources``);
+        ``fields`` is a field manifest's ``fields`` table.
+        """
+        problems = []
+        for key, name in sources:
+            limit, kind = fields.get(name, {}).get("max_len"), self.normalizers.get(key)
+            if not limit or kind is None: continue
+            longest = getattr(kind, "max_len", None)
+            if longest is None or longest > limit:
+                problems.append(f"{key} ({type(kind).__name__}, up to {longest} characters) fills {name}, "
+                                f"which holds {limit}")
+        return problems
+
+
+def compile_schema(spec):
+    """``Schema`` for a ``{key: field type}`` table (a key may also be a tuple of keys sharing one type)."""
+    normalizers = {}
+    for keys, kind in spec.items():
+        if not callable(kind): raise TypeError(f"Unknown field type {kind!r} for {keys!r}")
+        for key in (keys if isinstance(keys, tuple) else (keys,)):
+            if key in normalizers: raise ValueError(f"{key} appears twice in the payload schema")
+            normalizers[key] = kind
+    return Schema(normalizers)
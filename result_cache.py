@@ -0,0 +1,136 @@
+"""Content-addressed cache of generated PDFs.
+
+Entries are keyed by a hash of the canonical JSON payload, the output mode and
+a fingerprint of the template and fill code, so resubmitting an identical
+questionnaire returns the stored PDF without touching pypdf.  There are two
+tiers: an in-memory LRU bounded by total bytes, and an optional directory
+shared by every gunicorn worker on the host.
+"""
+import collections, hashlib, json, logging, os, tempfile, threading
+
+log = logging.getLogger(__name__)
+
+
+def payload_key(data, mode, fingerprint):
+    canonical = json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(f"{fingerprint}\0{mode}\0{canonical}".encode()).hexdigest()
+
+
+def code_fingerprint(*paths, versions=()):
+    """Hash of the source files (and library ``versions``) that decide what ends up in the PDF."""
+    h = hashlib.sha256("\0".join(versions).encode())
+    for p in paths:
+        with open(p, "rb") as fh:
+            h.update(fh.read())
+    return h.hexdigest()[:16]
+
+
+class ResultCache:
+    def __init__(self, max_bytes=64 << 20, disk_dir=None, disk_max_bytes=512 << 20):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = disk_max_bytes
+        self._mem = collections.OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.counts = collections.Counter()
+        self._disk_lock = threading.Lock()
+        self._disk_bytes = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+            self._disk_bytes = sum(size for _, size, _ in self._disk_entries())
+
+    def get(self, key):
+        with self._lock:
+            pdf = self._mem.get(key)
+            if pdf is not None:
+                self._mem.move_to_end(key)
+                self.counts["memory_hits"] += 1
+                return pdf
+        pdf = self._disk_get(key)
+        with self._lock:
+            self.counts["disk_hits" if pdf is not None else "misses"] += 1
+        if pdf is not None:
+            self._mem_put(key, pdf)
+        return pdf
+
+    def put(self, key, pdf):
+        """Store ``pdf``: bytes, or a ``PdfSpool`` (copied only into the tiers it fits)."""
+        if len(pdf) <= self.max_bytes:
+            self._mem_put(key, pdf if isinstance(pdf, bytes) else pdf.getvalue())
+        self._disk_put(key, pdf)
+
+    def _mem_put(self, key, pdf):
+        if len(pdf) > self.max_bytes: return
+        with self._lock:
+            old = self._mem.pop(key, None)
+            if old is not None: self._bytes -= len(old)
+            self._mem[key] = pdf
+            self._bytes += len(pdf)
+            while self._bytes > self.max_bytes:
+                _, evicted = self._mem.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.counts["evictions"] += 1
+
+    # ── disk tier ─────────────────────────────────────────────────
+    def _path(self, key):
+        return os.path.join(self.disk_dir, key + ".pdf")
+
+    def _disk_get(self, key):
+        if not self.disk_dir: return None
+        try:
+            with open(self._path(key), "rb") as fh:
+                pdf = fh.read()
+            os.utime(self._path(key))  # recency for pruning
+            return pdf
+        except OSError:
+            return None
+
+    def _disk_put(self, key, pdf):
+        if not self.disk_dir: return
+        try:
+            # Write-then-rename so other workers never see a partial file
+            fd, tmp = tempfile.mkstemp(dir=self.disk_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as fh:
+                for chunk in ((pdf,) if isinstance(pdf, bytes) else pdf.chunks()):
+                    fh.write(chunk)
+            os.replace(tmp, self._path(key))
+            with self._disk_lock:
+                # Running total of what this worker wrote (an overwrite counts
+                # twice); the directory is only rescanned once it says we are
+                # over budget, and that rescan also sees other workers' files.
+                self._disk_bytes += len(pdf)
+                if self._disk_bytes > self.disk_max_bytes:
+                    self._disk_prune()
+        except OSError as e:
+            log.warning(f"Result cache write failed: {e}")
+
+    def _disk_entries(self):
+        entries = []
+        for e in os.scandir(self.disk_dir):
+            if e.name.endswith(".pdf"):
+                try:
+                    st = e.stat()
+                except OSError:
+                    continue  # removed by another worker
+                entries.append((st.st_mtime, st.st_size, e.path))
+        return entries
+
+    def _disk_prune(self):
+        # Down to 90% of the budget, so a full cache isn't rescanned on every put
+        entries = self._disk_entries()
+        total = sum(size for _, size, _ in entries)
+        target = self.disk_max_bytes * 9 // 10 if total > self.disk_max_bytes else total
+        for _, size, path in sorted(entries):
+            if total <= target: break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self._disk_bytes = total
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._mem), "bytes": self._bytes, "max_bytes": self.max_bytes,
+                    "disk": bool(self.disk_dir), "disk_bytes": self._disk_bytes, **dict(self.counts)}
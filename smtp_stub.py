@@ -0,0 +1,61 @@
+"""A local SMTP server for benchmarks and tests; no mail leaves the machine.
+
+Just enough SMTP (EHLO, AUTH, MAIL, RCPT, DATA) to accept and count
+messages.  ``reject`` answers every DATA with a permanent error, and
+``drop_after`` closes a connection after that many messages, the way servers
+drop idle or long-lived clients.
+"""
+import socketserver, threading
+
+
+class SMTPStub(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, reject=False, drop_after=None):
+        super().__init__(("127.0.0.1", 0), _SMTPHandler)
+        self.reject, self.drop_after = reject, drop_after
+        self.messages = 0
+        self.bytes = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def close(self):
+        self.shutdown(); self.server_close()
+
+
+class _SMTPHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        srv = self.server
+        with srv.lock: srv.connections += 1
+        say = lambda line: self.wfile.write(line.encode() + b"\r\n")
+        say("220 stub ESMTP")
+        sent = 0
+        for line in self.rfile:
+            cmd = line.decode(errors="replace").strip().upper()
+            if cmd.startswith(("EHLO", "HELO")):
+                say("250-stub"); say("250-AUTH PLAIN LOGIN"); say("250 SIZE 52428800")
+            elif cmd.startswith("AUTH"):
+                say("235 2.7.0 Authentication successful")
+            elif cmd == "DATA":
+                say("354 End data with <CR><LF>.<CR><LF>")
+                size = 0
+                for chunk in self.rfile:
+                    if chunk in (b".\r\n", b".\n"): break
+                    size += len(chunk)
+                if srv.reject:
+                    say("554 5.7.1 Message rejected"); continue
+                with srv.lock:
+                    srv.messages += 1; srv.bytes += size
+                say("250 OK")
+                sent += 1
+                if srv.drop_after and sent >= srv.drop_after: return
+            elif cmd == "QUIT":
+                say("221 Bye"); return
+            else:
+                say("250 OK")
@@ -0,0 +1,101 @@
+"""Write-once buffer that generated PDFs are serialized into.
+
+The writer (pypdf, ``incremental`` or ``compact``) writes straight into a
+``PdfSpool``.  Small documents stay in memory.  Past ``max_size`` the spool
+moves to an unlinked temporary file, so a multi-megabyte PDF costs page cache
+rather than heap.  The HTTP response and the e-mail worker then read the same
+buffer independently.  The response gets its own reader from ``open``, which
+gunicorn can ``sendfile`` once the spool is on disk.  The mailer calls
+``getvalue`` only when it builds the message.
+"""
+import io, os, tempfile
+
+CHUNK = 256 << 10
+
+
+class PdfSpool:
+    def __init__(self, max_size=1 << 20, dir=None):
+        self.max_size = max_size
+        self.dir = dir
+        self.size = 0
+        self._mem = io.BytesIO()
+        self._file = None
+
+    # ── writing (file-like, as pypdf expects) ─────────────────────
+    def write(self, b):
+        n = len(b)
+        if self._file is None and self.size + n > self.max_size:
+            self._file = tempfile.TemporaryFile(dir=self.dir, buffering=CHUNK)
+            self._file.write(self._mem.getbuffer())
+            self._mem = None
+        (self._file or self._mem).write(b)
+        self.size += n
+        return n
+
+    def tell(self):
+        return self.size
+
+    def flush(self):
+        if self._file is not None: self._file.flush()
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def on_disk(self):
+        return self._file is not None
+
+    # ── reading (any number of independent readers) ───────────────
+    def chunks(self, size=CHUNK):
+        """Yield the contents as bytes chunks without moving any shared file position."""
+        if self._file is None:
+            view = self._mem.getbuffer()
+            try:
+                for i in range(0, self.size, size):
+                    yield bytes(view[i:i + size])
+            finally:
+                view.release()
+            return
+        self._file.flush()
+        fd = self._file.fileno()
+        for off in range(0, self.size, size):
+            yield os.pread(fd, min(size, self.size - off), off)
+
+    def getvalue(self):
+        """The whole document as one bytes object (a copy)."""
+        if self._file is None:
+            return self._mem.getvalue()
+        self._file.flush()
+        return os.pread(self._file.fileno(), self.size, 0)
+
+    def open(self):
+        """A private reader positioned at the start, for ``send_file``.
+
+        On disk this is a duplicated descriptor, which gunicorn can ``sendfile``
+        and close without affecting other readers.
+        """
+        if self._file is None:
+            return _ViewReader(self._mem.getbuffer())
+        self._file.flush()
+        fh = os.fdopen(os.dup(self._file.fileno()), "rb")
+        fh.seek(0)
+        return fh
+
+
+class _ViewReader(io.RawIOBase):
+    # Reads from a memoryview without copying the whole buffer first
+    def __init__(self, view):
+        self._view, self._pos = view, 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = min(len(b), len(self._view) - self._pos)
+        b[:n] = self._view[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed: self._view.release()
+        super().close()
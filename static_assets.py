@@ -0,0 +1,110 @@
+"""The questionnaire frontend (``static/``), served from memory with HTTP caching.
+
+Every file is read once at startup.  It gets a content fingerprint and, where
+compression helps, gzip and brotli variants (brotli needs the optional
+``brotli`` package).  Requests get the smallest variant their
+``Accept-Encoding`` allows, without any per-request compression.
+
+Each asset answers at two URLs:
+
+- ``/<name>`` (and ``/`` for ``index.html``) is ``Cache-Control: no-cache``.
+  Browsers keep it but revalidate every time, and an unchanged file costs a
+  304 with no body (``If-None-Match``, or ``If-Modified-Since`` when no ETag
+  is sent).
+- ``/<stem>.<fingerprint><ext>`` (see ``StaticAssets.url``) never changes
+  content, so it is cached for a year as ``immutable``.
+"""
+import gzip, hashlib, mimetypes, os
+from email.utils import formatdate
+from flask import Response, abort
+
+try:
+    import brotli
+except ImportError:  # optional; without it only gzip is offered
+    brotli = None
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+REVALIDATE = "no-cache"
+COMPRESSIBLE = ("text/", "application/javascript", "application/json", "application/xml", "image/svg+xml")
+MIN_COMPRESS = 256  # smaller files are not worth a Content-Encoding
+ENCODINGS = ("br", "gzip")  # preferred first when the client rates them equally
+
+
+class Asset:
+    def __init__(self, name, path):
+        with open(path, "rb") as fh:
+            data = fh.read()
+        self.name = name
+        self.mimetype = mimetypes.guess_type(name)[0] or "application/octet-stream"
+        self.digest = hashlib.sha256(data).hexdigest()[:16]
+        stem, ext = os.path.splitext(name)
+        self.fingerprinted = f"{stem}.{self.digest[:10]}{ext}"
+        self.mtime = int(os.stat(path).st_mtime)
+        self.last_modified = formatdate(self.mtime, usegmt=True)
+        self.variants = {"identity": data}
+        if self.mimetype.startswith(COMPRESSIBLE) and len(data) >= MIN_COMPRESS:
+            for encoding, compress in (("gzip", lambda b: gzip.compress(b, 9, mtime=0)),
+                                       ("br", brotli and (lambda b: brotli.compress(b, quality=11)))):
+                if compress is None: continue
+                packed = compress(data)
+                if len(packed) < len(data): self.variants[encoding] = packed
+        # One ETag per representation, all sharing the content digest
+        self.etags = {e: self.digest if e == "identity" else f"{self.digest}-{e}" for e in self.variants}
+
+    def encoding_for(self, accept):
+        """The variant to send for a request's ``Accept-Encoding`` (a werkzeug ``Accept``)."""
+        best, best_q = "identity", 0
+        for encoding in ENCODINGS:
+            q = accept.quality(encoding) if encoding in self.variants else 0
+            if q > best_q: best, best_q = encoding, q
+        return best
+
+
+class StaticAssets:
+    """Every file under ``directory``, keyed by name and by fingerprinted name."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.assets = {}
+        self._by_url = {}
+        for root, _, files in os.walk(directory):
+            for fname in sorted(files):
+                path = os.path.join(root, fname)
+                name = os.path.relpath(path, directory).replace(os.sep, "/")
+                asset = self.assets[name] = Asset(name, path)
+                self._by_url[name] = (asset, False)
+                self._by_url[asset.fingerprinted] = (asset, True)
+
+    def urls(self):
+        """Every path an asset answers at (without the leading ``/``), plain and fingerprinted."""
+        return list(self._by_url)
+
+    def url(self, name):
+        """The long-lived, fingerprinted URL of an asset."""
+        return "/" + self.assets[name].fingerprinted
+
+    def response(self, name, request):
+        hit = self._by_url.get(name)
+        if hit is None: abort(404)
+        asset, immutable = hit
+        encoding = asset.encoding_for(request.accept_encodings)
+        headers = {"Cache-Control": IMMUTABLE if immutable else REVALIDATE, "Last-Modified": asset.last_modified}
+        if len(asset.variants) > 1:
+            headers["Vary"] = "Accept-Encoding"
+        inm = request.if_none_match
+        if inm:
+            # Any representation's tag means the client already has this content
+            fresh = inm.star_tag or any(inm.contains_weak(tag) for tag in asset.etags.values())
+        else:
+            since = request.if_modified_since
+            fresh = since is not None and since.timestamp() >= asset.mtime
+        r = Response(None if fresh else asset.variants[encoding], status=304 if fresh else 200,
+                     mimetype=asset.mimetype, headers=headers)
+        r.set_etag(asset.etags[encoding])
+        if encoding != "identity" and not fresh:
+            r.headers["Content-Encoding"] = encoding
+        return r
+
+    def stats(self):
+        return {name: {"url": self.url(name), "bytes": {e: len(b) for e, b in a.variants.items()}}
+                for name, a in self.assets.items()}
@@ -0,0 +1,234 @@
+"""Process-wide cache of the parsed I-129 template.
+
+Parsing, decrypting and ``append``-ing the official PDF costs seconds per
+request, so it is done once and every request gets a copy-on-write clone of
+the prepared ``PdfWriter`` instead.
+"""
+import copy, logging, os, threading, time
+from pypdf import PageObject, PdfReader, PdfWriter
+from pypdf.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+from field_manifest import build_manifest, load_manifest
+from form_fill import prefill
+from metrics import Timings
+
+log = logging.getLogger(__name__)
+
+
+def _rss():
+    # Current resident set size (Linux); 0 where /proc is unavailable
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _rebind(obj, dst):
+    # Copy direct containers, re-pointing indirect references at dst.
+    # Streams and scalars are immutable for our purposes and stay shared.
+    if isinstance(obj, IndirectObject):
+        return IndirectObject(obj.idnum, obj.generation, dst)
+    if isinstance(obj, DictionaryObject) and not isinstance(obj, StreamObject):
+        new = copy.copy(obj)
+        for k, v in obj.items():
+            if isinstance(v, (IndirectObject, DictionaryObject, ArrayObject)):
+                dict.__setitem__(new, k, _rebind(v, dst))
+        return new
+    if isinstance(obj, ArrayObject):
+        return ArrayObject(_rebind(v, dst) if isinstance(v, (IndirectObject, DictionaryObject, ArrayObject)) else v
+                           for v in obj)
+    return obj
+
+
+def _mutable_ids(writer):
+    """Object numbers that filling may modify: catalog, page tree, AcroForm and every field/widget."""
+    ids = {writer._root_object.indirect_reference.idnum}
+    todo = [writer._pages]
+    while todo:
+        ref = todo.pop()
+        ids.add(ref.idnum)
+        node = ref.get_object()
+        for key in ("/Kids", "/Annots"):
+            if isinstance(node.raw_get(key) if key in node else None, IndirectObject):
+                ids.add(node.raw_get(key).idnum)
+        todo.extend(node.get("/Kids", []))
+    acro = writer._root_object.raw_get("/AcroForm")
+    if isinstance(acro, IndirectObject):
+        ids.add(acro.idnum)
+    todo = list(writer._root_object["/AcroForm"].get("/Fields", []))
+    for page in writer.pages:
+        todo.extend(page.get("/Annots", []))
+    while todo:
+        ref = todo.pop()
+        if not isinstance(ref, IndirectObject) or ref.idnum in ids: continue
+        ids.add(ref.idnum)
+        node = ref.get_object()
+        if isinstance(node.raw_get("/Kids") if "/Kids" in node else None, IndirectObject):
+            ids.add(node.raw_get("/Kids").idnum)
+        todo.extend(node.get("/Kids", []))
+    return sorted(ids)
+
+
+def prepare_template(path, timings=None):
+    """Load, decrypt and copy the template into a writer with /XFA removed."""
+    timings = timings or Timings()
+    with timings.phase("template_parse"):
+        reader = PdfReader(path)
+        if reader.is_encrypted:
+            reader.decrypt("")
+
+    with timings.phase("template_append"):
+        writer = PdfWriter()
+        writer.append(reader)
+
+    # Remove XFA so PDF viewers render AcroForm fields
+    if "/AcroForm" in writer._root_object:
+        acroform = writer._root_object["/AcroForm"].get_object()
+        if "/XFA" in acroform:
+            del acroform["/XFA"]
+    return writer
+
+
+def clone_writer(template, mutable_ids):
+    """Cheap copy of a prepared writer.
+
+    Every object is shared with ``template`` except the ones in
+    ``mutable_ids``, which are copied and re-bound to the clone so that edits
+    made through the clone never reach the cached template.
+    """
+    # Relies on PdfWriter internals (_objects, _idnum_hash, _id_translated,
+    # _merged_in_pages, _unresolved_links, _info_obj) as of pypdf 6.20;
+    # requirements.txt pins pypdf>=6.20,<7 for that reason.
+    w = copy.copy(template)
+    w._objects = list(template._objects)
+    w._idnum_hash = dict(template._idnum_hash)
+    w._id_translated = dict(template._id_translated)
+    w._merged_in_pages = dict(template._merged_in_pages)
+    w._unresolved_links = []
+    for idnum in mutable_ids:
+        obj = _rebind(template._objects[idnum - 1], w)
+        obj.indirect_reference = IndirectObject(idnum, 0, w)
+        if isinstance(obj, PageObject):
+            obj.pdf = w
+        w._objects[idnum - 1] = obj
+    w._root_object = w._objects[template._root_object.indirect_reference.idnum - 1]
+    w._pages = IndirectObject(template._pages.idnum, template._pages.generation, w)
+    if isinstance(template._info_obj, IndirectObject):
+        w._info_obj = IndirectObject(template._info_obj.idnum, template._info_obj.generation, w)
+    w.flattened_pages = [w._objects[p.indirect_reference.idnum - 1] for p in template.flattened_pages]
+    return w
+
+
+class TemplateCache:
+    """Holds one prepared template and its field manifest, reloading both when the file's mtime changes.
+
+    ``constants`` (field name → value) are filled into the template at load
+    time, so every clone starts with them already set.
+    """
+
+    def __init__(self, path, constants=None):
+        self.path = path
+        self.constants = constants or {}
+        self._lock = threading.Lock()
+        self._writer = None
+        self._mutable = ()
+        self.manifest = None
+        self.manifest_source = None
+        self._incremental = None
+        self._compact = None
+        self._flatten = None
+        self._mtime = None
+        self.hits = 0
+        self.misses = 0
+        self.clones = 0
+        self.load_ms = 0.0
+        self.load_phases_ms = {}
+        self.clone_ms_total = 0.0
+        self.clone_ms_last = 0.0
+        self.resident_bytes = 0  # RSS growth while loading the template (and incremental template)
+
+    def _load(self, mtime):
+        t, rss = time.perf_counter(), _rss()
+        timings = Timings()
+        writer = prepare_template(self.path, timings)
+        with timings.phase("template_manifest"):
+            manifest, self.manifest_source = load_manifest(self.path), "disk"
+            if manifest is None:
+                log.warning(f"No current field manifest for {self.path}; building it in memory "
+                            "(run `python field_manifest.py build` to persist it)")
+                manifest, self.manifest_source = build_manifest(writer, self.path), "built"
+        with timings.phase("template_bake"):
+            prefill(writer, manifest, self.constants)
+            self._mutable = _mutable_ids(writer)
+        self.load_phases_ms = {k: round(v, 1) for k, v in timings.ms.items()}
+        self._writer, self.manifest, self._mtime = writer, manifest, mtime
+        self._incremental = self._compact = self._flatten = None
+        self.load_ms = (time.perf_counter() - t) * 1000
+        self.resident_bytes = max(_rss() - rss, 0)
+        self.misses += 1
+
+    def template(self):
+        """The cached prepared writer (read-only!) and manifest, reloading them if the file changed."""
+        mtime = os.stat(self.path).st_mtime_ns
+        with self._lock:
+            if self._writer is None or mtime != self._mtime:
+                self._load(mtime)
+            else:
+                self.hits += 1
+            return self._writer, self._mutable, self.manifest
+
+    def checkout(self, mutable=None):
+        """A fresh, independently mutable ``PdfWriter`` for one request, plus its manifest.
+
+        ``mutable`` narrows the objects copied for the clone when the caller
+        modifies fewer than filling does (default: every form object).
+        """
+        template, default, manifest = self.template()
+        t = time.perf_counter()
+        w = clone_writer(template, default if mutable is None else mutable)
+        self.clone_ms_last = (time.perf_counter() - t) * 1000
+        self.clone_ms_total += self.clone_ms_last
+        self.clones += 1
+        return w, manifest
+
+    def incremental(self):
+        """The template in its original numbering for incremental output (loaded on first use)."""
+        from incremental import IncrementalTemplate
+        self.template()
+        with self._lock:
+            if self._incremental is None:
+                rss = _rss()
+                self._incremental = IncrementalTemplate(self.path, self.constants)
+                self.resident_bytes += max(_rss() - rss, 0)
+            return self._incremental
+
+    def compact(self):
+        """Serialization caches for compact output (built on first use)."""
+        from compact import CompactTemplate
+        template, _, _ = self.template()
+        with self._lock:
+            if self._compact is None or self._compact.template is not template:
+                self._compact = CompactTemplate(template)
+            return self._compact
+
+    def flatten(self):
+        """Font metrics, widget drawing and page resources for flattened output (built on first use)."""
+        from flatten import FlattenTemplate
+        template, _, manifest = self.template()
+        with self._lock:
+            if self._flatten is None or self._flatten.template is not template:
+                self._flatten = FlattenTemplate(template, manifest)
+            return self._flatten
+
+    def loaded_parts(self):
+        """How many parsed copies of the template are held (the prepared one, plus the incremental one)."""
+        return (self._writer is not None) + (self._incremental is not None)
+
+    def stats(self):
+        return {"loaded": self._writer is not None, "hits": self.hits, "misses": self.misses,
+                "load_ms": round(self.load_ms, 1), "resident_mb": round(self.resident_bytes / (1 << 20), 1), "load_phases_ms": self.load_phases_ms, "clone_ms_last": round(self.clone_ms_last, 2),
+                "clone_ms_avg": round(self.clone_ms_total / self.clones, 2) if self.clones else 0,
+                "objects": len(self._writer._objects) if self._writer else 0,
+                "mutable_objects": len(self._mutable), "manifest": self.manifest_source,
+                "manifest_fields": len(self.manifest["fields"]) if self.manifest else 0, "baked_fields": len(self.constants),
+                "incremental_load_ms": round(self._incremental.load_ms, 1) if self._incremental else None}
@@ -0,0 +1,77 @@
+import io, json, zipfile
+import pytest
+from batch import _json_array, parse_items, stream_zip
+from payload_schema import PayloadError
+
+
+def read_array(body, chunk):
+    out = []
+    for item in _json_array(io.BytesIO(body.encode()), chunk):
+        out.append(("error", str(item)) if isinstance(item, Exception) else item)
+    return out
+
+
+@pytest.mark.parametrize("chunk", [1, 2, 3, 5, 7, 64, 1 << 16])
+def test_array_values_split_across_chunks(chunk):
+    body = '[ 1.5e10, -42 , true,null, "a,]\\" é", {"k": [1, 2, {"x": "}"}]}, 12345678901234567890 ]'
+    assert read_array(body, chunk) == [1.5e10, -42, True, None, 'a,]" é', {"k": [1, 2, {"x": "}"}]},
+                                       12345678901234567890]
+
+
+@pytest.mark.parametrize("chunk", [1, 3, 64])
+def test_multibyte_utf8_split_across_chunks(chunk):
+    assert read_array('[{"name": "Zoë Ñúñez 日本"}]', chunk) == [{"name": "Zoë Ñúñez 日本"}]
+
+
+@pytest.mark.parametrize("body", ["[]", " [ ] ", "[\n]"])
+def test_empty_array(body):
+    assert read_array(body, 2) == []
+
+
+@pytest.mark.parametrize("body", ["", "{}", '{"a": 1}', "[{]", '[{"a": 1'])
+def test_error_before_first_item_raises(body):
+    with pytest.raises(ValueError):
+        read_array(body, 4)
+
+
+@pytest.mark.parametrize("body, message", [
+    ('[{"a": 1}, {"b": 2}, {"c": ]', "item #2"),
+    ('[{"a": 1}, {"b": 2} {"c": 3}]', "after item #1"),
+    ('[{"a": 1}, {"b": 2},]', "item #2"),
+    ('[{"a": 1}, {"b": 2}', "after item #1"),
+])
+@pytest.mark.parametrize("chunk", [3, 1 << 16])
+def test_malformed_element_after_valid_ones_ends_the_batch(body, message, chunk):
+    out = read_array(body, chunk)
+    assert out[:2] == [{"a": 1}, {"b": 2}]
+    assert len(out) == 3 and out[2][0] == "error" and message in out[2][1]
+
+
+def test_parse_items_json_array_flags_non_objects():
+    items = list(parse_items(io.BytesIO(b'[{"a": 1}, 5, "x"]'), "application/json"))
+    assert items[0] == {"a": 1}
+    assert all(isinstance(e, ValueError) and "not a JSON object" in str(e) for e in items[1:])
+
+
+def test_parse_items_rejects_non_array():
+    with pytest.raises(ValueError, match="JSON array"):
+        next(parse_items(io.BytesIO(b'{"a": 1}'), "application/json"))
+
+
+def test_parse_items_ndjson():
+    body = b'{"a": 1}\n\n  {"b": 2}  \n[1]\n{"c": \n{"d": 4}\n'
+    items = list(parse_items(io.BytesIO(body), "application/x-ndjson"))
+    assert items[0] == {"a": 1} and items[1] == {"b": 2} and items[4] == {"d": 4}
+    assert isinstance(items[2], ValueError) and isinstance(items[3], ValueError)
+
+
+def test_stream_zip_reports_item_errors_in_manifest():
+    results = [(0, {"n": 0}, b"%PDF-0", None),
+               (1, None, None, PayloadError([{"field": "petZip", "error": "must be a 5-digit ZIP code"}])),
+               (2, None, None, RuntimeError("boom"))]
+    zf = zipfile.ZipFile(io.BytesIO(b"".join(stream_zip(iter(results), lambda d: "I-129_form.pdf"))))
+    manifest = json.loads(zf.read("manifest.json"))
+    assert zf.read("I-129_form.pdf") == b"%PDF-0"
+    assert [i["status"] for i in manifest["items"]] == ["ok", "error", "error"]
+    assert manifest["items"][1]["errors"] == [{"field": "petZip", "error": "must be a 5-digit ZIP code"}]
+    assert manifest["items"][2]["error"] == "boom" and "errors" not in manifest["items"][2]
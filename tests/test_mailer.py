@@ -0,0 +1,89 @@
+import email, glob, json, time
+import pytest
+from mailer import Mailer
+from smtp_stub import SMTPStub
+
+DATA = {"benFirstName": "Rahul", "benLastName": "Sharma", "classification": "H-1B Specialty Occupation"}
+PDF = b"%PDF-1.7 stub"
+
+
+@pytest.fixture
+def stub():
+    s = SMTPStub()
+    yield s
+    s.close()
+
+
+def mailer(stub, tmp_path, **kw):
+    return Mailer("127.0.0.1", stub.port, "user", "secret", "to@localhost", starttls=False,
+                  deadletter_dir=str(tmp_path / "deadletter"), connect_timeout=5, **kw)
+
+
+def wait_for(cond, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not cond():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.01)
+
+
+def dead_letters(tmp_path):
+    return sorted(glob.glob(str(tmp_path / "deadletter" / "*")))
+
+
+def test_one_connection_for_several_messages(stub, tmp_path):
+    m = mailer(stub, tmp_path)
+    for _ in range(3):
+        assert m.submit(DATA, PDF)
+    wait_for(lambda: m.counts["sent"] == 3)
+    assert stub.messages == 3
+    assert stub.connections == 1 and m.counts["connections"] == 1
+
+
+def test_reconnects_after_server_drops_connection(stub, tmp_path):
+    stub.drop_after = 1
+    m = mailer(stub, tmp_path)
+    m.submit(DATA, PDF)
+    wait_for(lambda: m.counts["sent"] == 1)
+    m.submit(DATA, PDF)
+    wait_for(lambda: m.counts["sent"] == 2)
+    assert stub.messages == 2 and stub.connections == 2
+    # A stale kept-alive connection is not a failed attempt
+    assert m.counts["retries"] == 0 and not dead_letters(tmp_path)
+
+
+def test_retries_then_dead_letters(stub, tmp_path):
+    stub.reject = True
+    m = mailer(stub, tmp_path, max_attempts=3, retry_base=0.01)
+    m.submit(DATA, PDF)
+    wait_for(lambda: m.counts["dead_lettered"] == 1)
+    assert m.counts["retries"] == 2 and m.counts["failed"] == 1
+    eml, meta = dead_letters(tmp_path)
+    assert eml.endswith(".eml") and meta.endswith(".json")
+    with open(eml, "rb") as fh:
+        msg = email.message_from_bytes(fh.read())
+    assert msg["To"] == "to@localhost" and msg.get_payload()[1].get_payload(decode=True) == PDF
+    with open(meta) as fh:
+        info = json.load(fh)
+    assert info["attempts"] == 3 and "554" in info["error"] and info["data"] == DATA
+
+
+def test_queue_full_is_dead_lettered(stub, tmp_path, monkeypatch):
+    m = mailer(stub, tmp_path, queue_size=1)
+    monkeypatch.setattr(m, "_ensure_started", lambda: None)  # no worker, so the queue stays full
+    assert m.submit(DATA, PDF)
+    assert not m.submit(DATA, PDF)
+    assert m.counts["dropped"] == 1 and len(dead_letters(tmp_path)) == 2
+    with open(dead_letters(tmp_path)[1]) as fh:
+        assert json.load(fh)["error"] == "queue full"
+
+
+def test_drain_dead_letters_pending_retries(stub, tmp_path):
+    stub.reject = True
+    m = mailer(stub, tmp_path, retry_base=60)
+    m.submit(DATA, PDF)
+    wait_for(lambda: m.counts["retries"] == 1)
+    assert m.stats()["retrying"] == 1 and m.stats()["depth"] == 0
+    m.drain(timeout=0.1)
+    assert m.counts["dead_lettered"] == 1 and m.stats()["retrying"] == 0
+    with open([p for p in dead_letters(tmp_path) if p.endswith(".json")][0]) as fh:
+        assert json.load(fh)["attempts"] == 1
@@ -0,0 +1,115 @@
+import pytest
+from payload_schema import (Amount, Code, Date, Email, Enum, Integer, Invalid, PayloadError, Str, Unit, YesNo,
+                            compile_schema)
+
+
+@pytest.mark.parametrize("value, out", [("42", "42"), (42, "42"), (7.0, "7"), (" 1,200 ", "1200"), ("007", "7")])
+def test_integer_accepts(value, out):
+    assert Integer(0, 9999)(value) == out
+
+
+@pytest.mark.parametrize("value", ["²", "١٢", "4.5", "-3", "", "1e3", "9" * 5000, True])
+def test_integer_rejects_without_crashing(value):
+    with pytest.raises(Invalid):
+        Integer(0)(value)
+
+
+def test_integer_range():
+    hours = Integer(1, 168)
+    assert hours.max_len == 3
+    for bad in ("0", "169"):
+        with pytest.raises(Invalid, match="between 1 and 168"):
+            hours(bad)
+
+
+@pytest.mark.parametrize("value, number, kind", [
+    ("Suite 400", "400", "ste"), ("ste. 400", "400", "ste"), ("Apt 2B", "2B", "apt"), ("APARTMENT #7", "7", "apt"),
+    ("Floor 12", "12", "flr"), ("Fl 3", "3", "flr"), ("#12", "12", ""), ("400", "400", ""), ("Flat 3", "Flat 3", "")])
+def test_unit_splits_designator(value, number, kind):
+    assert Unit("petAptType")(value) == (number, {"petAptType": kind})
+
+
+@pytest.mark.parametrize("value", ["Suite", "Suite 1234567"])
+def test_unit_rejects(value):
+    with pytest.raises(Invalid):
+        Unit("petAptType")(value)
+
+
+def test_enum_is_case_insensitive():
+    sex = Enum("male", "female")
+    assert sex("FEMALE") == "female" and sex.max_len == 6
+    with pytest.raises(Invalid, match="must be one of 'male', 'female'"):
+        sex("other")
+
+
+@pytest.mark.parametrize("value, out", [("2025-10-01", "10/01/2025"), ("1/2/2024", "01/02/2024"),
+                                        ("d/s", "D/S"), (" 2024-02-29 ", "02/29/2024")])
+def test_date_normalizes_to_form_format(value, out):
+    assert Date("D/S")(value) == out
+
+
+@pytest.mark.parametrize("value", ["2023-02-29", "13/01/2024", "1899-01-01", "٢٠٢٤-01-01", "2024/01/01", "tomorrow"])
+def test_date_rejects(value):
+    with pytest.raises(Invalid):
+        Date()(value)
+
+
+def test_iso_date_stays_iso():
+    assert Date(iso=True)("01/20/2025") == "2025-01-20"
+
+
+def test_code_strips_and_matches_ascii_only():
+    fein = Code(r"\d{9}", "9 digits", 9)
+    assert fein("12-3456789") == "123456789"
+    for bad in ("12345678", "1234567890", "١٢٣٤٥٦٧٨٩"):
+        with pytest.raises(Invalid):
+            fein(bad)
+    receipt = Code(r"[A-Z]{3}\d{10}", "a receipt number", 13, literals=("None",))
+    assert receipt("none") == "None" and receipt("wac-2190012345") == "WAC2190012345"
+
+
+def test_small_types():
+    assert YesNo()(True) == "yes" and YesNo()("N") == "no"
+    assert Amount()("$120,000.50") == "120000.50"
+    assert Email()("hr@acme.com") == "hr@acme.com"
+    assert Str(5)("  a \n b  ") == "a b"
+    with pytest.raises(Invalid):
+        Str(5)("abcdef")
+
+
+SCHEMA = compile_schema({"totalWorkers": Integer(1, 99), ("petApt", "benApt"): Unit("x"), "petAptType": Enum("apt", "ste"),
+                         "benDob": Date()})
+
+
+def test_validate_normalizes_and_passes_unknown_keys():
+    out = SCHEMA.validate({"totalWorkers": 3, "benDob": "1990-05-15", "benApt": None, "other": [1]})
+    assert out == {"totalWorkers": "3", "benDob": "05/15/1990", "benApt": "", "other": [1]}
+
+
+def test_validate_companion_defers_to_explicit_answer():
+    unit = compile_schema({"petApt": Unit("petAptType"), "petAptType": Enum("apt", "ste")})
+    assert unit.validate({"petApt": "Suite 4"}) == {"petApt": "4", "petAptType": "ste"}
+    assert unit.validate({"petAptType": "apt", "petApt": "Suite 4"})["petAptType"] == "apt"
+    assert unit.validate({"petAptType": "", "petApt": "Suite 4"})["petAptType"] == "ste"
+
+
+def test_validate_collects_every_error():
+    with pytest.raises(PayloadError) as e:
+        SCHEMA.validate({"totalWorkers": "²", "benDob": "2023-02-30", "petAptType": "flr"})
+    assert [x["field"] for x in e.value.errors] == ["totalWorkers", "benDob", "petAptType"]
+    with pytest.raises(PayloadError):
+        SCHEMA.validate([{"totalWorkers": "1"}])
+
+
+def test_compile_schema_rejects_duplicates_and_non_types():
+    with pytest.raises(ValueError):
+        compile_schema({"a": Str(), ("b", "a"): Str()})
+    with pytest.raises(TypeError):
+        compile_schema({"a": "text"})
+
+
+def test_overflows():
+    fields = {"F1": {"max_len": 5}, "F2": {"max_len": 2}, "F3": {}}
+    schema = compile_schema({"zip": Code(r"\d{5}", "ZIP", 5), "n": Integer(0)})
+    assert schema.overflows([("zip", "F1"), ("zip", "F3")], fields) == []
+    assert len(schema.overflows([("zip", "F2"), ("n", "F1")], fields)) == 2